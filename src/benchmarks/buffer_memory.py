@@ -0,0 +1,67 @@
+"""
+Reports ReplayBuffer storage bytes per episode for the available storage layouts and dtypes.
+
+Run from the src directory:
+    python -m benchmarks.buffer_memory --n-agents 27 --n-actions 36 --obs-shape 285 --state-shape 1170
+"""
+import argparse
+
+from benchmarks.replay_buffer import build_scheme
+from components.episode_buffer import ReplayBuffer, PackedReplayBuffer, compact_storage_scheme
+
+
+def bytes_per_episode(buffer):
+    data = buffer.data
+    tensors = list(data.transition_data.values()) + list(data.episode_data.values())
+    return sum(v.numel() * v.element_size() for v in tensors) / buffer.buffer_size
+
+
+def bench_memory(args):
+    scheme, groups, preprocess = build_scheme(args.n_agents, args.n_actions, args.obs_shape, args.state_shape)
+    _, _, lazy_preprocess = build_scheme(args.n_agents, args.n_actions, args.obs_shape, args.state_shape,
+                                         lazy_preprocess=True)
+    max_seq_length = args.episode_limit + 1
+    schemes = [
+        ("default", scheme, preprocess),
+        ("lazy one-hot", scheme, lazy_preprocess),
+        ("uint8", compact_storage_scheme(scheme, preprocess), preprocess),
+        ("uint8 + float16 obs/state", compact_storage_scheme(scheme, preprocess, float16_keys=["obs", "state"]),
+         preprocess),
+        ("uint8 + float16 + lazy one-hot", compact_storage_scheme(scheme, preprocess, float16_keys=["obs", "state"]),
+         lazy_preprocess),
+    ]
+    results = []
+    for name, buffer_scheme, preprocess in schemes:
+        buffer = ReplayBuffer(buffer_scheme, groups, args.buffer_size, max_seq_length, preprocess=preprocess)
+        results.append(("padded, " + name, bytes_per_episode(buffer)))
+        # Packed storage sized for the mean episode length instead of the episode limit
+        packed = PackedReplayBuffer(buffer_scheme, groups, args.buffer_size, max_seq_length,
+                                    transition_capacity=max(2 * max_seq_length, args.buffer_size * (args.mean_episode_length + 1)),
+                                    preprocess=preprocess)
+        results.append(("packed, " + name, bytes_per_episode(packed)))
+    return results
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="ReplayBuffer bytes per episode")
+    parser.add_argument("--buffer-size", type=int, default=100)
+    parser.add_argument("--n-agents", type=int, default=8)
+    parser.add_argument("--n-actions", type=int, default=14)
+    parser.add_argument("--obs-shape", type=int, default=80)
+    parser.add_argument("--state-shape", type=int, default=168)
+    parser.add_argument("--episode-limit", type=int, default=120)
+    parser.add_argument("--mean-episode-length", type=int, default=60, help="Used to size packed buffers")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = bench_memory(args)
+    baseline = results[0][1]
+    print("{:<42} {:>16} {:>10}".format("storage", "bytes/episode", "vs default"))
+    for name, n_bytes in results:
+        print("{:<42} {:>16.0f} {:>9.2f}x".format(name, n_bytes, baseline / n_bytes))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+Benchmark of COMACritic training steps against the number of agents.
+
+Times a forward and backward pass over whole episodes and measures the peak memory it allocates, with the original
+input construction, which repeats the state and joint actions for every agent, and with the factored first layer.
+Peak memory is read from the cuda allocator with --cuda, otherwise it is estimated from torch.profiler's record of
+cpu allocations and frees. Run from the src directory:
+    python -m benchmarks.coma_critic --n-agents 3 5 10 20 27
+"""
+import argparse
+import time
+import types
+import torch as th
+import torch.nn.functional as F
+from torch.profiler import profile, ProfilerActivity
+
+from benchmarks.replay_buffer import build_scheme, random_episode_batch
+from envs.synthetic import SyntheticVecEnv
+from modules.critics.coma import COMACritic
+
+
+def legacy_forward(self, batch, t=None):
+    # The original COMACritic, concatenating the inputs of every agent before fc1
+    inputs = legacy_build_inputs(self, batch, t=t)
+    x = F.relu(self.fc1(inputs))
+    x = F.relu(self.fc2(x))
+    q = self.fc3(x)
+    return q
+
+
+def legacy_build_inputs(self, batch, t=None):
+    bs = batch.batch_size
+    max_t = batch.max_seq_length if t is None else 1
+    ts = slice(None) if t is None else slice(t, t+1)
+    inputs = []
+    # state
+    inputs.append(batch["state"][:, ts].unsqueeze(2).repeat(1, 1, self.n_agents, 1))
+
+    # observation
+    inputs.append(batch["obs"][:, ts])
+
+    # actions (masked out by agent)
+    actions = batch["actions_onehot"][:, ts].view(bs, max_t, 1, -1).repeat(1, 1, self.n_agents, 1)
+    agent_mask = (1 - th.eye(self.n_agents, device=batch.device))
+    agent_mask = agent_mask.view(-1, 1).repeat(1, self.n_actions).view(self.n_agents, -1)
+    inputs.append(actions * agent_mask.unsqueeze(0).unsqueeze(0))
+
+    # last actions
+    if t == 0:
+        inputs.append(th.zeros_like(batch["actions_onehot"][:, 0:1]).view(bs, max_t, 1, -1).repeat(1, 1, self.n_agents, 1))
+    elif isinstance(t, int):
+        inputs.append(batch["actions_onehot"][:, slice(t-1, t)].view(bs, max_t, 1, -1).repeat(1, 1, self.n_agents, 1))
+    else:
+        last_actions = th.cat([th.zeros_like(batch["actions_onehot"][:, 0:1]), batch["actions_onehot"][:, :-1]], dim=1)
+        last_actions = last_actions.view(bs, max_t, 1, -1).repeat(1, 1, self.n_agents, 1)
+        inputs.append(last_actions)
+
+    inputs.append(th.eye(self.n_agents, device=batch.device).unsqueeze(0).unsqueeze(0).expand(bs, max_t, -1, -1))
+
+    inputs = th.cat([x.reshape(bs, max_t, self.n_agents, -1) for x in inputs], dim=-1)
+    return inputs
+
+
+def peak_memory(fn, device):
+    if device == "cuda":
+        th.cuda.synchronize()
+        th.cuda.reset_peak_memory_stats()
+        base = th.cuda.memory_allocated()
+        fn()
+        th.cuda.synchronize()
+        return th.cuda.max_memory_allocated() - base
+
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+    current, peak = 0, 0
+    for e in sorted(prof.events(), key=lambda e: e.time_range.start):
+        current += e.self_cpu_memory_usage
+        peak = max(peak, current)
+    return peak
+
+
+def bench(args, n_agents, legacy):
+    device = "cuda" if args.cuda else "cpu"
+    # SMAC sizes for n_agents against as many enemies
+    env_info = SyntheticVecEnv(n_agents=n_agents, n_enemies=n_agents, obs_size=args.obs_shape,
+                               state_size=args.state_shape).get_env_info()
+    n_actions = env_info["n_actions"]
+    scheme, groups, preprocess = build_scheme(n_agents, n_actions, env_info["obs_shape"], env_info["state_shape"])
+    batch = random_episode_batch(scheme, groups, preprocess, args.batch_size, args.episode_limit + 1, n_actions)
+    batch.to(device)
+    critic_args = types.SimpleNamespace(n_agents=n_agents, n_actions=n_actions)
+    critic = COMACritic(batch.scheme, critic_args).to(device)
+    if legacy:
+        critic.forward = types.MethodType(legacy_forward, critic)
+
+    def step():
+        critic.zero_grad()
+        critic(batch).sum().backward()
+
+    step()  # warm up
+    memory = peak_memory(step, device)
+    start = time.perf_counter()
+    for _ in range(args.n_iters):
+        step()
+    if args.cuda:
+        th.cuda.synchronize()
+    return (time.perf_counter() - start) / args.n_iters, memory
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="COMACritic step time and peak memory against the number of agents")
+    parser.add_argument("--n-agents", type=int, nargs="+", default=[3, 5, 10, 20, 27])
+    parser.add_argument("--obs-shape", type=int, default=None, help="SMAC obs size for n-agents if not given")
+    parser.add_argument("--state-shape", type=int, default=None, help="SMAC state size for n-agents if not given")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--episode-limit", type=int, default=120)
+    parser.add_argument("--n-iters", type=int, default=10)
+    parser.add_argument("--cuda", action="store_true")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    print("{:>8} {:>10} {:>12} {:>14}".format("agents", "", "step ms", "peak MB"))
+    for n_agents in args.n_agents:
+        for name, legacy in [("before", True), ("after", False)]:
+            step_time, memory = bench(args, n_agents, legacy)
+            print("{:>8} {:>10} {:>12.2f} {:>14.1f}".format(n_agents, name, step_time * 1000, memory / 2 ** 20))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Profiler-backed benchmark of tensor allocations per acting step in BasicMAC.
+
+Counts the allocations recorded by torch.profiler when building agent inputs and when selecting actions,
+with the original per-step input construction and with the cached agent ids and input workspace.
+Run from the src directory:
+    python -m benchmarks.mac_inputs --batch-size 8 --n-agents 8
+"""
+import argparse
+import types
+import torch as th
+from torch.profiler import profile, ProfilerActivity
+
+from benchmarks.replay_buffer import build_scheme, random_episode_batch
+from controllers import REGISTRY as mac_REGISTRY
+
+
+def legacy_build_inputs(self, batch, t, inplace=False):
+    # The original BasicMAC._build_inputs, allocating a fresh eye and concatenation every step
+    bs = batch.batch_size
+    inputs = []
+    inputs.append(batch["obs"][:, t])  # b1av
+    if self.args.obs_last_action:
+        if t == 0:
+            inputs.append(th.zeros_like(batch["actions_onehot"][:, t]))
+        else:
+            inputs.append(batch["actions_onehot"][:, t-1])
+    if self.args.obs_agent_id:
+        inputs.append(th.eye(self.n_agents, device=batch.device).unsqueeze(0).expand(bs, -1, -1))
+
+    inputs = th.cat([x.reshape(bs*self.n_agents, -1) for x in inputs], dim=1)
+    return inputs
+
+
+def allocations_per_step(fn, n_steps):
+    fn(0)  # warm up, which also creates any cached tensors
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        for t in range(n_steps):
+            fn(t)
+    # Allocations are attributed to the op that made them, frees outside of ops show up as [memory] events
+    allocs = [e for e in prof.events() if e.name != "[memory]" and e.self_cpu_memory_usage > 0]
+    return len(allocs) / n_steps, sum(e.self_cpu_memory_usage for e in allocs) / n_steps
+
+
+def bench(args, legacy):
+    scheme, groups, preprocess = build_scheme(args.n_agents, args.n_actions, args.obs_shape, args.state_shape)
+    batch = random_episode_batch(scheme, groups, preprocess, args.batch_size, args.episode_limit + 1, args.n_actions)
+    mac_args = types.SimpleNamespace(n_agents=args.n_agents, n_actions=args.n_actions, agent="rnn",
+                                     rnn_hidden_dim=args.rnn_hidden_dim, obs_last_action=True, obs_agent_id=True,
+                                     agent_output_type="q", action_selector="epsilon_greedy",
+                                     epsilon_start=0.05, epsilon_finish=0.05, epsilon_anneal_time=1, epsilon_delay=0,
+                                     save_policy_outputs=False)
+    mac = mac_REGISTRY["basic_mac"](batch.scheme, groups, mac_args)
+    if legacy:
+        mac._build_inputs = types.MethodType(legacy_build_inputs, mac)
+    mac.init_hidden(args.batch_size)
+
+    def build_inputs(t):
+        with th.no_grad():
+            mac._build_inputs(batch, t % args.episode_limit, inplace=True)
+
+    def select_actions(t):
+        mac.select_actions(batch, t_ep=t % args.episode_limit, t_env=0)
+
+    return allocations_per_step(build_inputs, args.n_steps), allocations_per_step(select_actions, args.n_steps)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="BasicMAC acting allocation benchmark")
+    parser.add_argument("--batch-size", type=int, default=8, help="Parallel envs acting together")
+    parser.add_argument("--n-agents", type=int, default=8)
+    parser.add_argument("--n-actions", type=int, default=14)
+    parser.add_argument("--obs-shape", type=int, default=80)
+    parser.add_argument("--state-shape", type=int, default=168)
+    parser.add_argument("--episode-limit", type=int, default=120)
+    parser.add_argument("--rnn-hidden-dim", type=int, default=64)
+    parser.add_argument("--n-steps", type=int, default=100)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    print("{:>10} {:>16} {:>16} {:>18} {:>18}".format(
+        "", "inputs allocs", "inputs bytes", "select allocs", "select bytes"))
+    for name, legacy in [("before", True), ("after", False)]:
+        (in_n, in_b), (sel_n, sel_b) = bench(args, legacy)
+        print("{:>10} {:>16.1f} {:>16.0f} {:>18.1f} {:>18.0f}".format(name, in_n, in_b, sel_n, sel_b))
+
+
+if __name__ == "__main__":
+    main()
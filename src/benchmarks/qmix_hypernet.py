@@ -0,0 +1,122 @@
+"""
+Benchmark of the QMixer hypernetworks in QLearner's training step against the width of the state.
+
+Compares the original mixing, which runs the four hypernetworks separately on the states of timesteps :-1 for the
+online mixer and 1: for the target mixer, with the stacked hypernetwork evaluated once on every state, checking that
+the mixed values and gradients match. Run from the src directory:
+    python -m benchmarks.qmix_hypernet --state-shapes 120 500 2000
+"""
+import argparse
+import copy
+import time
+import types
+import torch as th
+import torch.nn.functional as F
+
+from modules.mixers.qmix import QMixer
+
+
+def legacy_forward(self, agent_qs, states):
+    # The original QMixer.forward
+    bs = agent_qs.size(0)
+    states = states.reshape(-1, self.state_dim)
+    agent_qs = agent_qs.view(-1, 1, self.n_agents)
+    # First layer
+    w1 = th.abs(self.hyper_w_1(states))
+    b1 = self.hyper_b_1(states)
+    w1 = w1.view(-1, self.n_agents, self.embed_dim)
+    b1 = b1.view(-1, 1, self.embed_dim)
+    hidden = F.elu(th.bmm(agent_qs, w1) + b1)
+    # Second layer
+    w_final = th.abs(self.hyper_w_final(states))
+    w_final = w_final.view(-1, self.embed_dim, 1)
+    # State-dependent bias
+    v = self.V(states).view(-1, 1, 1)
+    # Compute final output
+    y = th.bmm(hidden, w_final) + v
+    # Reshape and return
+    q_tot = y.view(bs, -1, 1)
+    return q_tot
+
+
+def legacy_mix(mixer, target_mixer, chosen_action_qvals, target_max_qvals, states):
+    return legacy_forward(mixer, chosen_action_qvals, states[:, :-1]), \
+        legacy_forward(target_mixer, target_max_qvals, states[:, 1:])
+
+
+def mix(mixer, target_mixer, chosen_action_qvals, target_max_qvals, states):
+    # As in QLearner.train
+    chosen_action_qvals = mixer.mix(F.pad(chosen_action_qvals, (0, 0, 0, 1)), mixer.hypernet(states))[:, :-1]
+    with th.no_grad():
+        target_max_qvals = target_mixer.mix(F.pad(target_max_qvals, (0, 0, 1, 0)), target_mixer.hypernet(states))[:, 1:]
+    return chosen_action_qvals, target_max_qvals
+
+
+def check(mixer, target_mixer, inputs):
+    # The mixed values and the gradients of a td loss on them must match the original mixing
+    results = []
+    for fn in [legacy_mix, mix]:
+        mixer.zero_grad()
+        q_tot, target_q_tot = fn(mixer, target_mixer, *inputs)
+        ((q_tot - target_q_tot.detach()) ** 2).sum().backward()
+        results.append([q_tot, target_q_tot] + [p.grad.clone() for p in mixer.parameters()])
+    for expected, actual in zip(*results):
+        assert th.allclose(expected, actual, rtol=1e-4, atol=1e-4 * expected.abs().max().item()), \
+            "Stacked hypernetwork differs from the original by {}".format((expected - actual).abs().max().item())
+
+
+def bench(args, state_shape, fn):
+    device = "cuda" if args.cuda else "cpu"
+    mixer_args = types.SimpleNamespace(n_agents=args.n_agents, state_shape=state_shape,
+                                       mixing_embed_dim=args.mixing_embed_dim, hypernet_layers=args.hypernet_layers,
+                                       hypernet_embed=args.hypernet_embed)
+    th.manual_seed(0)
+    mixer = QMixer(mixer_args).to(device)
+    target_mixer = copy.deepcopy(mixer)
+    states = th.randn(args.batch_size, args.episode_limit + 1, state_shape, device=device)
+    chosen_action_qvals = th.randn(args.batch_size, args.episode_limit, args.n_agents, device=device)
+    target_max_qvals = th.randn(args.batch_size, args.episode_limit, args.n_agents, device=device)
+    inputs = (chosen_action_qvals, target_max_qvals, states)
+    check(mixer, target_mixer, inputs)
+
+    def step():
+        mixer.zero_grad()
+        q_tot, target_q_tot = fn(mixer, target_mixer, *inputs)
+        ((q_tot - target_q_tot.detach()) ** 2).sum().backward()
+
+    step()  # warm up
+    if args.cuda:
+        th.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(args.n_iters):
+        step()
+    if args.cuda:
+        th.cuda.synchronize()
+    return (time.perf_counter() - start) / args.n_iters
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="QMixer hypernetwork benchmark against the state width")
+    parser.add_argument("--state-shapes", type=int, nargs="+", default=[120, 500, 2000])
+    parser.add_argument("--n-agents", type=int, default=10)
+    parser.add_argument("--mixing-embed-dim", type=int, default=32)
+    parser.add_argument("--hypernet-layers", type=int, default=1)
+    parser.add_argument("--hypernet-embed", type=int, default=64)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--episode-limit", type=int, default=120)
+    parser.add_argument("--n-iters", type=int, default=20)
+    parser.add_argument("--cuda", action="store_true")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    print("{:>8} {:>12} {:>12} {:>10}".format("state", "before ms", "after ms", "speedup"))
+    for state_shape in args.state_shapes:
+        before = bench(args, state_shape, legacy_mix)
+        after = bench(args, state_shape, mix)
+        print("{:>8} {:>12.2f} {:>12.2f} {:>10.2f}".format(state_shape, before * 1000, after * 1000, before / after))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""
+Microbenchmark for ReplayBuffer insert and sample throughput.
+
+Run from the src directory:
+    python -m benchmarks.replay_buffer --buffer-sizes 500 5000 --n-agents 8
+"""
+import argparse
+import time
+import numpy as np
+import torch as th
+
+from components.episode_buffer import EpisodeBatch, ReplayBuffer
+from components.transforms import OneHot
+
+
+def build_scheme(n_agents, n_actions, obs_shape, state_shape, lazy_preprocess=False):
+    # Mirrors the default scheme built in run.run_sequential
+    scheme = {
+        "state": {"vshape": state_shape},
+        "obs": {"vshape": obs_shape, "group": "agents"},
+        "actions": {"vshape": (1,), "group": "agents", "dtype": th.long},
+        "avail_actions": {"vshape": (n_actions,), "group": "agents", "dtype": th.int},
+        "reward": {"vshape": (1,)},
+        "terminated": {"vshape": (1,), "dtype": th.uint8},
+        "battle_won": {"vshape": (1,), "dtype": th.uint8},
+    }
+    groups = {"agents": n_agents}
+    preprocess = {"actions": ("actions_onehot", [OneHot(out_dim=n_actions, lazy=lazy_preprocess)])}
+    return scheme, groups, preprocess
+
+
+def random_episode_batch(scheme, groups, preprocess, batch_size, max_seq_length, n_actions):
+    batch = EpisodeBatch(scheme, groups, batch_size, max_seq_length, preprocess=preprocess)
+    n_agents = groups["agents"]
+    batch.update({
+        "state": th.rand(batch_size, max_seq_length, scheme["state"]["vshape"]),
+        "obs": th.rand(batch_size, max_seq_length, n_agents, scheme["obs"]["vshape"]),
+        "actions": th.randint(n_actions, (batch_size, max_seq_length, n_agents, 1)),
+        "avail_actions": th.ones(batch_size, max_seq_length, n_agents, n_actions, dtype=th.int),
+        "reward": th.rand(batch_size, max_seq_length, 1),
+    })
+    return batch
+
+
+def legacy_insert(buffer, ep_batch):
+    # The pre-vectorisation insert path: EpisodeBatch.update (incl. preprocessing) for every key
+    if buffer.buffer_index + ep_batch.batch_size <= buffer.buffer_size:
+        buffer.update(ep_batch.data.transition_data,
+                      slice(buffer.buffer_index, buffer.buffer_index + ep_batch.batch_size),
+                      slice(0, ep_batch.max_seq_length),
+                      mark_filled=False)
+        buffer.update(ep_batch.data.episode_data,
+                      slice(buffer.buffer_index, buffer.buffer_index + ep_batch.batch_size))
+        buffer.buffer_index = buffer.buffer_index + ep_batch.batch_size
+        buffer.episodes_in_buffer = max(buffer.episodes_in_buffer, buffer.buffer_index)
+        buffer.buffer_index = buffer.buffer_index % buffer.buffer_size
+    else:
+        buffer_left = buffer.buffer_size - buffer.buffer_index
+        legacy_insert(buffer, ep_batch[0:buffer_left, :])
+        legacy_insert(buffer, ep_batch[buffer_left:, :])
+
+
+def legacy_sample(buffer, batch_size):
+    ep_ids = np.random.choice(buffer.episodes_in_buffer, batch_size, replace=False)
+    return buffer[ep_ids]
+
+
+def _rate(fn, n_iters):
+    fn()  # warm up
+    start = time.perf_counter()
+    for _ in range(n_iters):
+        fn()
+    return n_iters / (time.perf_counter() - start)
+
+
+def bench_buffer(buffer_size, args):
+    scheme, groups, preprocess = build_scheme(args.n_agents, args.n_actions, args.obs_shape, args.state_shape)
+    buffer = ReplayBuffer(scheme, groups, buffer_size, args.episode_limit + 1, preprocess=preprocess)
+    ep_batch = random_episode_batch(scheme, groups, preprocess, args.batch_size_run, args.episode_limit + 1, args.n_actions)
+
+    # Fill the buffer once so that sampling draws from the full range
+    while buffer.episodes_in_buffer < buffer_size:
+        buffer.insert_episode_batch(ep_batch)
+
+    results = {
+        "buffer_size": buffer_size,
+        "inserts_per_sec": _rate(lambda: buffer.insert_episode_batch(ep_batch), args.n_iters) * args.batch_size_run,
+        "legacy_inserts_per_sec": _rate(lambda: legacy_insert(buffer, ep_batch), args.n_iters) * args.batch_size_run,
+        "samples_per_sec": _rate(lambda: buffer.sample(args.batch_size), args.n_iters),
+        "legacy_samples_per_sec": _rate(lambda: legacy_sample(buffer, args.batch_size), args.n_iters),
+    }
+    return results
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="ReplayBuffer insert/sample microbenchmark")
+    parser.add_argument("--buffer-sizes", type=int, nargs="+", default=[500, 1000, 5000])
+    parser.add_argument("--n-agents", type=int, default=8)
+    parser.add_argument("--n-actions", type=int, default=14)
+    parser.add_argument("--obs-shape", type=int, default=80)
+    parser.add_argument("--state-shape", type=int, default=168)
+    parser.add_argument("--episode-limit", type=int, default=120)
+    parser.add_argument("--batch-size-run", type=int, default=8, help="Episodes per insert")
+    parser.add_argument("--batch-size", type=int, default=32, help="Episodes per sample")
+    parser.add_argument("--n-iters", type=int, default=50)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    print("{:>12} {:>16} {:>16} {:>16} {:>16}".format(
+        "buffer_size", "inserts/s", "legacy inserts/s", "samples/s", "legacy samples/s"))
+    for buffer_size in args.buffer_sizes:
+        r = bench_buffer(buffer_size, args)
+        print("{:>12} {:>16.1f} {:>16.1f} {:>16.1f} {:>16.1f}".format(
+            r["buffer_size"], r["inserts_per_sec"], r["legacy_inserts_per_sec"],
+            r["samples_per_sec"], r["legacy_samples_per_sec"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Benchmark of the TD(lambda) targets in utils/rl_utils against episode length.
+
+Compares the original loop over timesteps with the chunked discounted sum, checking that their targets match, and
+times the n-step targets and discounted returns built on it. Run from the src directory:
+    python -m benchmarks.returns --episode-lengths 50 100 200 400
+"""
+import argparse
+import time
+import torch as th
+
+from utils.rl_utils import build_discounted_returns, build_n_step_targets, build_td_lambda_targets
+
+
+def legacy_build_td_lambda_targets(rewards, terminated, mask, target_qs, n_agents, gamma, td_lambda):
+    # The original build_td_lambda_targets, updating one timestep at a time
+    ret = target_qs.new_zeros(*target_qs.shape)
+    ret[:, -1] = target_qs[:, -1] * (1 - th.sum(terminated, dim=1))
+    for t in range(ret.shape[1] - 2, -1,  -1):
+        ret[:, t] = td_lambda * gamma * ret[:, t + 1] + mask[:, t] \
+                    * (rewards[:, t] + (1 - td_lambda) * gamma * target_qs[:, t + 1] * (1 - terminated[:, t]))
+    return ret[:, 0:-1]
+
+
+def random_targets(batch_size, max_seq_length, n_agents, device):
+    # Episodes of random lengths up to max_seq_length - 1 transitions, most of them terminating
+    lengths = th.randint(1, max_seq_length, (batch_size,), device=device)
+    ts = th.arange(max_seq_length - 1, device=device).view(1, -1, 1)
+    mask = (ts < lengths.view(-1, 1, 1)).float()
+    terminated = ((ts == lengths.view(-1, 1, 1) - 1) & (th.rand(batch_size, 1, 1, device=device) < 0.8)).float()
+    rewards = th.randn(batch_size, max_seq_length - 1, 1, device=device) * mask
+    target_qs = th.randn(batch_size, max_seq_length, n_agents, device=device)
+    return rewards, terminated, mask, target_qs
+
+
+def time_fn(fn, n_iters, cuda):
+    fn()
+    if cuda:
+        th.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(n_iters):
+        fn()
+    if cuda:
+        th.cuda.synchronize()
+    return (time.perf_counter() - start) / n_iters
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="TD(lambda), n-step and discounted return benchmark")
+    parser.add_argument("--episode-lengths", type=int, nargs="+", default=[50, 100, 200, 400])
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--n-agents", type=int, default=8)
+    parser.add_argument("--gamma", type=float, default=0.99)
+    parser.add_argument("--td-lambda", type=float, default=0.8)
+    parser.add_argument("--q-nstep", type=int, default=5)
+    parser.add_argument("--n-iters", type=int, default=50)
+    parser.add_argument("--cuda", action="store_true")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    device = "cuda" if args.cuda else "cpu"
+    print("{:>6} {:>14} {:>14} {:>14} {:>14}".format("T", "loop ms", "td-lambda ms", "n-step ms", "returns ms"))
+    for max_t in args.episode_lengths:
+        rewards, terminated, mask, target_qs = random_targets(args.batch_size, max_t + 1, args.n_agents, device)
+        td_args = (rewards, terminated, mask, target_qs, args.n_agents, args.gamma, args.td_lambda)
+
+        expected = legacy_build_td_lambda_targets(*td_args)
+        assert th.allclose(build_td_lambda_targets(*td_args), expected, rtol=1e-4, atol=1e-4), \
+            "td-lambda targets differ from the loop for T={}".format(max_t)
+
+        times = [
+            time_fn(lambda: legacy_build_td_lambda_targets(*td_args), args.n_iters, args.cuda),
+            time_fn(lambda: build_td_lambda_targets(*td_args), args.n_iters, args.cuda),
+            time_fn(lambda: build_n_step_targets(rewards, terminated, mask, target_qs, args.n_agents, args.gamma,
+                                                 args.q_nstep), args.n_iters, args.cuda),
+            time_fn(lambda: build_discounted_returns(rewards, mask, args.gamma), args.n_iters, args.cuda),
+        ]
+        print("{:>6} {:>14.3f} {:>14.3f} {:>14.3f} {:>14.3f}".format(max_t, *[t * 1000 for t in times]))
+
+
+if __name__ == "__main__":
+    main()
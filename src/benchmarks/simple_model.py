@@ -0,0 +1,92 @@
+"""
+CPU benchmark for SimPLeModel training, comparing the per-timestep LSTMCell loop with the fused sequence forward.
+
+Times teacher-forced state model training and obs model training for a number of epochs, using the
+default simple_qmix model sizes. Run from the src directory:
+    python -m benchmarks.simple_model --epochs 200
+"""
+import argparse
+import time
+import torch as th
+import torch.nn.functional as F
+
+from modules.models.simple import SimPLeModel
+
+
+def cell_forward(model, x, ht_ct):
+    # The per-timestep path previously used by SimPLeLearner.run_state_model/run_obs_model
+    bs, steps, _ = x.size()
+    yp = th.zeros(bs, steps, model.fc2.out_features)
+    for t in range(steps):
+        yt, ht_ct = model(x[:, t, :], ht_ct)
+        yp[:, t, :] = yt
+    return yp, ht_ct
+
+
+def seq_forward(model, x, ht_ct):
+    return model.forward_seq(x, ht_ct)
+
+
+def train_epochs(model, forward, x, y, epochs):
+    optimiser = th.optim.Adam(model.parameters(), lr=1e-3)
+    model.train()
+    start = time.perf_counter()
+    for _ in range(epochs):
+        yp, _ = forward(model, x, model.init_hidden(x.size(0), "cpu"))
+        loss = F.mse_loss(yp, y)
+        optimiser.zero_grad()
+        loss.backward()
+        th.nn.utils.clip_grad_norm_(model.parameters(), 10)
+        optimiser.step()
+    return (time.perf_counter() - start) / epochs
+
+
+def bench_model(name, input_size, output_size, args):
+    x = th.rand(args.batch_size, args.episode_limit, input_size)
+    y = th.rand(args.batch_size, args.episode_limit, output_size)
+
+    th.manual_seed(0)
+    model = SimPLeModel(input_size, output_size, args.hidden_dim)
+    with th.no_grad():
+        ht_ct = model.init_hidden(args.batch_size, "cpu")
+        max_diff = (cell_forward(model, x, ht_ct)[0] - seq_forward(model, x, ht_ct)[0]).abs().max().item()
+
+    cell_time = train_epochs(model, cell_forward, x, y, args.epochs)
+    seq_time = train_epochs(model, seq_forward, x, y, args.epochs)
+    return {"model": name, "cell_epoch_time": cell_time, "seq_epoch_time": seq_time, "max_abs_diff": max_diff}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="SimPLeModel per-cell vs sequence training benchmark")
+    parser.add_argument("--epochs", type=int, default=200, help="Matches state_model_initial_train_epochs")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--hidden-dim", type=int, default=128)
+    parser.add_argument("--n-agents", type=int, default=8)
+    parser.add_argument("--n-actions", type=int, default=14)
+    parser.add_argument("--obs-shape", type=int, default=80)
+    parser.add_argument("--state-shape", type=int, default=168)
+    parser.add_argument("--episode-limit", type=int, default=120)
+    parser.add_argument("--threads", type=int, default=None)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.threads:
+        th.set_num_threads(args.threads)
+
+    action_size = args.n_agents * args.n_actions
+    models = [
+        ("state", args.state_shape + action_size, args.state_shape + 2),
+        ("obs", args.state_shape, args.n_agents * (args.obs_shape + args.n_actions)),
+    ]
+    print("{:>8} {:>16} {:>16} {:>10} {:>14}".format("model", "cell s/epoch", "seq s/epoch", "speedup", "max abs diff"))
+    for name, input_size, output_size in models:
+        r = bench_model(name, input_size, output_size, args)
+        print("{:>8} {:>16.4f} {:>16.4f} {:>10.2f} {:>14.2e}".format(
+            r["model"], r["cell_epoch_time"], r["seq_epoch_time"],
+            r["cell_epoch_time"] / r["seq_epoch_time"], r["max_abs_diff"]))
+
+
+if __name__ == "__main__":
+    main()
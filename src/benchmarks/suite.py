@@ -0,0 +1,294 @@
+"""
+End-to-end throughput benchmarks on the synthetic env, so that they run without StarCraft II.
+
+Covers runner env steps/sec (EpisodeRunner, ParallelRunner and ContinuousParallelRunner), ReplayBuffer
+inserts/sec and samples/sec, QLearner (qmix), COMALearner and QTRAN train steps/sec, and SimPLeLearner
+model training epochs/sec and rollout episodes/sec. Configs are read from src/config as for a real run.
+Results are printed and can be written as JSON, together with the commit they were measured at, so that
+regressions can be tracked between commits. Given a baseline JSON file, each rate is also shown relative to it. Run from the src directory:
+    python -m benchmarks.suite --n-agents 8 --episode-limit 60 --batch-size 32 --output bench.json
+    python -m benchmarks.suite --only learners --obs-shape 200 --baseline bench.json
+"""
+import argparse
+import contextlib
+import copy
+import io
+import json
+import logging
+import os
+import platform
+import subprocess
+import time
+from types import SimpleNamespace as SN
+import numpy as np
+import torch as th
+import yaml
+
+from benchmarks.replay_buffer import build_scheme, random_episode_batch, _rate
+from components.episode_buffer import EpisodeBatch, ReplayBuffer
+from controllers import REGISTRY as mac_REGISTRY
+from envs import REGISTRY as env_REGISTRY
+from learners import REGISTRY as le_REGISTRY
+from runners import REGISTRY as r_REGISTRY
+from utils.logging import Logger
+
+BENCHMARKS = ["runners", "buffer", "learners", "simple"]
+CONFIG_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "config")
+
+
+def load_args(alg, bench_args, **overrides):
+    # default.yaml, updated with the algorithm and synthetic env configs, then with the benchmark parameters
+    config = {}
+    for path in ["default.yaml", os.path.join("algs", alg + ".yaml"), os.path.join("envs", "synthetic.yaml")]:
+        with open(os.path.join(CONFIG_DIR, path)) as f:
+            for k, v in yaml.safe_load(f).items():
+                if isinstance(v, dict):
+                    config[k] = dict(config.get(k, {}), **v)
+                else:
+                    config[k] = v
+
+    config["env_args"].update(map_name=None, n_agents=bench_args.n_agents, n_enemies=bench_args.n_agents,
+                              episode_limit=bench_args.episode_limit, unit_type_bits=0, shield_bits_ally=0,
+                              shield_bits_enemy=0, obs_size=bench_args.obs_shape, state_size=bench_args.state_shape,
+                              episode_length_dist="uniform", episode_length_min=bench_args.episode_limit // 2,
+                              step_time=bench_args.step_time, seed=None)
+    config.update(batch_size=bench_args.batch_size, batch_size_run=bench_args.batch_size_run,
+                  envs_per_worker=bench_args.envs_per_worker, buffer_size=bench_args.buffer_size,
+                  use_cuda=bench_args.cuda, seed=bench_args.seed)
+    config.update(overrides)
+    args = SN(**config)
+    args.device = "cuda" if args.use_cuda else "cpu"
+
+    env_info = env_REGISTRY[args.env](**args.env_args).get_env_info()
+    args.n_agents = env_info["n_agents"]
+    args.n_actions = env_info["n_actions"]
+    args.state_shape = env_info["state_shape"]
+    args.episode_limit = env_info["episode_limit"]
+    return args, env_info
+
+
+def make_scheme(args, env_info):
+    # The scheme built by run.run_sequential
+    return build_scheme(args.n_agents, args.n_actions, env_info["obs_shape"], env_info["state_shape"],
+                        lazy_preprocess=args.lazy_preprocess)
+
+
+def random_episodes(args, scheme, groups, preprocess, batch_size):
+    # Random data, with episode lengths drawn like those of the synthetic env and terminated on their last step
+    batch = random_episode_batch(scheme, groups, preprocess, batch_size, args.episode_limit + 1, args.n_actions)
+    lengths = th.randint(args.episode_limit // 2, args.episode_limit + 1, (batch_size, 1, 1))
+    t = th.arange(args.episode_limit + 1).view(1, -1, 1)
+    batch.data.transition_data["filled"].copy_(t <= lengths)
+    batch.data.transition_data["terminated"].copy_(t == lengths - 1)
+    return batch
+
+
+def make_logger():
+    return Logger(logging.getLogger("benchmark"))
+
+
+def check_battles_game(runner, n_episodes):
+    # The synthetic env counts the episodes of all the envs it runs, i.e. per worker for the parallel runner
+    if hasattr(runner, "parent_conns"):
+        for parent_conn in runner.parent_conns:
+            parent_conn.send(("get_stats", None))
+        battles_game = [parent_conn.recv()[0]["battles_game"] for parent_conn in runner.parent_conns]
+    else:
+        battles_game = [runner.env.get_stats()["battles_game"]]
+    assert all(b == n_episodes for b in battles_game), \
+        "Envs played {} episodes, expected {}".format(battles_game, n_episodes)
+
+
+def bench_runners(bench_args):
+    results = {}
+    for name, runner_name, batch_size_run in [("episode", "episode", 1),
+                                              ("parallel", "parallel", bench_args.batch_size_run),
+                                              ("parallel_continuous", "parallel_continuous", bench_args.batch_size_run)]:
+        args, env_info = load_args("qmix", bench_args, runner=runner_name, batch_size_run=batch_size_run,
+                                   envs_per_worker=min(bench_args.envs_per_worker, batch_size_run),
+                                   runner_log_interval=10 ** 12)
+        scheme, groups, preprocess = make_scheme(args, env_info)
+        runner = r_REGISTRY[runner_name](args=args, logger=make_logger())
+        mac = mac_REGISTRY[args.mac](EpisodeBatch(scheme, groups, 1, 2, preprocess=preprocess).scheme, groups, args)
+        runner.setup(scheme=scheme, groups=groups, preprocess=preprocess, mac=mac)
+        runner.run(test_mode=False)  # warm up
+
+        n_runs = max(1, bench_args.runner_episodes // batch_size_run)
+        t_env = runner.t_env
+        start = time.perf_counter()
+        for _ in range(n_runs):
+            runner.run(test_mode=False)
+        elapsed = time.perf_counter() - start
+        if runner_name != "parallel_continuous":
+            # Each env plays one episode per run, stepping an env past its end would count another
+            check_battles_game(runner, args.envs_per_worker * (n_runs + 1))
+        runner.close_env()
+        results[name] = {
+            "env_steps_per_sec": (runner.t_env - t_env) / elapsed,
+            "episodes_per_sec": n_runs * batch_size_run / elapsed,
+            "batch_size_run": batch_size_run,
+            "envs_per_worker": args.envs_per_worker,
+        }
+    return results
+
+
+def bench_buffer(bench_args):
+    args, env_info = load_args("qmix", bench_args)
+    scheme, groups, preprocess = make_scheme(args, env_info)
+    buffer = ReplayBuffer(scheme, groups, args.buffer_size, args.episode_limit + 1, preprocess=preprocess)
+    ep_batch = random_episodes(args, scheme, groups, preprocess, args.batch_size_run)
+    while buffer.episodes_in_buffer < args.buffer_size:
+        buffer.insert_episode_batch(ep_batch)
+    return {
+        "inserts_per_sec": _rate(lambda: buffer.insert_episode_batch(ep_batch), bench_args.n_iters) * args.batch_size_run,
+        "samples_per_sec": _rate(lambda: buffer.sample(args.batch_size), bench_args.n_iters),
+    }
+
+
+def bench_learners(bench_args):
+    results = {}
+    runs = [("qmix", "q_learner", {}), ("qtran", "qtran_learner", {})]
+    runs += [("coma", "coma_learner" + ("" if mode == "seq" else "_" + mode), {"critic_train_mode": mode})
+             for mode in ["seq", "chunk", "batch"]]
+    for alg, name, overrides in runs:
+        args, env_info = load_args(alg, bench_args, learner_log_interval=10 ** 12, **overrides)
+        scheme, groups, preprocess = make_scheme(args, env_info)
+        batch = random_episodes(args, scheme, groups, preprocess, args.batch_size)
+        batch.to(args.device)
+        mac = mac_REGISTRY[args.mac](batch.scheme, groups, args)
+        learner = le_REGISTRY[args.learner](mac, batch.scheme, make_logger(), args)
+        if args.use_cuda:
+            learner.cuda()
+
+        def train():
+            learner.train(batch, 0, 0)
+            if args.use_cuda:
+                th.cuda.synchronize()
+        results[name] = {"train_steps_per_sec": _rate(train, bench_args.n_train_steps)}
+    return results
+
+
+def bench_simple(bench_args):
+    epochs = bench_args.model_epochs
+    args, env_info = load_args("simple_qmix", bench_args, learner_log_interval=10 ** 12,
+                               state_model_initial_train_epochs=epochs, state_model_train_epochs=epochs,
+                               state_model_train_log_epochs=epochs, obs_model_initial_train_epochs=epochs,
+                               obs_model_train_epochs=epochs, obs_model_train_log_epochs=epochs)
+    scheme, groups, preprocess = make_scheme(args, env_info)
+    buffer = ReplayBuffer(scheme, groups, args.buffer_size, args.episode_limit + 1, preprocess=preprocess)
+    buffer.insert_episode_batch(random_episodes(args, scheme, groups, preprocess, args.buffer_size))
+    mac = mac_REGISTRY[args.mac](buffer.scheme, groups, args)
+    learner = le_REGISTRY[args.model_learner](mac, buffer.scheme, make_logger(), args)
+    if args.use_cuda:
+        learner.cuda()
+
+    # The learner reports progress with print
+    with contextlib.redirect_stdout(io.StringIO()):
+        ep_ids = buffer.stored_episode_ids()
+        train_indices, test_indices = learner.train_test_split(list(range(len(ep_ids))), args.model_training_test_ratio)
+        episodes = learner.get_episode_vars(buffer.gather_episodes(ep_ids))
+        train_episodes = [x[train_indices] for x in episodes]
+        test_episodes = [x[test_indices] for x in episodes]
+
+        start = time.perf_counter()
+        learner.train_state_model(train_episodes, test_episodes)
+        state_elapsed = time.perf_counter() - start
+        start = time.perf_counter()
+        learner.train_obs_model(train_episodes, test_episodes)
+        obs_elapsed = time.perf_counter() - start
+
+        learner.generate_batch(buffer, args.model_rollout_batch_size, 0)  # warm up
+        start = time.perf_counter()
+        for _ in range(bench_args.n_rollouts):
+            learner.generate_batch(buffer, args.model_rollout_batch_size, 0)
+        rollout_elapsed = time.perf_counter() - start
+
+    return {
+        "state_model_epochs_per_sec": epochs / state_elapsed,
+        "obs_model_epochs_per_sec": epochs / obs_elapsed,
+        "rollout_episodes_per_sec": bench_args.n_rollouts * args.model_rollout_batch_size / rollout_elapsed,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(bench_args):
+    # Seeds the generated data and sampling, while episode lengths vary between envs and runs
+    np.random.seed(bench_args.seed)
+    th.manual_seed(bench_args.seed)
+    fns = {"runners": bench_runners, "buffer": bench_buffer, "learners": bench_learners, "simple": bench_simple}
+    results = {}
+    for name in bench_args.only:
+        results[name] = fns[name](bench_args)
+    params = copy.copy(vars(bench_args))
+    params.pop("output")
+    params.pop("baseline")
+    return {
+        "commit": git_commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "host": platform.node(),
+        "torch": th.__version__,
+        "threads": th.get_num_threads(),
+        "params": params,
+        "results": results,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="End-to-end throughput benchmarks")
+    parser.add_argument("--only", nargs="+", choices=BENCHMARKS, default=BENCHMARKS)
+    parser.add_argument("--n-agents", type=int, default=8, help="Also the number of enemies")
+    parser.add_argument("--obs-shape", type=int, default=None, help="SMAC obs size for n-agents if not given")
+    parser.add_argument("--state-shape", type=int, default=None, help="SMAC state size for n-agents if not given")
+    parser.add_argument("--episode-limit", type=int, default=60, help="Episode lengths are uniform from half of this")
+    parser.add_argument("--batch-size", type=int, default=32, help="Episodes per learner batch")
+    parser.add_argument("--batch-size-run", type=int, default=8, help="Envs of the parallel runners")
+    parser.add_argument("--envs-per-worker", type=int, default=1)
+    parser.add_argument("--buffer-size", type=int, default=1000)
+    parser.add_argument("--step-time", type=float, default=0.0, help="Simulated seconds per env step")
+    parser.add_argument("--runner-episodes", type=int, default=64)
+    parser.add_argument("--n-iters", type=int, default=50, help="Buffer inserts and samples")
+    parser.add_argument("--n-train-steps", type=int, default=10)
+    parser.add_argument("--model-epochs", type=int, default=5)
+    parser.add_argument("--n-rollouts", type=int, default=5)
+    parser.add_argument("--cuda", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default=None, help="JSON file to write the results to")
+    parser.add_argument("--baseline", type=str, default=None, help="JSON file of earlier results to compare with")
+    return parser.parse_args(argv)
+
+
+def rates(results):
+    # Flattens results to {(benchmark, stat): rate}
+    flat = {}
+    for name, stats in results.items():
+        for k, v in stats.items():
+            for stat, value in (v.items() if isinstance(v, dict) else [(k, v)]):
+                if stat.endswith("_per_sec"):
+                    flat[("{}/{}".format(name, k) if isinstance(v, dict) else name, stat)] = value
+    return flat
+
+
+def main(argv=None):
+    bench_args = parse_args(argv)
+    report = run_suite(bench_args)
+    baseline = {}
+    if bench_args.baseline is not None:
+        with open(bench_args.baseline) as f:
+            baseline = rates(json.load(f)["results"])
+    for (label, stat), value in rates(report["results"]).items():
+        vs_baseline = "{:>9.2f}x".format(value / baseline[(label, stat)]) if (label, stat) in baseline else ""
+        print("{:<32} {:<28} {:>12.1f} {}".format(label, stat, value, vs_baseline))
+    if bench_args.output is not None:
+        with open(bench_args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,18 @@
 import torch as th
 import numpy as np
-from types import SimpleNamespace as SN
-import pickle
 import os
-from glob import glob
+import shutil
+import tempfile
+from types import SimpleNamespace as SN
+from .episode_store import EpisodeStore
+from .transforms import OneHot
+from .sum_tree import SumTree
 
 
 class EpisodeBatch:
+    # Whether outputs of lazy transforms get storage of their own, otherwise they are computed when first read
+    store_lazy = True
+
     def __init__(self,
                  scheme,
                  groups,
@@ -42,22 +48,30 @@ class EpisodeBatch:
                 for transform in transforms:
                     vshape, dtype = transform.infer_output_info(vshape, dtype)
 
+                # A storage dtype may be declared for the output of preprocessing ahead of time
+                storage_dtype = self.scheme.get(new_k, {}).get("storage_dtype", None)
                 self.scheme[new_k] = {
                     "vshape": vshape,
                     "dtype": dtype
                 }
+                if storage_dtype is not None:
+                    self.scheme[new_k]["storage_dtype"] = storage_dtype
                 if "group" in self.scheme[k]:
                     self.scheme[new_k]["group"] = self.scheme[k]["group"]
                 if "episode_const" in self.scheme[k]:
                     self.scheme[new_k]["episode_const"] = self.scheme[k]["episode_const"]
 
-        assert "filled" not in scheme, '"filled" is a reserved key for masking.'
+        # Only a storage dtype may be declared for filled
+        assert set(scheme.get("filled", {})) <= {"storage_dtype"}, '"filled" is a reserved key for masking.'
         scheme.update({
-            "filled": {"vshape": (1,), "dtype": th.long},
+            "filled": {"vshape": (1,), "dtype": th.long, **scheme.get("filled", {})},
         })
 
+        lazy_keys = self._lazy_keys()
         for field_key, field_info in scheme.items():
             assert "vshape" in field_info, "Scheme must define vshape for {}".format(field_key)
+            if field_key in lazy_keys and not self.store_lazy:
+                continue
             vshape = field_info["vshape"]
             episode_const = field_info.get("episode_const", False)
             group = field_info.get("group", None)
@@ -73,18 +87,26 @@ class EpisodeBatch:
                 shape = vshape
 
             if episode_const:
-                self.data.episode_data[field_key] = th.zeros((batch_size, *shape), dtype=dtype, device=self.device)
+                self.data.episode_data[field_key] = self._alloc(field_key, (batch_size, *shape), dtype)
             else:
-                self.data.transition_data[field_key] = th.zeros((batch_size, max_seq_length, *shape), dtype=dtype, device=self.device)
+                self.data.transition_data[field_key] = self._alloc_transitions(field_key, batch_size, max_seq_length, shape, dtype)
+
+    def _alloc(self, key, shape, dtype):
+        # Storage for one field, subclasses may override this to change where the data lives
+        return th.zeros(shape, dtype=dtype, device=self.device)
+
+    def _alloc_transitions(self, key, batch_size, max_seq_length, shape, dtype):
+        # Storage for a per-timestep field, subclasses may override this to change its layout
+        return self._alloc(key, (batch_size, max_seq_length, *shape), dtype)
 
     def extend(self, scheme, groups=None):
         self._setup_data(scheme, self.groups if groups is None else groups, self.batch_size, self.max_seq_length)
 
-    def to(self, device):
+    def to(self, device, non_blocking=False):
         for k, v in self.data.transition_data.items():
-            self.data.transition_data[k] = v.to(device)
+            self.data.transition_data[k] = v.to(device, non_blocking=non_blocking)
         for k, v in self.data.episode_data.items():
-            self.data.episode_data[k] = v.to(device)
+            self.data.episode_data[k] = v.to(device, non_blocking=non_blocking)
         self.device = device
 
     def update(self, data, bs=slice(None), ts=slice(None), mark_filled=True):
@@ -107,7 +129,8 @@ class EpisodeBatch:
             self._check_safe_view(v, target[k][_slices])
             target[k][_slices] = v.view_as(target[k][_slices])
 
-            if k in self.preprocess:
+            # Lazy outputs that have not been computed yet are left until they are read
+            if k in self.preprocess and self.preprocess[k][0] in target:
                 new_k = self.preprocess[k][0]
                 v = target[k][_slices]
                 for transform in self.preprocess[k][1]:
@@ -123,17 +146,36 @@ class EpisodeBatch:
             else:
                 idx -= 1
 
+    def _lazy_keys(self):
+        # Maps the outputs of lazy preprocessing to the keys they are computed from
+        return {new_k: k for k, (new_k, transforms) in self.preprocess.items()
+                if transforms and all(t.lazy for t in transforms)}
+
+    def _compute_lazy(self, key):
+        # Computes a lazy field from its source and keeps it for the lifetime of the batch
+        k = self._lazy_keys()[key]
+        target = self.data.episode_data if k in self.data.episode_data else self.data.transition_data
+        v = target[k]
+        for transform in self.preprocess[k][1]:
+            v = transform.transform(v)
+        target[key] = v.to(self.scheme[key].get("dtype", th.float32))
+        return target[key]
+
     def __getitem__(self, item):
         if isinstance(item, str):
             if item in self.data.episode_data:
                 return self.data.episode_data[item]
             elif item in self.data.transition_data:
                 return self.data.transition_data[item]
+            elif item in self._lazy_keys():
+                return self._compute_lazy(item)
             else:
                 raise ValueError
         elif isinstance(item, tuple) and all([isinstance(it, str) for it in item]):
             new_data = self._new_data_sn()
             for key in item:
+                if key in self._lazy_keys() and key not in self.data.transition_data and key not in self.data.episode_data:
+                    self._compute_lazy(key)
                 if key in self.data.transition_data:
                     new_data.transition_data[key] = self.data.transition_data[key]
                 elif key in self.data.episode_data:
@@ -150,15 +192,18 @@ class EpisodeBatch:
         else:
             item = self._parse_slices(item)
             new_data = self._new_data_sn()
+            # Fields kept in a compact storage dtype (see compact_storage_scheme) are converted back, the others
+            # stay views
             for k, v in self.data.transition_data.items():
-                new_data.transition_data[k] = v[item]
+                new_data.transition_data[k] = v[item].to(self.scheme[k].get("dtype", th.float32))
             for k, v in self.data.episode_data.items():
-                new_data.episode_data[k] = v[item[0]]
+                new_data.episode_data[k] = v[item[0]].to(self.scheme[k].get("dtype", th.float32))
 
             ret_bs = self._get_num_items(item[0], self.batch_size)
             ret_max_t = self._get_num_items(item[1], self.max_seq_length)
 
-            ret = EpisodeBatch(self.scheme, self.groups, ret_bs, ret_max_t, data=new_data, device=self.device)
+            ret = EpisodeBatch(self.scheme, self.groups, ret_bs, ret_max_t, data=new_data,
+                               preprocess=self.preprocess, device=self.device)
             return ret
 
     def _get_num_items(self, indexing_item, max_size):
@@ -208,50 +253,74 @@ class EpisodeBatch:
 
 
 class ReplayBuffer(EpisodeBatch):
+    store_lazy = False
+
     def __init__(self, scheme, groups, buffer_size, max_seq_length, preprocess=None, device="cpu",
-                 save_episodes=False, episode_dir=None, clear_existing_episodes=True):
+                 save_episodes=False, episode_dir=None, clear_existing_episodes=True, storage="memory", storage_dir=None):
+        # storage is "memory" for in-process tensors, or "mmap" for tensors backed by memory-mapped files
+        # in a fresh directory under storage_dir (the system temp dir if None), removed again by close()
+        assert storage in ["memory", "mmap"], "Unknown buffer storage {}".format(storage)
+        self.storage = storage
+        self.storage_path = None
+        if storage == "mmap":
+            assert str(device) == "cpu", "Memory-mapped buffer storage must be on the cpu"
+            if storage_dir is not None:
+                os.makedirs(storage_dir, exist_ok=True)
+            self.storage_path = tempfile.mkdtemp(prefix="buffer_", dir=storage_dir)
+        # Gather sampled batches into pinned memory so they can be copied to the gpu asynchronously
+        self.pin_memory = storage == "mmap" and th.cuda.is_available()
+
         super(ReplayBuffer, self).__init__(scheme, groups, buffer_size, max_seq_length, preprocess=preprocess, device=device)
         self.buffer_size = buffer_size  # same as self.batch_size but more explicit
         self.buffer_index = 0
         self.episodes_in_buffer = 0
-        self.save_index = 0
+        self.episode_lengths = np.zeros(buffer_size, dtype=np.int64)  # filled timesteps of every stored episode
         self.save_episodes = save_episodes
         self.save_dir = episode_dir
 
+        self.episode_store = None
         if self.save_episodes:
             if self.save_dir:
-                if os.path.exists(self.save_dir):
-                    if clear_existing_episodes:
-                        files = glob(os.path.join(self.save_dir, "episode_*.pkl"))
-                        for f in files:
-                            os.remove(f)
-                else:
-                    os.mkdir(self.save_dir)
+                self.episode_store = EpisodeStore(self.save_dir, prefix="episode", clear_existing=clear_existing_episodes)
             else:
                 raise Exception("Please specify 'episode_dir' or set 'save_episodes' to False")
 
     def insert_episode_batch(self, ep_batch):
-        if self.buffer_index + ep_batch.batch_size <= self.buffer_size:
-            self.update(ep_batch.data.transition_data,
-                        slice(self.buffer_index, self.buffer_index + ep_batch.batch_size),
-                        slice(0, ep_batch.max_seq_length),
-                        mark_filled=False)
-            self.update(ep_batch.data.episode_data,
-                        slice(self.buffer_index, self.buffer_index + ep_batch.batch_size))
-
-            if self.save_episodes:
-                for i in range(self.buffer_index, self.buffer_index + ep_batch.batch_size):
-                    self.save_episode(self[[i]])
-                    #self.save_episode(self.sample(1))
-
-            self.buffer_index = (self.buffer_index + ep_batch.batch_size)
-            self.episodes_in_buffer = max(self.episodes_in_buffer, self.buffer_index)
-            self.buffer_index = self.buffer_index % self.buffer_size
-            assert self.buffer_index < self.buffer_size
-        else:
-            buffer_left = self.buffer_size - self.buffer_index
-            self.insert_episode_batch(ep_batch[0:buffer_left, :])
-            self.insert_episode_batch(ep_batch[buffer_left:, :])
+        # Write the whole batch into the ring with one indexed copy per key (no recursive wrap-around split)
+        n = ep_batch.batch_size
+        ep_ids = (th.arange(n, device=self.device) + self.buffer_index) % self.buffer_size
+        src = slice(max(0, n - self.buffer_size), n)  # only the most recent episodes survive a batch larger than the buffer
+        ep_ids = ep_ids[src]
+        max_t = ep_batch.max_seq_length
+
+        # Only the buffer's own keys are copied, which leaves out the outputs of lazy transforms
+        for k, target in self.data.transition_data.items():
+            v = ep_batch[k][src].to(device=self.device, dtype=target.dtype)
+            if max_t == self.max_seq_length:
+                target.index_copy_(0, ep_ids, v)
+            else:
+                target[ep_ids, :max_t] = v
+                target[ep_ids, max_t:] = 0
+        for k, target in self.data.episode_data.items():
+            target.index_copy_(0, ep_ids, ep_batch[k][src].to(device=self.device, dtype=target.dtype))
+        self.episode_lengths[ep_ids.cpu().numpy()] = _episode_lengths(ep_batch)[src]
+
+        if self.save_episodes:
+            # Saved from the batch rather than the buffer, so that episodes are stored without padding
+            self.episode_store.append_batch(ep_batch if src.start == 0 else ep_batch[src])
+
+        self.episodes_in_buffer = min(self.buffer_size, max(self.episodes_in_buffer, self.buffer_index + n))
+        self.buffer_index = (self.buffer_index + n) % self.buffer_size
+
+    def _alloc(self, key, shape, dtype):
+        # Buffers keep fields in their storage dtype if the scheme declares one, see compact_storage_scheme
+        dtype = self.scheme[key].get("storage_dtype", dtype)
+        if self.storage == "memory":
+            return super(ReplayBuffer, self)._alloc(key, shape, dtype)
+        # A new memmap file reads as zeros, and disk is only used for the parts that get written
+        np_dtype = th.empty((), dtype=dtype).numpy().dtype
+        array = np.memmap(os.path.join(self.storage_path, "{}.dat".format(key)), dtype=np_dtype, mode="w+", shape=shape)
+        return th.from_numpy(array)
 
     def can_sample(self, batch_size):
         return self.episodes_in_buffer >= batch_size
@@ -259,19 +328,57 @@ class ReplayBuffer(EpisodeBatch):
     def sample(self, batch_size):
         assert self.can_sample(batch_size)
         if self.episodes_in_buffer == batch_size:
-            return self[:batch_size]
+            ep_ids = th.arange(batch_size)
         else:
             # Uniform sampling only atm
-            ep_ids = np.random.choice(self.episodes_in_buffer, batch_size, replace=False)
-            return self[ep_ids]
-
-    def save_episode(self, episode):
-        if os.path.exists(self.save_dir):
+            ep_ids = th.from_numpy(np.random.choice(self.episodes_in_buffer, batch_size, replace=False))
+        return self._gather(ep_ids)
+
+    def stored_episode_ids(self):
+        # The slots that hold an episode
+        return th.arange(self.episodes_in_buffer)
+
+    def gather_episodes(self, ep_ids, max_t=None):
+        # The episodes in slots ep_ids as a new batch, trimmed to the longest of them or to their first max_t timesteps
+        return self._gather(ep_ids, max_t=max_t)
+
+    def _gather(self, ep_ids, max_t=None):
+        # Gather episodes straight from storage into a new batch, without building intermediate views.
+        # The batch is trimmed to the longest of its episodes, using the stored lengths
+        max_t_filled = max(1, int(self.episode_lengths[ep_ids.cpu().numpy()].max()))
+        max_t = max_t_filled if max_t is None else min(max_t, max_t_filled)
+        ep_ids = ep_ids.to(self.device)
+        new_data = self._new_data_sn()
+        for k, v in self.data.transition_data.items():
+            new_data.transition_data[k] = self._index_select(k, v[:, :max_t], ep_ids)
+        for k, v in self.data.episode_data.items():
+            new_data.episode_data[k] = self._index_select(k, v, ep_ids)
+        return EpisodeBatch(self.scheme, self.groups, len(ep_ids), max_t, data=new_data,
+                            preprocess=self.preprocess, device=self.device)
 
-            fname = os.path.join(self.save_dir, f"episode_{self.save_index + 1:06}.pkl")
-            with open(fname, 'wb') as f:
-                pickle.dump(episode.data.transition_data, f)
-            self.save_index += 1
+    def max_t_filled(self):
+        return int(self.episode_lengths.max())
+
+    def _index_select(self, key, v, ep_ids):
+        # Gathers rows of a field, converted from its storage dtype back to its dtype
+        dtype = self.scheme[key].get("dtype", th.float32)
+        if not self.pin_memory:
+            return v.index_select(0, ep_ids).to(dtype)
+        # Pinned allocations are cached by torch, so this reuses staging memory once it is free again
+        out = th.empty((len(ep_ids), *v.shape[1:]), dtype=dtype, pin_memory=True)
+        if v.dtype == dtype:
+            return th.index_select(v, 0, ep_ids, out=out)
+        return out.copy_(v.index_select(0, ep_ids))
+
+    def close(self):
+        # Finishes writing any saved episodes and removes memory-mapped storage
+        if self.episode_store is not None:
+            self.episode_store.close()
+            self.episode_store = None
+        if self.storage_path is not None:
+            self.data = self._new_data_sn()
+            shutil.rmtree(self.storage_path, ignore_errors=True)
+            self.storage_path = None
 
     def __repr__(self):
         return "ReplayBuffer. {}/{} episodes. Keys:{} Groups:{}".format(self.episodes_in_buffer,
@@ -279,3 +386,181 @@ class ReplayBuffer(EpisodeBatch):
                                                                         self.scheme.keys(),
                                                                         self.groups.keys())
 
+
+class PackedReplayBuffer(ReplayBuffer):
+    """
+    Replay buffer that stores episodes without padding. The timesteps of all episodes are concatenated in a ring of
+    transition_capacity transitions, with an offset and length per episode slot. An episode is evicted when its slot
+    is reused or when new transitions overwrite any of its own, which can leave any slot empty. Samples are padded
+    only up to their longest episode.
+    Indexing with episode indices gathers padded batches, indexing timesteps directly is not supported.
+    """
+    def __init__(self, scheme, groups, buffer_size, max_seq_length, transition_capacity=None, preprocess=None,
+                 device="cpu", **kwargs):
+        self.transition_capacity = buffer_size * max_seq_length if transition_capacity is None else transition_capacity
+        assert self.transition_capacity >= 2 * max_seq_length, "transition_capacity must hold at least two full episodes"
+        super(PackedReplayBuffer, self).__init__(scheme, groups, buffer_size, max_seq_length,
+                                                 preprocess=preprocess, device=device, **kwargs)
+        self.episode_offsets = np.zeros(buffer_size, dtype=np.int64)
+        self.transition_index = 0
+
+    def _alloc_transitions(self, key, batch_size, max_seq_length, shape, dtype):
+        return self._alloc(key, (self.transition_capacity, *shape), dtype)
+
+    def insert_episode_batch(self, ep_batch):
+        n = ep_batch.batch_size
+        src = slice(max(0, n - self.buffer_size), n)
+        lengths = _episode_lengths(ep_batch)[src]
+        assert lengths.sum() + self.max_seq_length <= self.transition_capacity, "Episode batch too large for the buffer"
+        slots = (np.arange(len(lengths)) + self.buffer_index) % self.buffer_size
+
+        # Place the episodes one after the other, wrapping round to the start when the end of the ring is reached
+        dest = []
+        for slot, length in zip(slots, lengths):
+            self.episode_lengths[slot] = 0
+            if self.transition_index + length > self.transition_capacity:
+                self.transition_index = 0
+            start, end = self.transition_index, self.transition_index + length
+            overwritten = (self.episode_offsets < end) & (self.episode_offsets + self.episode_lengths > start)
+            self.episode_lengths[overwritten] = 0
+            self.episode_offsets[slot] = start
+            self.episode_lengths[slot] = length
+            dest.append(np.arange(start, end))
+            self.transition_index = end
+        dest = th.from_numpy(np.concatenate(dest)).to(self.device)
+
+        # The filled timesteps of every episode, in the same order as dest
+        filled = ep_batch.data.transition_data["filled"][src, :, 0].bool()
+        for k, target in self.data.transition_data.items():
+            v = ep_batch[k]
+            target.index_copy_(0, dest, v[src][filled.to(v.device)].to(device=self.device, dtype=target.dtype))
+        ep_ids = th.from_numpy(slots).to(self.device)
+        for k, target in self.data.episode_data.items():
+            target.index_copy_(0, ep_ids, ep_batch[k][src].to(device=self.device, dtype=target.dtype))
+
+        if self.save_episodes:
+            self.episode_store.append_batch(ep_batch if src.start == 0 else ep_batch[src])
+
+        self.episodes_in_buffer = int((self.episode_lengths > 0).sum())
+        self.buffer_index = (self.buffer_index + n) % self.buffer_size
+
+    def sample(self, batch_size):
+        return self._gather(self._sample_ids(batch_size))
+
+    def stored_episode_ids(self):
+        return th.from_numpy(np.flatnonzero(self.episode_lengths > 0))
+
+    def _sample_ids(self, batch_size):
+        assert self.can_sample(batch_size)
+        return th.from_numpy(np.random.choice(self.stored_episode_ids().numpy(), batch_size, replace=False))
+
+    def _gather(self, ep_ids, max_t=None):
+        # Pads every episode to the longest one in the batch, padding reads transition 0 and is zeroed afterwards
+        ids = ep_ids.cpu().numpy()
+        lengths = self.episode_lengths[ids]
+        max_t_filled = max(1, int(lengths.max()))
+        max_t = max_t_filled if max_t is None else min(max_t, max_t_filled)
+        timesteps = np.arange(max_t)
+        mask = timesteps[None] < lengths[:, None]
+        idx = np.where(mask, self.episode_offsets[ids][:, None] + timesteps[None], 0)
+        idx = th.from_numpy(idx.reshape(-1)).to(self.device)
+        mask = th.from_numpy(mask).to(self.device)
+
+        new_data = self._new_data_sn()
+        for k, v in self.data.transition_data.items():
+            out = self._index_select(k, v, idx).view(len(ids), max_t, *v.shape[1:])
+            new_data.transition_data[k] = out.masked_fill_(~mask.view(*mask.shape, *[1] * (v.dim() - 1)), 0)
+        ep_ids = ep_ids.to(self.device)
+        for k, v in self.data.episode_data.items():
+            new_data.episode_data[k] = self._index_select(k, v, ep_ids)
+        return EpisodeBatch(self.scheme, self.groups, len(ids), max_t, data=new_data,
+                            preprocess=self.preprocess, device=self.device)
+
+    def __getitem__(self, item):
+        if isinstance(item, str):
+            return super(PackedReplayBuffer, self).__getitem__(item)
+        if isinstance(item, tuple):
+            raise ValueError("PackedReplayBuffer only supports indexing episodes")
+        return self._gather(th.arange(self.buffer_size)[item].view(-1))
+
+    def __repr__(self):
+        return "PackedReplayBuffer. {}/{} episodes, {} transitions. Keys:{} Groups:{}".format(
+            self.episodes_in_buffer, self.buffer_size, self.transition_capacity, self.scheme.keys(), self.groups.keys())
+
+
+def compact_storage_scheme(scheme, preprocess=None, uint8=True, float16_keys=()):
+    """
+    Returns a copy of scheme that declares compact storage dtypes, which only replay buffers use.
+    With uint8, integer fields (masks, flags and action indices, which must all be below 256), one-hot preprocessing
+    outputs and filled are stored as uint8. float16_keys are stored as float16.
+    Sampled batches are converted back to the usual dtypes.
+    """
+    scheme = {k: dict(v) for k, v in scheme.items()}
+    for k in float16_keys:
+        scheme[k]["storage_dtype"] = th.float16
+    if uint8:
+        for k, v in scheme.items():
+            if v.get("dtype", th.float32) in [th.uint8, th.int8, th.int16, th.int32, th.int64]:
+                v["storage_dtype"] = th.uint8
+        for new_k, transforms in (preprocess or {}).values():
+            if all(isinstance(t, OneHot) for t in transforms):
+                scheme[new_k] = {"storage_dtype": th.uint8}
+        scheme["filled"] = {"storage_dtype": th.uint8}
+    return scheme
+
+
+def _episode_lengths(ep_batch):
+    # Filled timesteps of each episode in the batch
+    return ep_batch.data.transition_data["filled"].reshape(ep_batch.batch_size, -1).sum(1).cpu().numpy()
+
+
+class PrioritizedReplayBuffer(ReplayBuffer):
+    """
+    Episode-level prioritised replay (Schaul et al. 2015) backed by a sum-tree.
+    New episodes enter with the current maximum priority; learners feed back one priority per sampled episode.
+    """
+    def __init__(self, scheme, groups, buffer_size, max_seq_length, alpha, beta_start, beta_anneal_time,
+                 eps=1e-6, preprocess=None, device="cpu", **kwargs):
+        super(PrioritizedReplayBuffer, self).__init__(scheme, groups, buffer_size, max_seq_length,
+                                                      preprocess=preprocess, device=device, **kwargs)
+        self.alpha = alpha
+        self.beta_start = beta_start
+        self.beta_anneal_time = beta_anneal_time
+        self.eps = eps
+        self.max_priority = 1.0
+        self.sum_tree = SumTree(buffer_size)
+
+    def insert_episode_batch(self, ep_batch):
+        n = ep_batch.batch_size
+        ep_ids = (np.arange(max(0, n - self.buffer_size), n) + self.buffer_index) % self.buffer_size
+        super(PrioritizedReplayBuffer, self).insert_episode_batch(ep_batch)
+        self.sum_tree.update(ep_ids, self.max_priority ** self.alpha)
+
+    def sample(self, batch_size):
+        assert self.can_sample(batch_size)
+        ep_ids = self.sum_tree.sample(batch_size)
+        return self._gather(th.from_numpy(ep_ids))
+
+    def sample_with_weights(self, batch_size, t_env):
+        """ Returns the sampled batch, the buffer indices of its episodes and their importance weights """
+        assert self.can_sample(batch_size)
+        ep_ids = self.sum_tree.sample(batch_size)
+
+        # Importance sampling weights, normalised by the largest weight in the batch
+        beta = min(1.0, self.beta_start + (1.0 - self.beta_start) * t_env / self.beta_anneal_time)
+        probs = self.sum_tree.get(ep_ids) / self.sum_tree.total()
+        weights = (self.episodes_in_buffer * probs) ** (-beta)
+        weights = th.as_tensor(weights / weights.max(), dtype=th.float32)
+
+        return self._gather(th.from_numpy(ep_ids)), ep_ids, weights
+
+    def update_priorities(self, ep_ids, priorities):
+        priorities = th.as_tensor(priorities).detach().cpu().double().numpy() + self.eps
+        self.max_priority = max(self.max_priority, priorities.max())
+        self.sum_tree.update(ep_ids, priorities ** self.alpha)
+
+    def __repr__(self):
+        return "PrioritizedReplayBuffer. {}/{} episodes. Keys:{} Groups:{}".format(self.episodes_in_buffer,
+                                                                                   self.buffer_size,
+                                                                                   self.scheme.keys(),
+                                                                                   self.groups.keys())
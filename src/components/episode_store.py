@@ -0,0 +1,170 @@
+import json
+import os
+import queue
+import threading
+from glob import glob
+import numpy as np
+import torch as th
+
+
+class EpisodeStore:
+    """
+    Append-only columnar store for episodes on disk.
+
+    Episodes are grouped into chunks. Every chunk holds one .npy array per key, with the timesteps of its episodes
+    concatenated along the first axis (no padding), so that variable length episodes take only the space they use.
+    An index file lists the chunks with the lengths of their episodes, and is rewritten atomically whenever a
+    chunk is completed. Writing happens in a background thread so that appending does not stall training.
+    Use EpisodeStoreReader to read the episodes back.
+    """
+
+    def __init__(self, path, prefix="episode", chunk_size=1000, clear_existing=True):
+        self.path = path
+        self.prefix = prefix
+        self.chunk_size = chunk_size
+
+        os.makedirs(path, exist_ok=True)
+        index_path = _index_path(path, prefix)
+        if clear_existing:
+            for f in glob(os.path.join(path, "{}_*.npy".format(prefix))) + [index_path]:
+                if os.path.exists(f):
+                    os.remove(f)
+            self.index = {"keys": {}, "chunks": []}
+        else:
+            self.index = _load_index(path, prefix)
+
+        self.pending = []  # episodes of the chunk currently being filled, only touched by the writer thread
+        self.error = None
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._writer, daemon=True)
+        self.thread.start()
+
+    def append(self, episode):
+        """ Queues one episode for writing, given as a dict of arrays/tensors whose first axis is time """
+        if self.error is not None:
+            raise self.error
+        self.queue.put({k: _to_numpy(v) for k, v in episode.items()})
+
+    def append_batch(self, ep_batch):
+        """ Queues every episode of an EpisodeBatch, trimmed to its filled timesteps """
+        if self.error is not None:
+            raise self.error
+        data = ep_batch.data
+        lengths = data.transition_data["filled"].reshape(ep_batch.batch_size, -1).sum(1).tolist()
+        transition_data = {k: _to_numpy(v) for k, v in data.transition_data.items() if k != "filled"}
+        episode_data = {k: _to_numpy(v) for k, v in data.episode_data.items()}
+        for i, length in enumerate(lengths):
+            episode = {k: v[i, :int(length)] for k, v in transition_data.items()}
+            episode.update({k: v[i:i + 1] for k, v in episode_data.items()})
+            self.queue.put(episode)
+
+    def flush(self):
+        """ Writes out everything appended so far, closing the current chunk even if it is not full """
+        self.queue.put("flush")
+        self.queue.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+
+    def _writer(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                if self.error is None:
+                    if item == "flush":
+                        self._write_chunk()
+                    else:
+                        self.pending.append(item)
+                        if len(self.pending) >= self.chunk_size:
+                            self._write_chunk()
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _write_chunk(self):
+        if not self.pending:
+            return
+        chunk_id = len(self.index["chunks"])
+        for k in self.pending[0]:
+            values = np.concatenate([ep[k] for ep in self.pending], axis=0)
+            np.save(_chunk_path(self.path, self.prefix, chunk_id, k), values)
+            self.index["keys"][k] = {"dtype": values.dtype.str, "shape": list(values.shape[1:])}
+        self.index["chunks"].append({"lengths": {k: [len(ep[k]) for ep in self.pending] for k in self.pending[0]}})
+        self.pending = []
+
+        index_path = _index_path(self.path, self.prefix)
+        with open(index_path + ".tmp", "w") as f:
+            json.dump(self.index, f)
+        os.replace(index_path + ".tmp", index_path)
+
+
+class EpisodeStoreReader:
+    """ Reads episodes back from an EpisodeStore, memory-mapping chunk arrays and slicing episodes out of them """
+
+    def __init__(self, path, prefix="episode"):
+        self.path = path
+        self.prefix = prefix
+        self.reload()
+
+    def reload(self):
+        # Picks up chunks completed since the reader was created
+        self.index = _load_index(self.path, self.prefix)
+        self.locations = []  # (chunk, episode within chunk) for every episode
+        self.offsets = []  # per chunk, per key start offsets of the episodes
+        for c, chunk in enumerate(self.index["chunks"]):
+            offsets = {k: np.concatenate([[0], np.cumsum(lengths)]) for k, lengths in chunk["lengths"].items()}
+            self.offsets.append(offsets)
+            n_episodes = len(next(iter(chunk["lengths"].values())))
+            self.locations.extend((c, i) for i in range(n_episodes))
+        self.arrays = {}
+
+    def keys(self):
+        return list(self.index["keys"])
+
+    def __len__(self):
+        return len(self.locations)
+
+    def chunk(self, chunk_id, key):
+        """ The memory-mapped array holding key for all episodes of a chunk """
+        if (chunk_id, key) not in self.arrays:
+            self.arrays[(chunk_id, key)] = np.load(_chunk_path(self.path, self.prefix, chunk_id, key), mmap_mode="r")
+        return self.arrays[(chunk_id, key)]
+
+    def episode(self, idx, keys=None):
+        """ Returns episode idx as a dict of (memory-mapped) arrays, each of its own unpadded length """
+        chunk_id, i = self.locations[idx]
+        offsets = self.offsets[chunk_id]
+        keys = self.keys() if keys is None else keys
+        return {k: self.chunk(chunk_id, k)[offsets[k][i]:offsets[k][i + 1]] for k in keys}
+
+    def __getitem__(self, idx):
+        return self.episode(idx)
+
+
+def _to_numpy(v):
+    if isinstance(v, th.Tensor):
+        return v.detach().to("cpu", copy=True).numpy()
+    return np.array(v)
+
+
+def _index_path(path, prefix):
+    return os.path.join(path, "{}_index.json".format(prefix))
+
+
+def _chunk_path(path, prefix, chunk_id, key):
+    return os.path.join(path, "{}_{:06}_{}.npy".format(prefix, chunk_id, key))
+
+
+def _load_index(path, prefix):
+    index_path = _index_path(path, prefix)
+    if not os.path.exists(index_path):
+        return {"keys": {}, "chunks": []}
+    with open(index_path) as f:
+        return json.load(f)
@@ -0,0 +1,115 @@
+import queue
+import threading
+import torch as th
+from .episode_buffer import PrioritizedReplayBuffer
+
+
+class BatchPrefetcher:
+    """
+    Samples batches from a replay buffer in a background thread, keeping up to n_batches ready ahead of the learner.
+
+    Batches are moved to device in the background as well. For a cpu buffer and a gpu device they are gathered into
+    pinned memory and copied on a separate cuda stream, which the learner's stream waits on when it takes the batch.
+    Lazy fields are computed on device before the batch is handed over.
+    While a prefetcher is running, inserts and priority updates must go through it so they do not race its sampling.
+    Prioritised samples may be drawn before the priorities of the latest trained batches are updated.
+    """
+    def __init__(self, buffer, batch_size, n_batches, device):
+        self.buffer = buffer
+        self.batch_size = batch_size
+        self.device = device
+        self.t_env = 0  # for annealing the importance sampling exponent of prioritised buffers
+
+        self.cuda = th.device(device).type == "cuda" and th.device(buffer.device).type == "cpu"
+        self.stream = None
+        if self.cuda:
+            buffer.pin_memory = True
+            self.stream = th.cuda.Stream()
+
+        self.queue = queue.Queue(maxsize=n_batches)
+        self.lock = threading.Condition()
+        self.stop_event = threading.Event()
+        self.error = None
+        self.thread = threading.Thread(target=self._sample, name="BatchPrefetcher", daemon=True)
+        self.thread.start()
+
+    def insert_episode_batch(self, ep_batch):
+        with self.lock:
+            self.buffer.insert_episode_batch(ep_batch)
+            self.lock.notify()
+
+    def update_priorities(self, ep_ids, priorities):
+        with self.lock:
+            self.buffer.update_priorities(ep_ids, priorities)
+
+    def get(self, t_env):
+        """ Returns the next (batch, ep_ids, weights), ep_ids and weights are None unless the buffer is prioritised """
+        self.t_env = t_env
+        while True:
+            if self.error is not None:
+                raise self.error
+            try:
+                batch, ep_ids, weights, ready = self.queue.get(timeout=0.1)
+                break
+            except queue.Empty:
+                continue
+
+        if ready is not None:
+            # The batch was made on the copy stream, the current stream must not use or free it any earlier
+            stream = th.cuda.current_stream()
+            stream.wait_event(ready)
+            for v in list(batch.data.transition_data.values()) + list(batch.data.episode_data.values()):
+                v.record_stream(stream)
+            if weights is not None:
+                weights.record_stream(stream)
+        return batch, ep_ids, weights
+
+    def close(self):
+        self.stop_event.set()
+        with self.lock:
+            self.lock.notify()
+        self.thread.join()
+
+    def _sample(self):
+        try:
+            while not self.stop_event.is_set():
+                with self.lock:
+                    while not self.buffer.can_sample(self.batch_size) and not self.stop_event.is_set():
+                        self.lock.wait(0.1)
+                    if self.stop_event.is_set():
+                        return
+                    if isinstance(self.buffer, PrioritizedReplayBuffer):
+                        batch, ep_ids, weights = self.buffer.sample_with_weights(self.batch_size, self.t_env)
+                    else:
+                        batch, ep_ids, weights = self.buffer.sample(self.batch_size), None, None
+
+                item = self._to_device(batch, ep_ids, weights)
+                while not self.stop_event.is_set():
+                    try:
+                        self.queue.put(item, timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+        except Exception as e:
+            self.error = e
+            raise
+
+    def _to_device(self, batch, ep_ids, weights):
+        if not self.cuda:
+            if batch.device != self.device:
+                batch.to(self.device)
+            if weights is not None:
+                weights = weights.to(self.device)
+            for k in batch._lazy_keys():
+                batch[k]
+            return batch, ep_ids, weights, None
+
+        with th.cuda.stream(self.stream):
+            batch.to(self.device, non_blocking=True)
+            if weights is not None:
+                weights = weights.pin_memory().to(self.device, non_blocking=True)
+            for k in batch._lazy_keys():
+                batch[k]
+            ready = th.cuda.Event()
+            ready.record(self.stream)
+        return batch, ep_ids, weights, ready
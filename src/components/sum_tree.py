@@ -0,0 +1,50 @@
+import numpy as np
+
+
+class SumTree:
+    """
+    Binary sum-tree over a fixed number of leaves, stored as a flat array (root at index 1).
+    Both sampling and priority updates operate on whole batches of leaves at once, walking the
+    tree one level at a time, so each costs O(batch_size * log(capacity)).
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        # Round up to a power of two so that every leaf sits at the same depth
+        self.n_leaves = 1
+        while self.n_leaves < capacity:
+            self.n_leaves *= 2
+        self.tree = np.zeros(2 * self.n_leaves, dtype=np.float64)
+
+    def total(self):
+        return self.tree[1]
+
+    def get(self, idxs):
+        return self.tree[np.asarray(idxs) + self.n_leaves]
+
+    def update(self, idxs, values):
+        nodes = np.asarray(idxs, dtype=np.int64) + self.n_leaves
+        self.tree[nodes] = values
+        # Recompute the parents of the touched leaves, level by level
+        nodes = np.unique(nodes // 2)
+        while nodes[0] >= 1:
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+            if nodes[0] == 1:
+                break
+            nodes = np.unique(nodes // 2)
+
+    def find(self, prefix_sums):
+        # Returns the leaf index whose cumulative range contains each prefix sum
+        prefix_sums = np.array(prefix_sums, dtype=np.float64)
+        nodes = np.ones(len(prefix_sums), dtype=np.int64)
+        while nodes[0] < self.n_leaves:
+            left = 2 * nodes
+            go_right = (prefix_sums > self.tree[left]) & (self.tree[left + 1] > 0)
+            prefix_sums -= self.tree[left] * go_right
+            nodes = left + go_right
+        return nodes - self.n_leaves
+
+    def sample(self, batch_size):
+        # Stratified sampling: one draw from each of batch_size equal segments of the total mass
+        segment = self.total() / batch_size
+        prefix_sums = (np.arange(batch_size) + np.random.uniform(size=batch_size)) * segment
+        return self.find(prefix_sums)
@@ -2,6 +2,9 @@ import torch as th
 
 
 class Transform:
+    # Lazy outputs are not stored by replay buffers, sampled batches compute them when first read instead
+    lazy = False
+
     def transform(self, tensor):
         raise NotImplementedError
 
@@ -10,8 +13,9 @@ class Transform:
 
 
 class OneHot(Transform):
-    def __init__(self, out_dim):
+    def __init__(self, out_dim, lazy=False):
         self.out_dim = out_dim
+        self.lazy = lazy
 
     def transform(self, tensor):
         y_onehot = tensor.new(*tensor.shape[:-1], self.out_dim).zero_()
@@ -1,9 +1,8 @@
 from modules.agents import REGISTRY as agent_REGISTRY
 from components.action_selectors import REGISTRY as action_REGISTRY
+from components.episode_store import EpisodeStore
+import copy
 import torch as th
-import os
-from glob import glob
-import pickle
 
 
 # This multi-agent controller shares parameters between agents
@@ -12,6 +11,7 @@ class BasicMAC:
         self.n_agents = args.n_agents
         self.args = args
         input_shape = self._get_input_shape(scheme)
+        self.input_shape = input_shape
         self._build_agents(input_shape)
         self.agent_output_type = args.agent_output_type
 
@@ -19,37 +19,72 @@ class BasicMAC:
 
         self.hidden_states = None
 
+        # Constant agent-id blocks per device and reusable acting inputs per (batch size, device)
+        self._agent_ids = {}
+        self._input_workspaces = {}
+
         self.policy_outputs = []
-        self.policy_episode_id = 0
+        self.policy_store = None
 
     def save_policy_outputs(self):
-        fname = os.path.join(self.args.episode_dir, f"policy_{self.policy_episode_id + 1:06}.pkl")
-        with open(fname, 'wb') as f:
-            pickle.dump(self.policy_outputs, f)
-        self.policy_episode_id += 1
+        # Stores the agent outputs of the last episode as one (time, batch, agents, actions) array.
+        # The store is created on first use so that the mac can still be deep-copied before then
+        if self.policy_store is None:
+            self.policy_store = EpisodeStore(self.args.episode_dir, prefix="policy",
+                                             clear_existing=getattr(self.args, "clear_existing_episodes", True))
+        self.policy_store.append({"agent_outputs": th.stack(self.policy_outputs, dim=0)})
         self.policy_outputs = []
 
+    def close_policy_store(self):
+        if self.policy_store is not None:
+            self.policy_store.close()
+            self.policy_store = None
+
 
     def select_actions(self, ep_batch, t_ep, t_env, bs=slice(None), test_mode=False):
         # Only select actions for the selected batch elements in bs
         avail_actions = ep_batch["avail_actions"][:, t_ep]
-        agent_outputs = self.forward(ep_batch, t_ep, test_mode=test_mode)
+        with th.no_grad():
+            agent_outputs = self.forward(ep_batch, t_ep, test_mode=test_mode, inplace_inputs=True)
         if self.args.save_policy_outputs:
             self.policy_outputs.append(agent_outputs)
         chosen_actions = self.action_selector.select_action(agent_outputs[bs], avail_actions[bs], t_env, test_mode=test_mode)
         return chosen_actions
 
-    def forward(self, ep_batch, t, test_mode=False):
-        agent_inputs = self._build_inputs(ep_batch, t)
+    def forward(self, ep_batch, t, test_mode=False, inplace_inputs=False):
+        # inplace_inputs builds the agent inputs in a workspace that the next such call overwrites
+        agent_inputs = self._build_inputs(ep_batch, t, inplace=inplace_inputs)
         avail_actions = ep_batch["avail_actions"][:, t]
         agent_outs, self.hidden_states = self.agent(agent_inputs, self.hidden_states)
 
+        agent_outs = self._policy_outputs(agent_outs, avail_actions, test_mode)
+
+        return agent_outs.view(ep_batch.batch_size, self.n_agents, -1)
+
+    def forward_seq(self, ep_batch, max_t=None, test_mode=False, return_hidden=False):
+        # Equivalent to calling forward for t = 0 .. max_t - 1 and stacking over time (btav), but the
+        # inputs are built in one go and only the agent recurrence is stepped per timestep
+        max_t = ep_batch.max_seq_length if max_t is None else max_t
+        bs = ep_batch.batch_size
+        agent_inputs = self._build_seq_inputs(ep_batch, max_t)
+        avail_actions = ep_batch["avail_actions"][:, :max_t]
+        agent_outs, hidden_states = self.agent.forward_seq(agent_inputs, self.hidden_states)
+        self.hidden_states = hidden_states[-1]
+
+        agent_outs = self._policy_outputs(agent_outs.reshape(max_t * bs * self.n_agents, -1),
+                                          avail_actions.transpose(0, 1), test_mode)
+        agent_outs = agent_outs.view(max_t, bs, self.n_agents, -1).transpose(0, 1).contiguous()
+        if return_hidden:
+            return agent_outs, hidden_states.view(max_t, bs, self.n_agents, -1).transpose(0, 1).contiguous()
+        return agent_outs
+
+    def _policy_outputs(self, agent_outs, avail_actions, test_mode):
         # Softmax the agent outputs if they're policy logits
         if self.agent_output_type == "pi_logits":
 
             if getattr(self.args, "mask_before_softmax", True):
                 # Make the logits for unavailable actions very negative to minimise their affect on the softmax
-                reshaped_avail_actions = avail_actions.reshape(ep_batch.batch_size * self.n_agents, -1)
+                reshaped_avail_actions = avail_actions.reshape(agent_outs.size(0), -1)
                 agent_outs[reshaped_avail_actions == 0] = -1e10
 
             agent_outs = th.nn.functional.softmax(agent_outs, dim=-1)
@@ -67,7 +102,7 @@ class BasicMAC:
                     # Zero out the unavailable actions
                     agent_outs[reshaped_avail_actions == 0] = 0.0
 
-        return agent_outs.view(ep_batch.batch_size, self.n_agents, -1)
+        return agent_outs
 
     def init_hidden(self, batch_size):
         self.hidden_states = self.agent.init_hidden().unsqueeze(0).expand(batch_size, self.n_agents, -1)  # bav
@@ -78,6 +113,17 @@ class BasicMAC:
     def load_state(self, other_mac):
         self.agent.load_state_dict(other_mac.agent.state_dict())
 
+    def target_copy(self):
+        # A copy with its own agent for target networks, sharing the action selector and leaving out the hidden
+        # states, acting workspaces and policy outputs
+        target = copy.copy(self)
+        target.agent = copy.deepcopy(self.agent)
+        target.hidden_states = None
+        target._input_workspaces = {}
+        target.policy_outputs = []
+        target.policy_store = None
+        return target
+
     def cuda(self):
         self.agent.cuda()
 
@@ -90,10 +136,13 @@ class BasicMAC:
     def _build_agents(self, input_shape):
         self.agent = agent_REGISTRY[self.args.agent](input_shape, self.args)
 
-    def _build_inputs(self, batch, t):
+    def _build_inputs(self, batch, t, inplace=False):
         # Assumes homogenous agents with flat observations.
         # Other MACs might want to e.g. delegate building inputs to each agent
         bs = batch.batch_size
+        if inplace:
+            return self._build_inputs_inplace(batch, t)
+
         inputs = []
         inputs.append(batch["obs"][:, t])  # b1av
         if self.args.obs_last_action:
@@ -102,11 +151,55 @@ class BasicMAC:
             else:
                 inputs.append(batch["actions_onehot"][:, t-1])
         if self.args.obs_agent_id:
-            inputs.append(th.eye(self.n_agents, device=batch.device).unsqueeze(0).expand(bs, -1, -1))
+            inputs.append(self._get_agent_ids(batch.device).unsqueeze(0).expand(bs, -1, -1))
 
         inputs = th.cat([x.reshape(bs*self.n_agents, -1) for x in inputs], dim=1)
         return inputs
 
+    def _build_inputs_inplace(self, batch, t):
+        # Same inputs as _build_inputs, written into a persistent workspace so that acting allocates nothing.
+        # Only for callers that are done with the inputs before the next call and don't backpropagate through them,
+        # like select_actions
+        bs = batch.batch_size
+        key = (bs, str(batch.device))
+        if key not in self._input_workspaces:
+            workspace = th.zeros(bs, self.n_agents, self.input_shape, device=batch.device)
+            if self.args.obs_agent_id:
+                workspace[:, :, -self.n_agents:] = self._get_agent_ids(batch.device)
+            self._input_workspaces[key] = workspace
+        inputs = self._input_workspaces[key]
+
+        obs_shape = batch["obs"].size(-1)
+        inputs[:, :, :obs_shape].copy_(batch["obs"][:, t])
+        if self.args.obs_last_action:
+            last_actions = inputs[:, :, obs_shape:obs_shape + batch["actions_onehot"].size(-1)]
+            if t == 0:
+                last_actions.zero_()
+            else:
+                last_actions.copy_(batch["actions_onehot"][:, t-1])
+        return inputs.view(bs * self.n_agents, -1)
+
+    def _get_agent_ids(self, device):
+        key = str(device)
+        if key not in self._agent_ids:
+            self._agent_ids[key] = th.eye(self.n_agents, device=device)
+        return self._agent_ids[key]
+
+    def _build_seq_inputs(self, batch, max_t):
+        # Inputs for timesteps 0 .. max_t - 1 as a (time, batch * agents, features) tensor
+        bs = batch.batch_size
+        inputs = []
+        inputs.append(batch["obs"][:, :max_t])  # btav
+        if self.args.obs_last_action:
+            last_actions = th.zeros_like(batch["actions_onehot"][:, :max_t])
+            last_actions[:, 1:] = batch["actions_onehot"][:, :max_t - 1]
+            inputs.append(last_actions)
+        if self.args.obs_agent_id:
+            inputs.append(self._get_agent_ids(batch.device).expand(bs, max_t, -1, -1))
+
+        inputs = th.cat([x.transpose(0, 1) for x in inputs], dim=-1)
+        return inputs.reshape(max_t, bs * self.n_agents, -1)
+
     def _get_input_shape(self, scheme):
         input_shape = scheme["obs"]["vshape"]
         if self.args.obs_last_action:
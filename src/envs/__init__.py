@@ -1,5 +1,7 @@
 from functools import partial
-from smac.env import MultiAgentEnv, StarCraft2Env
+from .multiagentenv import MultiAgentEnv
+from .vecmultiagentenv import VecMultiAgentEnv, VecMultiAgentEnvWrapper
+from .synthetic import SyntheticEnv, SyntheticVecEnv
 import sys
 import os
 
@@ -7,7 +9,32 @@ def env_fn(env, **kwargs) -> MultiAgentEnv:
     return env(**kwargs)
 
 REGISTRY = {}
-REGISTRY["sc2"] = partial(env_fn, env=StarCraft2Env)
+REGISTRY["synthetic"] = partial(env_fn, env=SyntheticEnv)
+
+# StarCraft II is only available with smac installed
+try:
+    from smac.env import StarCraft2Env
+    REGISTRY["sc2"] = partial(env_fn, env=StarCraft2Env)
+except ImportError:
+    pass
+
+# Envs with a batched implementation of their own, created with n_envs
+VEC_REGISTRY = {}
+VEC_REGISTRY["synthetic"] = partial(env_fn, env=SyntheticVecEnv)
+
+def offset_seed(env_args, offset):
+    # A copy of env_args whose seed (if any) is moved on by offset, so that envs built from the same args differ
+    env_args = dict(env_args)
+    if env_args.get("seed") is not None:
+        env_args["seed"] = env_args["seed"] + offset
+    return env_args
+
+def vec_env_fn(env, n_envs, **kwargs) -> VecMultiAgentEnv:
+    # Batched envs seed all of their copies from one generator. Any other env is wrapped, with its copies
+    # seeded seed, seed + 1, ... and stepped one after another
+    if env in VEC_REGISTRY:
+        return VEC_REGISTRY[env](n_envs=n_envs, **kwargs)
+    return VecMultiAgentEnvWrapper([partial(REGISTRY[env], **offset_seed(kwargs, i)) for i in range(n_envs)])
 
 if sys.platform == "linux":
     os.environ.setdefault("SC2PATH",
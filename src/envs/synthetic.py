@@ -0,0 +1,281 @@
+import time
+import numpy as np
+from .multiagentenv import MultiAgentEnv
+from .vecmultiagentenv import VecMultiAgentEnv
+
+
+# Unit counts, episode limits and feature bits of some SMAC maps, obs and state sizes are derived from them
+MAP_PARAMS = {
+    "3m": dict(n_agents=3, n_enemies=3, episode_limit=60, unit_type_bits=0, shield_bits_ally=0, shield_bits_enemy=0),
+    "8m": dict(n_agents=8, n_enemies=8, episode_limit=120, unit_type_bits=0, shield_bits_ally=0, shield_bits_enemy=0),
+    "25m": dict(n_agents=25, n_enemies=25, episode_limit=150, unit_type_bits=0, shield_bits_ally=0, shield_bits_enemy=0),
+    "27m_vs_30m": dict(n_agents=27, n_enemies=30, episode_limit=180, unit_type_bits=0, shield_bits_ally=0,
+                       shield_bits_enemy=0),
+    "2s3z": dict(n_agents=5, n_enemies=5, episode_limit=120, unit_type_bits=2, shield_bits_ally=1, shield_bits_enemy=1),
+    "3s5z": dict(n_agents=8, n_enemies=8, episode_limit=150, unit_type_bits=2, shield_bits_ally=1, shield_bits_enemy=1),
+    "MMM2": dict(n_agents=10, n_enemies=12, episode_limit=180, unit_type_bits=3, shield_bits_ally=0,
+                 shield_bits_enemy=0),
+    "corridor": dict(n_agents=6, n_enemies=24, episode_limit=400, unit_type_bits=2, shield_bits_ally=1,
+                     shield_bits_enemy=0),
+}
+
+N_ACTIONS_NO_ATTACK = 6  # no-op, stop and 4 move directions, as in SMAC
+
+
+class SyntheticVecEnv(VecMultiAgentEnv):
+    """
+    Pure numpy stand-in for SMAC, for benchmarking and profiling without StarCraft II.
+
+    Env info matches SMAC for map_name (or for the given unit counts and feature bits): the obs and state sizes,
+    6 + n_enemies actions and the episode limit. Observations and states are noise, apart from the unit type bits
+    and a one-hot of a rewarded action for each agent at the start of its observation. Agents get a shared reward for
+    the fraction of them taking their rewarded action. Attack actions are available at random. Agents die at random,
+    after which only no-op is available to them and they add nothing to the reward, and episodes end in defeat once
+    all agents are dead.
+
+    Episode lengths are drawn from episode_length_dist, "fixed" (episode_limit), "uniform" (between
+    episode_length_min and episode_length_max) or "geometric" (mean episode_length_mean), and capped at the
+    episode limit. Episodes ending before the limit without a defeat are won if their mean reward is at least
+    win_threshold, episodes reaching the limit time out. Every env step busy-waits step_time seconds (plus normal noise of std step_time_std) to
+    stand in for the cost of the simulator. obs_size and state_size override the SMAC sizes, for benchmarks.
+    """
+    def __init__(self, n_envs=1, map_name="3m", n_agents=None, n_enemies=None, episode_limit=None,
+                 unit_type_bits=None, shield_bits_ally=None, shield_bits_enemy=None,
+                 obs_all_health=True, obs_own_health=True, obs_last_action=False, state_last_action=True,
+                 episode_length_dist="uniform", episode_length_min=None, episode_length_max=None,
+                 episode_length_mean=None, attack_avail_prob=0.5, death_prob=0.0, win_threshold=0.5,
+                 step_time=0.0, step_time_std=0.0, obs_size=None, state_size=None, seed=None):
+        params = dict(MAP_PARAMS[map_name]) if map_name is not None else {}
+        for k, v in dict(n_agents=n_agents, n_enemies=n_enemies, episode_limit=episode_limit,
+                         unit_type_bits=unit_type_bits, shield_bits_ally=shield_bits_ally,
+                         shield_bits_enemy=shield_bits_enemy).items():
+            if v is not None:
+                params[k] = v
+        self.n_envs = n_envs
+        self.n_agents = params["n_agents"]
+        self.n_enemies = params["n_enemies"]
+        self.episode_limit = params["episode_limit"]
+        self.unit_type_bits = params["unit_type_bits"]
+        self.n_actions = N_ACTIONS_NO_ATTACK + self.n_enemies
+
+        # Feature sizes as computed by SMAC's StarCraft2Env
+        self.shield_bits_ally, self.shield_bits_enemy = params["shield_bits_ally"], params["shield_bits_enemy"]
+        self.state_last_action = state_last_action
+        nf_enemy = 4 + self.unit_type_bits + (1 + self.shield_bits_enemy if obs_all_health else 0)
+        nf_ally = 4 + self.unit_type_bits + (1 + self.shield_bits_ally if obs_all_health else 0)
+        nf_ally += self.n_actions if obs_last_action else 0
+        nf_own = self.unit_type_bits + (1 + self.shield_bits_ally if obs_own_health else 0)
+        self.obs_size = 4 + self.n_enemies * nf_enemy + (self.n_agents - 1) * nf_ally + nf_own
+        self.state_size = self.n_agents * (4 + self.shield_bits_ally + self.unit_type_bits) \
+            + self.n_enemies * (3 + self.shield_bits_enemy + self.unit_type_bits) \
+            + (self.n_agents * self.n_actions if state_last_action else 0)
+        self.obs_size = self.obs_size if obs_size is None else obs_size
+        self.state_size = self.state_size if state_size is None else state_size
+        assert self.obs_size >= self.n_actions + self.unit_type_bits, "Observations too small to hold the rewarded action"
+
+        assert episode_length_dist in ["fixed", "uniform", "geometric"], \
+            "Unknown episode_length_dist {}".format(episode_length_dist)
+        self.episode_length_dist = episode_length_dist
+        self.episode_length_min = 1 if episode_length_min is None else episode_length_min
+        self.episode_length_max = self.episode_limit if episode_length_max is None else episode_length_max
+        self.episode_length_mean = self.episode_limit / 2 if episode_length_mean is None else episode_length_mean
+        self.attack_avail_prob = attack_avail_prob
+        self.death_prob = death_prob
+        self.win_threshold = win_threshold
+        self.step_time = step_time
+        self.step_time_std = step_time_std
+        self.rng = np.random.RandomState(seed)
+
+        # Unit types are assigned to agents in turn
+        self.unit_types = np.zeros((self.n_agents, self.unit_type_bits), dtype=np.float32)
+        if self.unit_type_bits > 0:
+            self.unit_types[np.arange(self.n_agents), np.arange(self.n_agents) % self.unit_type_bits] = 1
+
+        self.t = np.zeros(n_envs, dtype=np.int64)
+        self.lengths = np.zeros(n_envs, dtype=np.int64)
+        self.returns = np.zeros(n_envs)
+        self.alive = np.ones((n_envs, self.n_agents), dtype=bool)
+        self.good_actions = np.zeros((n_envs, self.n_agents), dtype=np.int64)
+        self.avail_actions = np.zeros((n_envs, self.n_agents, self.n_actions), dtype=np.int64)
+        self.obs = np.zeros((n_envs, self.n_agents, self.obs_size), dtype=np.float32)
+        self.state = np.zeros((n_envs, self.state_size), dtype=np.float32)
+
+        self.battles_game = 0
+        self.battles_won = 0
+        self.timeouts = 0
+
+    def _ids(self, env_ids):
+        return np.arange(self.n_envs) if env_ids is None else np.asarray(env_ids, dtype=np.int64)
+
+    def _sample_lengths(self, n):
+        if self.episode_length_dist == "fixed":
+            lengths = np.full(n, self.episode_limit)
+        elif self.episode_length_dist == "uniform":
+            lengths = self.rng.randint(self.episode_length_min, self.episode_length_max + 1, size=n)
+        else:
+            lengths = self.rng.geometric(1.0 / self.episode_length_mean, size=n)
+        return np.clip(lengths, 1, self.episode_limit)
+
+    def _observe(self, ids):
+        # New observations, states, rewarded actions and available actions for the envs in ids
+        n = len(ids)
+        avail = np.zeros((n, self.n_agents, self.n_actions), dtype=np.int64)
+        avail[:, :, 1:N_ACTIONS_NO_ATTACK] = 1
+        avail[:, :, N_ACTIONS_NO_ATTACK:] = self.rng.rand(n, self.n_agents, self.n_enemies) < self.attack_avail_prob
+        dead = ~self.alive[ids]
+        avail[dead] = 0
+        avail[dead, 0] = 1
+
+        # A random available action is rewarded, by ranking random keys of the available actions
+        keys = self.rng.rand(n, self.n_agents, self.n_actions) + avail
+        good = keys.argmax(-1)
+
+        obs = self.rng.randn(n, self.n_agents, self.obs_size).astype(np.float32)
+        obs[:, :, :self.n_actions] = 0
+        np.put_along_axis(obs[:, :, :self.n_actions], good[..., None], 1, axis=-1)
+        if self.unit_type_bits > 0:
+            obs[:, :, -self.unit_type_bits:] = self.unit_types
+        obs[dead] = 0
+
+        self.avail_actions[ids] = avail
+        self.good_actions[ids] = good
+        self.obs[ids] = obs
+        self.state[ids] = self.rng.randn(n, self.state_size)
+
+    def _busy_wait(self, n):
+        if self.step_time <= 0 and self.step_time_std <= 0:
+            return
+        duration = max(0.0, n * self.step_time + np.sqrt(n) * self.step_time_std * self.rng.randn())
+        end = time.perf_counter() + duration
+        while time.perf_counter() < end:
+            pass
+
+    def reset(self, env_ids=None):
+        ids = self._ids(env_ids)
+        self.t[ids] = 0
+        self.lengths[ids] = self._sample_lengths(len(ids))
+        self.returns[ids] = 0
+        self.alive[ids] = True
+        self._observe(ids)
+
+    def step(self, actions, env_ids=None):
+        ids = self._ids(env_ids)
+        actions = np.asarray(actions).reshape(len(ids), self.n_agents)
+        self._busy_wait(len(ids))
+
+        # Dead agents add nothing to the reward
+        rewards = ((actions == self.good_actions[ids]) & self.alive[ids]).mean(-1).astype(np.float32)
+        self.returns[ids] += rewards
+        self.t[ids] += 1
+        if self.death_prob > 0:
+            self.alive[ids] &= self.rng.rand(len(ids), self.n_agents) >= self.death_prob
+
+        timeout = self.t[ids] >= self.episode_limit
+        defeat = ~self.alive[ids].any(-1)
+        terminated = (self.t[ids] >= self.lengths[ids]) | timeout | defeat
+        infos = []
+        for i, idx in enumerate(ids):
+            info = {}
+            if terminated[i]:
+                won = bool(not (timeout[i] or defeat[i]) and self.returns[idx] / self.t[idx] >= self.win_threshold)
+                info["battle_won"] = won
+                if timeout[i]:
+                    info["episode_limit"] = True
+                self.battles_game += 1
+                self.battles_won += won
+                self.timeouts += bool(timeout[i])
+            infos.append(info)
+
+        self._observe(ids)
+        return rewards, terminated, infos
+
+    def get_obs(self, env_ids=None):
+        return self.obs[self._ids(env_ids)]
+
+    def get_state(self, env_ids=None):
+        return self.state[self._ids(env_ids)]
+
+    def get_avail_actions(self, env_ids=None):
+        return self.avail_actions[self._ids(env_ids)]
+
+    def get_env_info(self):
+        return {"state_shape": self.state_size,
+                "obs_shape": self.obs_size,
+                "n_actions": self.n_actions,
+                "n_agents": self.n_agents,
+                "episode_limit": self.episode_limit}
+
+    def get_stats(self):
+        # The counts cover all envs, so the same stats are given for each of them
+        return [self._stats()] * self.n_envs
+
+    def _stats(self):
+        return {"battles_won": self.battles_won,
+                "battles_game": self.battles_game,
+                "timeouts": self.timeouts,
+                "win_rate": self.battles_won / max(1, self.battles_game)}
+
+    def close(self):
+        pass
+
+
+class SyntheticEnv(MultiAgentEnv):
+    """ Single env version of SyntheticVecEnv, taking the same arguments """
+
+    def __init__(self, **kwargs):
+        self.env = SyntheticVecEnv(n_envs=1, **kwargs)
+        self.n_agents = self.env.n_agents
+        self.episode_limit = self.env.episode_limit
+
+    def __getattr__(self, name):
+        # Unit counts and feature bits, as read from SMAC envs by SimPLeLearner
+        if name == "env":
+            raise AttributeError(name)
+        return getattr(self.env, name)
+
+    def step(self, actions):
+        rewards, terminated, infos = self.env.step(np.asarray(actions)[None])
+        return float(rewards[0]), bool(terminated[0]), infos[0]
+
+    def get_obs(self):
+        return list(self.env.get_obs()[0])
+
+    def get_obs_agent(self, agent_id):
+        return self.env.get_obs()[0, agent_id]
+
+    def get_obs_size(self):
+        return self.env.obs_size
+
+    def get_state(self):
+        return self.env.get_state()[0]
+
+    def get_state_size(self):
+        return self.env.state_size
+
+    def get_avail_actions(self):
+        return list(self.env.get_avail_actions()[0])
+
+    def get_avail_agent_actions(self, agent_id):
+        return self.env.get_avail_actions()[0, agent_id]
+
+    def get_total_actions(self):
+        return self.env.n_actions
+
+    def reset(self):
+        self.env.reset()
+        return self.get_obs(), self.get_state()
+
+    def render(self):
+        pass
+
+    def close(self):
+        pass
+
+    def seed(self):
+        pass
+
+    def save_replay(self):
+        pass
+
+    def get_stats(self):
+        return self.env._stats()
@@ -0,0 +1,78 @@
+import numpy as np
+
+
+class VecMultiAgentEnv(object):
+    """
+    n_envs copies of a multi-agent env stepped together.
+    Methods take env_ids, the envs to act on (all of them if None), and return numpy arrays stacked along a
+    first axis in the order of env_ids.
+    """
+    n_envs = None
+
+    def step(self, actions, env_ids=None):
+        """ Steps env_ids with actions of shape (len(env_ids), n_agents). Returns rewards, terminated, infos """
+        raise NotImplementedError
+
+    def reset(self, env_ids=None):
+        raise NotImplementedError
+
+    def get_obs(self, env_ids=None):
+        """ Returns observations of shape (len(env_ids), n_agents, obs_size) """
+        raise NotImplementedError
+
+    def get_state(self, env_ids=None):
+        """ Returns states of shape (len(env_ids), state_size) """
+        raise NotImplementedError
+
+    def get_avail_actions(self, env_ids=None):
+        """ Returns available actions of shape (len(env_ids), n_agents, n_actions) """
+        raise NotImplementedError
+
+    def get_env_info(self):
+        """ Returns the env info of a single env """
+        raise NotImplementedError
+
+    def get_stats(self):
+        """ Returns the stats of every env in a list """
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+
+class VecMultiAgentEnvWrapper(VecMultiAgentEnv):
+    """ Steps a list of MultiAgentEnvs one after another in the same process """
+
+    def __init__(self, env_fns):
+        self.envs = [env_fn() for env_fn in env_fns]
+        self.n_envs = len(self.envs)
+
+    def _envs(self, env_ids):
+        return self.envs if env_ids is None else [self.envs[i] for i in env_ids]
+
+    def step(self, actions, env_ids=None):
+        rewards, terminated, infos = zip(*[env.step(a) for env, a in zip(self._envs(env_ids), actions)])
+        return np.array(rewards, dtype=np.float32), np.array(terminated, dtype=bool), list(infos)
+
+    def reset(self, env_ids=None):
+        for env in self._envs(env_ids):
+            env.reset()
+
+    def get_obs(self, env_ids=None):
+        return np.stack([np.stack(env.get_obs()) for env in self._envs(env_ids)])
+
+    def get_state(self, env_ids=None):
+        return np.stack([env.get_state() for env in self._envs(env_ids)])
+
+    def get_avail_actions(self, env_ids=None):
+        return np.stack([np.stack(env.get_avail_actions()) for env in self._envs(env_ids)])
+
+    def get_env_info(self):
+        return self.envs[0].get_env_info()
+
+    def get_stats(self):
+        return [env.get_stats() for env in self.envs]
+
+    def close(self):
+        for env in self.envs:
+            env.close()
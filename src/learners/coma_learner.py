@@ -1,7 +1,8 @@
 import copy
 from components.episode_buffer import EpisodeBatch
 from modules.critics.coma import COMACritic
-from utils.rl_utils import build_td_lambda_targets
+from utils.param_groups import ParamGroup
+from utils.rl_utils import build_n_step_targets, build_td_lambda_targets
 import torch as th
 from torch.optim import RMSprop
 
@@ -26,8 +27,13 @@ class COMALearner:
         self.critic_params = list(self.critic.parameters())
         self.params = self.agent_params + self.critic_params
 
-        self.agent_optimiser = RMSprop(params=self.agent_params, lr=args.lr, alpha=args.optim_alpha, eps=args.optim_eps)
-        self.critic_optimiser = RMSprop(params=self.critic_params, lr=args.critic_lr, alpha=args.optim_alpha, eps=args.optim_eps)
+        self.agent_param_group = ParamGroup(self.agent_params, flat=args.flat_params)
+        self.critic_param_group = ParamGroup(self.critic_params, flat=args.flat_params)
+        self.target_critic_param_group = ParamGroup(self.target_critic.parameters(), flat=args.flat_params,
+                                                    requires_grad=False)
+
+        self.agent_optimiser = RMSprop(params=self.agent_param_group.optimiser_params(), lr=args.lr, alpha=args.optim_alpha, eps=args.optim_eps)
+        self.critic_optimiser = RMSprop(params=self.critic_param_group.optimiser_params(), lr=args.critic_lr, alpha=args.optim_alpha, eps=args.optim_eps)
 
     def train(self, batch: EpisodeBatch, t_env: int, episode_num: int):
         # Get the relevant quantities
@@ -49,12 +55,8 @@ class COMALearner:
 
         actions = actions[:,:-1]
 
-        mac_out = []
         self.mac.init_hidden(batch.batch_size)
-        for t in range(batch.max_seq_length - 1):
-            agent_outs = self.mac.forward(batch, t=t)
-            mac_out.append(agent_outs)
-        mac_out = th.stack(mac_out, dim=1)  # Concat over time
+        mac_out = self.mac.forward_seq(batch, max_t=batch.max_seq_length - 1)
 
         # Mask out unavailable actions, renormalise (as in action selection)
         mac_out[avail_actions == 0] = 0
@@ -77,19 +79,25 @@ class COMALearner:
         coma_loss = - ((advantages * log_pi_taken) * mask).sum() / mask.sum()
 
         # Optimise agents
-        self.agent_optimiser.zero_grad()
+        self.agent_param_group.zero_grad()
         coma_loss.backward()
-        grad_norm = th.nn.utils.clip_grad_norm_(self.agent_params, self.args.grad_norm_clip)
+        grad_norm = self.agent_param_group.clip_grad_norm(self.args.grad_norm_clip)
         self.agent_optimiser.step()
 
-        if (self.critic_training_steps - self.last_target_update_step) / self.args.target_update_interval >= 1.0:
+        if self.args.target_update_tau > 0:
+            self.target_critic_param_group.lerp_(self.critic_param_group, self.args.target_update_tau)
+        elif (self.critic_training_steps - self.last_target_update_step) / self.args.target_update_interval >= 1.0:
             self._update_targets()
             self.last_target_update_step = self.critic_training_steps
 
         if t_env - self.log_stats_t >= self.args.learner_log_interval:
-            ts_logged = len(critic_train_stats["critic_loss"])
-            for key in ["critic_loss", "critic_grad_norm", "td_error_abs", "q_taken_mean", "target_mean"]:
-                self.logger.log_stat(key, sum(critic_train_stats[key])/ts_logged, t_env)
+            # Critic stats are summed over its updates on device and fetched together
+            keys = ["critic_loss", "critic_grad_norm", "td_error_abs", "q_taken_mean", "target_mean"]
+            n_updates = critic_train_stats.pop("n_updates")
+            if n_updates > 0:
+                values = th.stack([critic_train_stats[key] for key in keys]).tolist()
+                for key, value in zip(keys, values):
+                    self.logger.log_stat(key, value / n_updates, t_env)
 
             self.logger.log_stat("advantage_mean", (advantages * mask).sum().item() / mask.sum().item(), t_env)
             self.logger.log_stat("coma_loss", coma_loss.item(), t_env)
@@ -102,28 +110,46 @@ class COMALearner:
         target_q_vals = self.target_critic(batch)[:, :]
         targets_taken = th.gather(target_q_vals, dim=3, index=actions).squeeze(3)
 
-        # Calculate td-lambda targets
-        targets = build_td_lambda_targets(rewards, terminated, mask, targets_taken, self.n_agents, self.args.gamma, self.args.td_lambda)
+        if self.args.q_nstep > 0:
+            # Calculate n-step targets
+            targets = build_n_step_targets(rewards, terminated, mask, targets_taken, self.n_agents, self.args.gamma, self.args.q_nstep)
+        else:
+            # Calculate td-lambda targets
+            targets = build_td_lambda_targets(rewards, terminated, mask, targets_taken, self.n_agents, self.args.gamma, self.args.td_lambda)
 
         q_vals = th.zeros_like(target_q_vals)[:, :-1]
 
         running_log = {
-            "critic_loss": [],
-            "critic_grad_norm": [],
-            "td_error_abs": [],
-            "target_mean": [],
-            "q_taken_mean": [],
+            "critic_loss": 0,
+            "critic_grad_norm": 0,
+            "td_error_abs": 0,
+            "target_mean": 0,
+            "q_taken_mean": 0,
+            "n_updates": 0,
         }
 
-        for t in reversed(range(rewards.size(1))):
-            mask_t = mask[:, t].expand(-1, self.n_agents)
+        # One update per timestep (seq), per critic_train_chunk_size timesteps (chunk) or for all of them (batch),
+        # going backwards from the end of the episodes
+        max_ep_t = rewards.size(1)
+        if self.args.critic_train_mode == "seq":
+            chunk_size = 1
+        elif self.args.critic_train_mode == "chunk":
+            chunk_size = self.args.critic_train_chunk_size
+        elif self.args.critic_train_mode == "batch":
+            chunk_size = max_ep_t
+        else:
+            raise ValueError("Unknown critic_train_mode {}".format(self.args.critic_train_mode))
+
+        for t_end in range(max_ep_t, 0, -chunk_size):
+            ts = slice(max(t_end - chunk_size, 0), t_end)
+            mask_t = mask[:, ts].expand(-1, -1, self.n_agents)
             if mask_t.sum() == 0:
                 continue
 
-            q_t = self.critic(batch, t)
-            q_vals[:, t] = q_t.view(bs, self.n_agents, self.n_actions)
-            q_taken = th.gather(q_t, dim=3, index=actions[:, t:t+1]).squeeze(3).squeeze(1)
-            targets_t = targets[:, t]
+            q_t = self.critic(batch, ts)
+            q_vals[:, ts] = q_t
+            q_taken = th.gather(q_t, dim=3, index=actions[:, ts]).squeeze(3)
+            targets_t = targets[:, ts]
 
             td_error = (q_taken - targets_t.detach())
 
@@ -131,30 +157,34 @@ class COMALearner:
             masked_td_error = td_error * mask_t
 
             # Normal L2 loss, take mean over actual data
-            loss = (masked_td_error ** 2).sum() / mask_t.sum()
-            self.critic_optimiser.zero_grad()
+            mask_elems = mask_t.sum()
+            loss = (masked_td_error ** 2).sum() / mask_elems
+            self.critic_param_group.zero_grad()
             loss.backward()
-            grad_norm = th.nn.utils.clip_grad_norm_(self.critic_params, self.args.grad_norm_clip)
+            grad_norm = self.critic_param_group.clip_grad_norm(self.args.grad_norm_clip)
             self.critic_optimiser.step()
             self.critic_training_steps += 1
 
-            running_log["critic_loss"].append(loss.item())
-            running_log["critic_grad_norm"].append(grad_norm)
-            mask_elems = mask_t.sum().item()
-            running_log["td_error_abs"].append((masked_td_error.abs().sum().item() / mask_elems))
-            running_log["q_taken_mean"].append((q_taken * mask_t).sum().item() / mask_elems)
-            running_log["target_mean"].append((targets_t * mask_t).sum().item() / mask_elems)
+            running_log["critic_loss"] += loss.detach()
+            running_log["critic_grad_norm"] += grad_norm
+            running_log["td_error_abs"] += masked_td_error.detach().abs().sum() / mask_elems
+            running_log["q_taken_mean"] += (q_taken.detach() * mask_t).sum() / mask_elems
+            running_log["target_mean"] += (targets_t * mask_t).sum() / mask_elems
+            running_log["n_updates"] += 1
 
         return q_vals, running_log
 
     def _update_targets(self):
-        self.target_critic.load_state_dict(self.critic.state_dict())
+        self.target_critic_param_group.copy_(self.critic_param_group)
         self.logger.console_logger.info("Updated target network")
 
     def cuda(self):
         self.mac.cuda()
         self.critic.cuda()
         self.target_critic.cuda()
+        self.agent_param_group.flatten()
+        self.critic_param_group.flatten()
+        self.target_critic_param_group.flatten()
 
     def save_models(self, path):
         self.mac.save_models(path)
@@ -2,7 +2,10 @@ import copy
 from components.episode_buffer import EpisodeBatch
 from modules.mixers.vdn import VDNMixer
 from modules.mixers.qmix import QMixer
+from utils.param_groups import ParamGroup
+from utils.rl_utils import build_n_step_targets
 import torch as th
+import torch.nn.functional as F
 from torch.optim import RMSprop
 
 
@@ -27,14 +30,21 @@ class QLearner:
             self.params += list(self.mixer.parameters())
             self.target_mixer = copy.deepcopy(self.mixer)
 
-        self.optimiser = RMSprop(params=self.params, lr=args.lr, alpha=args.optim_alpha, eps=args.optim_eps)
+        # Copies the agent but shares the action selector
+        self.target_mac = mac.target_copy()
 
-        # a little wasteful to deepcopy (e.g. duplicates action selector), but should work for any MAC
-        self.target_mac = copy.deepcopy(mac)
+        # Target parameters follow self.params in the same order
+        target_params = list(self.target_mac.parameters())
+        if self.mixer is not None:
+            target_params += list(self.target_mixer.parameters())
+        self.param_group = ParamGroup(self.params, flat=args.flat_params)
+        self.target_param_group = ParamGroup(target_params, flat=args.flat_params, requires_grad=False)
+
+        self.optimiser = RMSprop(params=self.param_group.optimiser_params(), lr=args.lr, alpha=args.optim_alpha, eps=args.optim_eps)
 
         self.log_stats_t = -self.args.learner_log_interval - 1
 
-    def train(self, batch: EpisodeBatch, t_env: int, episode_num: int):
+    def train(self, batch: EpisodeBatch, t_env: int, episode_num: int, weights=None):
 
         # Get the relevant quantities
         rewards = batch["reward"][:, :-1]
@@ -45,24 +55,17 @@ class QLearner:
         avail_actions = batch["avail_actions"]
 
         # Calculate estimated Q-Values
-        mac_out = []
         self.mac.init_hidden(batch.batch_size)
-        for t in range(batch.max_seq_length):
-            agent_outs = self.mac.forward(batch, t=t)
-            mac_out.append(agent_outs)
-        mac_out = th.stack(mac_out, dim=1)  # Concat over time
+        mac_out = self.mac.forward_seq(batch)
 
         # Pick the Q-Values for the actions taken by each agent
         chosen_action_qvals = th.gather(mac_out[:, :-1], dim=3, index=actions).squeeze(3)  # Remove the last dim
 
         # Calculate the Q-Values necessary for the target
-        target_mac_out = []
         self.target_mac.init_hidden(batch.batch_size)
-        for t in range(batch.max_seq_length):
-            target_agent_outs = self.target_mac.forward(batch, t=t)
-            target_mac_out.append(target_agent_outs)
+        target_mac_out = self.target_mac.forward_seq(batch)
         # We don't need the first timesteps Q-Value estimate for calculating targets
-        target_mac_out = th.stack(target_mac_out[1:], dim=1)  # Concat across time
+        target_mac_out = target_mac_out[:, 1:]
 
         # Mask out unavailable actions
         target_mac_out[avail_actions[:, 1:] == 0] = -9999999
@@ -78,12 +81,28 @@ class QLearner:
             target_max_qvals = target_mac_out.max(dim=3)[0]
 
         # Mix
-        if self.mixer is not None:
+        if isinstance(self.mixer, QMixer):
+            # The hypernetworks are evaluated on every state once, rather than on the overlapping windows of states
+            # for each mixer. Agent Q-Values are padded to all timesteps, the online mixer keeps timesteps :-1 and
+            # the target mixer timesteps 1:
+            states = batch["state"]
+            chosen_action_qvals = self.mixer.mix(F.pad(chosen_action_qvals, (0, 0, 0, 1)),
+                                                 self.mixer.hypernet(states))[:, :-1]
+            with th.no_grad():
+                target_max_qvals = self.target_mixer.mix(F.pad(target_max_qvals, (0, 0, 1, 0)),
+                                                         self.target_mixer.hypernet(states))[:, 1:]
+        elif self.mixer is not None:
             chosen_action_qvals = self.mixer(chosen_action_qvals, batch["state"][:, :-1])
             target_max_qvals = self.target_mixer(target_max_qvals, batch["state"][:, 1:])
 
-        # Calculate 1-step Q-Learning targets
-        targets = rewards + self.args.gamma * (1 - terminated) * target_max_qvals
+        if self.args.q_nstep > 1:
+            # Calculate n-step Q-Learning targets, which index the target Q-Values from the first timestep
+            target_max_qvals = th.cat([th.zeros_like(target_max_qvals[:, :1]), target_max_qvals], dim=1)
+            targets = build_n_step_targets(rewards, terminated, mask, target_max_qvals, self.args.n_agents,
+                                           self.args.gamma, self.args.q_nstep)
+        else:
+            # Calculate 1-step Q-Learning targets
+            targets = rewards + self.args.gamma * (1 - terminated) * target_max_qvals
 
         # Td-error
         td_error = (chosen_action_qvals - targets.detach())
@@ -94,15 +113,21 @@ class QLearner:
         masked_td_error = td_error * mask
 
         # Normal L2 loss, take mean over actual data
-        loss = (masked_td_error ** 2).sum() / mask.sum()
+        if weights is None:
+            loss = (masked_td_error ** 2).sum() / mask.sum()
+        else:
+            # Importance sampling weights from prioritised replay, one per episode
+            loss = (masked_td_error ** 2 * weights.view(-1, 1, 1)).sum() / mask.sum()
 
         # Optimise
-        self.optimiser.zero_grad()
+        self.param_group.zero_grad()
         loss.backward()
-        grad_norm = th.nn.utils.clip_grad_norm_(self.params, self.args.grad_norm_clip)
+        grad_norm = self.param_group.clip_grad_norm(self.args.grad_norm_clip)
         self.optimiser.step()
 
-        if (episode_num - self.last_target_update_episode) / self.args.target_update_interval >= 1.0:
+        if self.args.target_update_tau > 0:
+            self.target_param_group.lerp_(self.param_group, self.args.target_update_tau)
+        elif (episode_num - self.last_target_update_episode) / self.args.target_update_interval >= 1.0:
             self._update_targets()
             self.last_target_update_episode = episode_num
 
@@ -115,10 +140,11 @@ class QLearner:
             self.logger.log_stat("target_mean", (targets * mask).sum().item()/(mask_elems * self.args.n_agents), t_env)
             self.log_stats_t = t_env
 
+        # Per-episode mean absolute td-error, used as the priority for prioritised replay
+        return (masked_td_error.abs().sum(dim=(1, 2)) / mask.sum(dim=(1, 2)).clamp(min=1)).detach()
+
     def _update_targets(self):
-        self.target_mac.load_state(self.mac)
-        if self.mixer is not None:
-            self.target_mixer.load_state_dict(self.mixer.state_dict())
+        self.target_param_group.copy_(self.param_group)
         self.logger.console_logger.info("Updated target network")
 
     def cuda(self):
@@ -127,6 +153,8 @@ class QLearner:
         if self.mixer is not None:
             self.mixer.cuda()
             self.target_mixer.cuda()
+        self.param_group.flatten()
+        self.target_param_group.flatten()
 
     def save_models(self, path):
         self.mac.save_models(path)
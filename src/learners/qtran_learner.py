@@ -1,6 +1,7 @@
 import copy
 from components.episode_buffer import EpisodeBatch
 from modules.mixers.qtran import QTranBase
+from utils.param_groups import ParamGroup
 import torch as th
 from torch.optim import RMSprop, Adam
 
@@ -24,10 +25,15 @@ class QLearner:
         self.params += list(self.mixer.parameters())
         self.target_mixer = copy.deepcopy(self.mixer)
 
-        self.optimiser = RMSprop(params=self.params, lr=args.lr, alpha=args.optim_alpha, eps=args.optim_eps)
+        # Copies the agent but shares the action selector
+        self.target_mac = mac.target_copy()
 
-        # a little wasteful to deepcopy (e.g. duplicates action selector), but should work for any MAC
-        self.target_mac = copy.deepcopy(mac)
+        # Target parameters follow self.params in the same order
+        target_params = list(self.target_mac.parameters()) + list(self.target_mixer.parameters())
+        self.param_group = ParamGroup(self.params, flat=args.flat_params)
+        self.target_param_group = ParamGroup(target_params, flat=args.flat_params, requires_grad=False)
+
+        self.optimiser = RMSprop(params=self.param_group.optimiser_params(), lr=args.lr, alpha=args.optim_alpha, eps=args.optim_eps)
 
         self.log_stats_t = -self.args.learner_log_interval - 1
 
@@ -41,33 +47,15 @@ class QLearner:
         avail_actions = batch["avail_actions"]
 
         # Calculate estimated Q-Values
-        mac_out = []
-        mac_hidden_states = []
         self.mac.init_hidden(batch.batch_size)
-        for t in range(batch.max_seq_length):
-            agent_outs = self.mac.forward(batch, t=t)
-            mac_out.append(agent_outs)
-            mac_hidden_states.append(self.mac.hidden_states)
-        mac_out = th.stack(mac_out, dim=1)  # Concat over time
-        mac_hidden_states = th.stack(mac_hidden_states, dim=1)
-        mac_hidden_states = mac_hidden_states.reshape(batch.batch_size, self.args.n_agents, batch.max_seq_length, -1).transpose(1,2) #btav
+        mac_out, mac_hidden_states = self.mac.forward_seq(batch, return_hidden=True)  # btav
 
         # Pick the Q-Values for the actions taken by each agent
         chosen_action_qvals = th.gather(mac_out[:, :-1], dim=3, index=actions).squeeze(3)  # Remove the last dim
 
         # Calculate the Q-Values necessary for the target
-        target_mac_out = []
-        target_mac_hidden_states = []
         self.target_mac.init_hidden(batch.batch_size)
-        for t in range(batch.max_seq_length):
-            target_agent_outs = self.target_mac.forward(batch, t=t)
-            target_mac_out.append(target_agent_outs)
-            target_mac_hidden_states.append(self.target_mac.hidden_states)
-
-        # We don't need the first timesteps Q-Value estimate for calculating targets
-        target_mac_out = th.stack(target_mac_out[:], dim=1)  # Concat across time
-        target_mac_hidden_states = th.stack(target_mac_hidden_states, dim=1)
-        target_mac_hidden_states = target_mac_hidden_states.reshape(batch.batch_size, self.args.n_agents, batch.max_seq_length, -1).transpose(1,2) #btav
+        target_mac_out, target_mac_hidden_states = self.target_mac.forward_seq(batch, return_hidden=True)  # btav
 
         # Mask out unavailable actions
         target_mac_out[avail_actions[:, :] == 0] = -9999999  # From OG deepmarl
@@ -128,12 +116,14 @@ class QLearner:
         loss = td_loss + self.args.opt_loss * opt_loss + self.args.nopt_min_loss * nopt_loss
 
         # Optimise
-        self.optimiser.zero_grad()
+        self.param_group.zero_grad()
         loss.backward()
-        grad_norm = th.nn.utils.clip_grad_norm_(self.params, self.args.grad_norm_clip)
+        grad_norm = self.param_group.clip_grad_norm(self.args.grad_norm_clip)
         self.optimiser.step()
 
-        if (episode_num - self.last_target_update_episode) / self.args.target_update_interval >= 1.0:
+        if self.args.target_update_tau > 0:
+            self.target_param_group.lerp_(self.param_group, self.args.target_update_tau)
+        elif (episode_num - self.last_target_update_episode) / self.args.target_update_interval >= 1.0:
             self._update_targets()
             self.last_target_update_episode = episode_num
 
@@ -153,9 +143,7 @@ class QLearner:
             self.log_stats_t = t_env
 
     def _update_targets(self):
-        self.target_mac.load_state(self.mac)
-        if self.mixer is not None:
-            self.target_mixer.load_state_dict(self.mixer.state_dict())
+        self.target_param_group.copy_(self.param_group)
         self.logger.console_logger.info("Updated target network")
 
     def cuda(self):
@@ -164,6 +152,8 @@ class QLearner:
         if self.mixer is not None:
             self.mixer.cuda()
             self.target_mixer.cuda()
+        self.param_group.flatten()
+        self.target_param_group.flatten()
 
     def save_models(self, path):
         self.mac.save_models(path)
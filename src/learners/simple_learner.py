@@ -224,12 +224,13 @@ class SimPLeLearner:
 
         n = len(indices)
         n_test = max(1, int(test_ratio * n))
-        train_indices = range(n - n_test)
-        test_indices = range(len(train_indices), n)
+        train_indices = indices[:n - n_test]
+        test_indices = indices[n - n_test:]
 
         return train_indices, test_indices
 
     def get_episode_vars(self, ep):
+        # Builds the model training tensors for a whole batch of episodes at once, without modifying ep
 
         # per-agent quantities
         obs = ep["obs"][:, :-1, ...]  # observations
@@ -250,29 +251,32 @@ class SimPLeLearner:
         # reward
         reward = ep["reward"][:, :-1, :]
 
-        # termination signal
-        terminated = ep["terminated"][:, :-1].float()
-        term_idx = torch.squeeze(terminated).max(0)[1].item()
-        term_signal = torch.ones_like(terminated)
-        term_signal[:, :term_idx, :] = 0
+        # termination signal, term_idx is the first terminated timestep of each episode (0 if there is none)
+        terminated = ep["terminated"][:, :-1, 0]
+        term_idx = terminated.argmax(1).unsqueeze(1)
+        timesteps = torch.arange(ntimesteps, device=terminated.device).unsqueeze(0)
+        term_signal = (timesteps >= term_idx).float().unsqueeze(-1)
 
         # mask for active timesteps (except for term_signal which is always valid)
-        mask = torch.ones_like(terminated)
-        mask[:, term_idx + 1:, :] = 0
+        mask = (timesteps <= term_idx).float().unsqueeze(-1)
 
-        obs *= mask
-        aa *= mask
-        action *= mask
-        reward *= mask
-        state *= mask
+        obs = obs * mask
+        aa = aa * mask
+        action = action * mask
+        reward = reward * mask
+        state = state * mask
 
         return state, action, reward, term_signal, obs, aa, mask
 
+    def n_episodes(self, episodes):
+        return episodes[0].size(0)
+
     def get_batch(self, episodes, batch_size, use_mask=False):
-        # TOOD: refactor to use list of ids passed to replay buffer
-        bs = min(batch_size, len(episodes))
-        batch = random.sample(episodes, bs)
-        props = [torch.cat(t) for t in zip(*batch)]
+        # draw a random minibatch from the episode tensors by index
+        n = self.n_episodes(episodes)
+        bs = min(batch_size, n)
+        ids = torch.randperm(n)[:bs].to(episodes[0].device)
+        props = [x.index_select(0, ids) for x in episodes]
         if use_mask:
             mask = props[-1]
             idx = int(mask.sum(1).max().item())
@@ -298,11 +302,16 @@ class SimPLeLearner:
         bs, steps, state_size = state.size()
         if not ht_ct:
             ht_ct = self.state_model.init_hidden(bs, self.device)
+
+        # without autoregressive feedback the whole sequence can be run at once
+        if use_true_state:
+            return self.state_model.forward_seq(torch.cat((state, action), dim=-1), ht_ct)
+
         yp = torch.zeros(bs, steps, self.state_model_output_size).to(self.device)
 
         for t in range(0, steps):
 
-            if t == 0 or use_true_state:
+            if t == 0:
                 st = state[:, t, :]
             else:
                 st = yt[:, :state_size]
@@ -328,7 +337,7 @@ class SimPLeLearner:
         # model learning parameters        
         grad_clip = self.args.state_model_grad_clip_norm
         batch_size = self.args.state_model_train_batch_size
-        batch_size = min(batch_size, len(test_episodes))        
+        batch_size = min(batch_size, self.n_episodes(test_episodes))
         epochs = self.args.state_model_train_epochs if self.initial_state_model_trained else self.args.state_model_initial_train_epochs
         log_epochs = self.args.state_model_train_log_epochs
         use_mask = False # learning a termination signal is easier with unmasked input
@@ -402,14 +411,8 @@ class SimPLeLearner:
         bs, steps, state_size = state.size()
         if not ht_ct:
             ht_ct = self.obs_model.init_hidden(bs, self.device)
-        yp = torch.zeros(bs, steps, self.obs_model_output_size).to(self.device)
-
-        for t in range(0, steps):
-            xt = state[:, t, :]
-            yt, ht_ct = self.obs_model(xt, ht_ct)
-            yp[:, t, :] = yt
 
-        return yp, ht_ct
+        return self.obs_model.forward_seq(state, ht_ct)
 
     def train_obs_model(self, train_episodes, test_episodes):
         # observation model training
@@ -424,7 +427,7 @@ class SimPLeLearner:
         # model learning parameters
         grad_clip = self.args.obs_model_grad_clip_norm
         batch_size = self.args.obs_model_train_batch_size
-        batch_size = min(batch_size, len(test_episodes))
+        batch_size = min(batch_size, self.n_episodes(test_episodes))
         epochs = self.args.obs_model_train_epochs if self.initial_obs_model_trained else self.args.obs_model_initial_train_epochs
         log_epochs = self.args.obs_model_train_log_epochs
         use_mask = self.args.obs_model_use_mask
@@ -502,7 +505,7 @@ class SimPLeLearner:
     def plot_state_model(self, test_episodes, plot_dir):
 
         batch_size = self.args.state_model_train_batch_size
-        batch_size = min(batch_size, len(test_episodes))
+        batch_size = min(batch_size, self.n_episodes(test_episodes))
 
         # get state model results
         self.state_model.eval()
@@ -536,7 +539,7 @@ class SimPLeLearner:
     def plot_obs_model(self, test_episodes, plot_dir):
 
         batch_size = self.args.state_model_train_batch_size
-        batch_size = min(batch_size, len(test_episodes))
+        batch_size = min(batch_size, self.n_episodes(test_episodes))
 
         # get obs model results
         self.state_model.eval()
@@ -577,12 +580,17 @@ class SimPLeLearner:
         print(f"Training with {buffer.episodes_in_buffer} episodes")
 
         # generate training and test episode indices
-        indices = list(range(0, buffer.episodes_in_buffer))
+        ep_ids = buffer.stored_episode_ids()
+        indices = list(range(0, len(ep_ids)))
         train_indices, test_indices = self.train_test_split(indices, test_ratio=self.args.model_training_test_ratio, shuffle=True)
 
-        # extract episodes
-        train_episodes = [self.get_episode_vars(buffer[i]) for i in train_indices]
-        test_episodes = [self.get_episode_vars(buffer[i]) for i in train_indices]
+        # extract episodes as (episodes, timesteps, features) tensors straight from buffer storage
+        episodes = self.get_episode_vars(buffer.gather_episodes(ep_ids))
+        device = episodes[0].device
+        train_indices = torch.tensor(train_indices, device=device)
+        test_indices = torch.tensor(test_indices, device=device)
+        train_episodes = [x.index_select(0, train_indices) for x in episodes]
+        test_episodes = [x.index_select(0, test_indices) for x in episodes]
 
         self.state_model_train_loss, self.state_model_val_loss = self.train_state_model(train_episodes, test_episodes)
         self.obs_model_train_loss, self.obs_model_val_loss = self.train_obs_model(train_episodes, test_episodes)
@@ -598,87 +606,57 @@ class SimPLeLearner:
         self.obs_model.eval()
 
         with torch.no_grad():
-            # sample real starts from the replay buffer
-            episodes = buffer.sample(batch_size)
-            #self.logger.console_logger.info(f"Generating {batch_size} model based episodes")
+            # sample real starting timesteps from the replay buffer, with replacement if asked for more than it holds
+            stored = buffer.stored_episode_ids()
+            n = len(stored)
+            if batch_size > n:
+                ep_ids = stored[torch.randint(n, (batch_size,))]
+            else:
+                ep_ids = stored[torch.randperm(n)[:batch_size]]
+            first_steps = buffer.gather_episodes(ep_ids, max_t=1)
+            starts = {k: first_steps[k][:, 0].to(self.device) for k in ["state", "obs", "avail_actions", "terminated"]}
 
-            # create new episode batch for generated episodes
+            # create new episode batch for generated episodes, which is written to in place below
             scheme = buffer.scheme.copy()
             scheme.pop("filled", None)  # buffer scheme excluding filled key
-            batch = partial(EpisodeBatch, scheme, buffer.groups, batch_size, buffer.max_seq_length,
-                            preprocess=buffer.preprocess, device=self.device)()
+            batch = EpisodeBatch(scheme, buffer.groups, batch_size, buffer.max_seq_length,
+                                 preprocess=buffer.preprocess, device=self.device)
 
             # get real starting states for the batch
-            state = episodes["state"][:, 0, :self.state_size].unsqueeze(1).to(self.device)
-            obs = episodes["obs"][:, 0].unsqueeze(1).to(self.device)
-            avail_actions = episodes["avail_actions"][:, 0].unsqueeze(1).to(self.device)
-            actions_onehot = torch.zeros_like(episodes["actions_onehot"][:, 0].view(batch_size, 1, -1)).to(self.device)
-            term_signal = episodes["terminated"][:, 0].unsqueeze(1).float().to(self.device)
-            terminated = (term_signal > 0)
-            active_episodes = [i for i, finished in enumerate(terminated.flatten()) if not finished]
+            state = starts["state"][:, :self.state_size]
+            obs = starts["obs"]
+            avail_actions = starts["avail_actions"]
+            actions_onehot = torch.zeros(batch_size, self.action_size, device=self.device)
+            active = starts["terminated"][:, 0] == 0  # episodes still being generated
 
             obs_size = self.args.n_agents * self.agent_obs_size
 
             # initialise hidden states
-            o_ht_ct = None # obs model hidden states
-            s_ht_ct = None # state model hidden states
+            o_ht_ct = self.obs_model.init_hidden(batch_size, self.device)  # obs model hidden states
+            s_ht_ct = self.state_model.init_hidden(batch_size, self.device)  # state model hidden states
             self.mac.init_hidden(batch_size=batch_size)
 
-            bidx = 0
             max_t = batch.max_seq_length - 1
+            batch_state = state
+            if self.args.env_args["state_last_action"]:
+                batch_state = torch.cat((state, actions_onehot), dim=-1)
+            self._write_active(batch, 0, active, {"state": batch_state, "avail_actions": avail_actions, "obs": obs})
+
             # generate episode sequence
-            print(f"Collecting {self.args.model_rollout_batch_size} episodes from MODEL ENV using epsilon: {self.mac.action_selector.epsilon:.2f}, model_episodes: {self.model_episodes}")
+            print(f"Collecting {batch_size} episodes from MODEL ENV using epsilon: {self.mac.action_selector.epsilon:.2f}, model_episodes: {self.model_episodes}")
             for t in range(max_t):
 
-                # print(f"[{t:01}] active_episodes")
-                # print("   ", active_episodes)
-                #
-                # print(f"[{t:01}] state (excluding action)")
-                # print("   ", state[bidx])
-                #
-                # print(f"[{t:01}] obs")
-                # print("   ", obs[bidx])
-                #
-                # print(f"[{t:01}] avail_actions")
-                # print("   ", avail_actions[bidx])
-
-                #aa = avail_actions
-                # for i in range(aa.size()[0]):
-                #     try:
-                #         a = Categorical(aa[i].float()).sample()
-                #     except:
-                #         print(f"invalid avail actions on batch index {i} at timestep {t:01}")
-                #         print(aa[i])
-                #         for k, v in self.get_state_scheme(custom_features=False).items():
-                #             print(f"{k}: {state[i, :, v].item():.4f}")
-
-                batch_state = state
-                if self.args.env_args["state_last_action"]:
-                    batch_state = torch.cat((state, actions_onehot), dim=-1)
-
-                pre_transition_data = {
-                    "state": batch_state[active_episodes],
-                    "avail_actions": avail_actions[active_episodes],
-                    "obs": obs[active_episodes]
-                }
-                batch.update(pre_transition_data, bs=active_episodes, ts=t)
-
-                # choose actions following current policy
-                actions = self.mac.select_actions(batch, t_ep=t, t_env=t_env, bs=active_episodes, model_action=True).unsqueeze(1)
-                # print(f"[{t:01}] actions")
-                # print("   ", actions[bidx])
-
-                batch.update({"actions": actions}, bs=active_episodes, ts=t)  # this will generate actions_onehot
-                actions_onehot = batch["actions_onehot"][:, t, ...].view(batch_size, 1, -1)  # latest action
-
-                # print(f"[{t:01}] actions_onehot")
-                # print("   ", actions_onehot[bidx])
+                # choose actions following current policy, only active episodes have available actions to choose from
+                actions = torch.zeros(batch_size, self.args.n_agents, dtype=torch.long, device=self.device)
+                actions[active] = self.mac.select_actions(batch, t_ep=t, t_env=t_env, bs=active, model_action=True)
+                self._write_active(batch, t, active, {"actions": actions.unsqueeze(-1)})  # this will generate actions_onehot
+                actions_onehot = batch["actions_onehot"][:, t].reshape(batch_size, -1)  # latest action
 
                 # generate next state, reward and termination signal
-                output, s_ht_ct = self.run_state_model(state, actions_onehot, ht_ct=s_ht_ct)
-                state = output[:, :, :self.state_size]; idx = self.state_size
-                reward = output[:, :, idx:idx + self.reward_size]; idx += self.reward_size
-                term_signal = output[:, :, idx:idx + self.term_size]
+                output, s_ht_ct = self.state_model(torch.cat((state, actions_onehot), dim=-1), s_ht_ct)
+                state = output[:, :self.state_size]; idx = self.state_size
+                reward = output[:, idx:idx + self.reward_size]; idx += self.reward_size
+                term_signal = output[:, idx:idx + self.term_size]
 
                 # generate termination mask
                 threshold = 0.9
@@ -686,51 +664,52 @@ class SimPLeLearner:
 
                 # if this is the last timestep, terminate
                 if t == max_t - 1:
-                    terminated[active_episodes] = True
-
-                # print(f"[{t:01}] terminated")
-                # print("   ", terminated.flatten())
+                    terminated |= active.unsqueeze(-1)
 
-                post_transition_data = {
-                    "reward": reward[active_episodes],
-                    "terminated": terminated[active_episodes]
-                }
-                batch.update(post_transition_data, ts=t, bs=active_episodes)
+                self._write_active(batch, t, active, {"reward": reward, "terminated": terminated})
 
                 # generate new observations
-                output, o_ht_ct = self.run_obs_model(state.to(self.device), ht_ct=o_ht_ct)
-                obs = output[:, 0, :obs_size].view(batch_size, 1, self.args.n_agents, self.agent_obs_size)
-                avail_actions = output[:, 0, obs_size:].view(batch_size, 1, self.args.n_agents, self.args.n_actions)
+                output, o_ht_ct = self.obs_model(state, o_ht_ct)
+                obs = output[:, :obs_size].view(batch_size, self.args.n_agents, self.agent_obs_size)
+                avail_actions = output[:, obs_size:].view(batch_size, self.args.n_agents, self.args.n_actions)
 
                 # threshold avail_actions
                 threshold = 0.5
                 avail_actions = (avail_actions > threshold).float()
 
-                # handle cases where no agent actions are available e.g. when agent is dead
-                mask = avail_actions.sum(-1) == 0
-                source = torch.zeros_like(avail_actions)
-                source[:, :, :, 0] = 1  # enable no-op
-                avail_actions[mask] = source[mask]
+                # handle cases where no agent actions are available e.g. when agent is dead, by enabling no-op
+                avail_actions[:, :, 0] += (avail_actions.sum(-1) == 0).float()
 
-                # add pre-tranition data to the batch at the next timestep
-                pre_transition_data = {
-                    "state": batch_state[active_episodes],
-                    "avail_actions": avail_actions[active_episodes],
-                    "obs": obs[active_episodes]
-                }
-                batch.update(pre_transition_data, bs=active_episodes, ts=t+1)
+                # add pre-transition data to the batch at the next timestep
+                batch_state = state
+                if self.args.env_args["state_last_action"]:
+                    batch_state = torch.cat((state, actions_onehot), dim=-1)
+                self._write_active(batch, t + 1, active, {"state": batch_state, "avail_actions": avail_actions, "obs": obs})
 
                 # update active episodes
-                active_episodes = [i for i, finished in enumerate(terminated.flatten()) if not finished]
-                if all(terminated):
+                active &= ~terminated.squeeze(-1)
+                if not active.any():
                     break
 
-                #print("\n=================================================\n")
-
-            self.model_episodes += self.args.model_rollout_batch_size
+            self.model_episodes += batch_size
 
             return batch
 
+    def _write_active(self, batch, t, active, data):
+        # Masked in-place write of timestep t for the active episodes only (marking them filled), including preprocessing
+        transition_data = batch.data.transition_data
+        data = dict(data, filled=torch.ones(batch.batch_size, 1, device=self.device))
+        for k in list(data):
+            if k in batch.preprocess:
+                v = data[k].to(batch.scheme[k].get("dtype", torch.float32))
+                for transform in batch.preprocess[k][1]:
+                    v = transform.transform(v)
+                data[batch.preprocess[k][0]] = v
+        for k, v in data.items():
+            target = transition_data[k][:, t]
+            mask = active.view(-1, *([1] * (target.dim() - 1)))
+            target.copy_(torch.where(mask, v.to(target.dtype).view_as(target), target))
+
     def plot_episode(self, batch,  plot_dir="plots"):
         state_scheme = self.get_state_scheme(custom_features=True)
         obs_scheme = self.get_obs_scheme()
@@ -1,3 +1,4 @@
+import torch as th
 import torch.nn as nn
 import torch.nn.functional as F
 
@@ -21,3 +22,16 @@ class RNNAgent(nn.Module):
         h = self.rnn(x, h_in)
         q = self.fc2(h)
         return q, h
+
+    def forward_seq(self, inputs, hidden_state):
+        # inputs is (time, batch, features). The feed-forward layers run on all timesteps at once and
+        # only the GRU is stepped, giving the same outputs as calling forward once per timestep.
+        x = F.relu(self.fc1(inputs))
+        h = hidden_state.reshape(-1, self.args.rnn_hidden_dim)
+        hs = []
+        for xt in x.unbind(0):
+            h = self.rnn(xt, h)
+            hs.append(h)
+        hs = th.stack(hs, dim=0)
+        q = self.fc2(hs)
+        return q, hs
@@ -14,49 +14,49 @@ class COMACritic(nn.Module):
         input_shape = self._get_input_shape(scheme)
         self.output_type = "q"
 
+        # Widths of the state, obs, actions, last actions and agent id blocks of the inputs
+        self.input_sizes = [scheme["state"]["vshape"], scheme["obs"]["vshape"], self.n_actions * self.n_agents,
+                            self.n_actions * self.n_agents, self.n_agents]
+
         # Set up network layers
         self.fc1 = nn.Linear(input_shape, 128)
         self.fc2 = nn.Linear(128, 128)
         self.fc3 = nn.Linear(128, self.n_actions)
 
     def forward(self, batch, t=None):
-        inputs = self._build_inputs(batch, t=t)
-        x = F.relu(self.fc1(inputs))
-        x = F.relu(self.fc2(x))
-        q = self.fc3(x)
-        return q
-
-    def _build_inputs(self, batch, t=None):
+        # t is a timestep, a slice of timesteps or None for all of them
         bs = batch.batch_size
-        max_t = batch.max_seq_length if t is None else 1
-        ts = slice(None) if t is None else slice(t, t+1)
-        inputs = []
-        # state
-        inputs.append(batch["state"][:, ts].unsqueeze(2).repeat(1, 1, self.n_agents, 1))
+        if t is None:
+            ts = slice(None)
+        elif isinstance(t, int):
+            ts = slice(t, t+1)
+        else:
+            ts = t
+        start, stop, _ = ts.indices(batch.max_seq_length)
+        max_t = stop - start
 
-        # observation
-        inputs.append(batch["obs"][:, ts])
+        # fc1 is applied to each input block separately, so the state and joint actions shared by all agents are
+        # projected once and broadcast, rather than repeated per agent (which made the inputs grow as n_agents^2)
+        w_state, w_obs, w_actions, w_last_actions, w_agent_id = th.split(self.fc1.weight, self.input_sizes, dim=1)
 
-        # actions (masked out by agent)
-        actions = batch["actions_onehot"][:, ts].view(bs, max_t, 1, -1).repeat(1, 1, self.n_agents, 1)
-        agent_mask = (1 - th.eye(self.n_agents, device=batch.device))
-        agent_mask = agent_mask.view(-1, 1).repeat(1, self.n_actions).view(self.n_agents, -1)
-        inputs.append(actions * agent_mask.unsqueeze(0).unsqueeze(0))
+        actions = batch["actions_onehot"][:, ts]
+        last_actions = batch["actions_onehot"][:, max(start - 1, 0):stop - 1]
+        if start == 0:
+            last_actions = th.cat([th.zeros_like(batch["actions_onehot"][:, 0:1]), last_actions], dim=1)
 
-        # last actions
-        if t == 0:
-            inputs.append(th.zeros_like(batch["actions_onehot"][:, 0:1]).view(bs, max_t, 1, -1).repeat(1, 1, self.n_agents, 1))
-        elif isinstance(t, int):
-            inputs.append(batch["actions_onehot"][:, slice(t-1, t)].view(bs, max_t, 1, -1).repeat(1, 1, self.n_agents, 1))
-        else:
-            last_actions = th.cat([th.zeros_like(batch["actions_onehot"][:, 0:1]), batch["actions_onehot"][:, :-1]], dim=1)
-            last_actions = last_actions.view(bs, max_t, 1, -1).repeat(1, 1, self.n_agents, 1)
-            inputs.append(last_actions)
+        x = F.linear(batch["state"][:, ts], w_state, self.fc1.bias)
+        x = x + F.linear(actions.reshape(bs, max_t, -1), w_actions)
+        x = x + F.linear(last_actions.reshape(bs, max_t, -1), w_last_actions)
+        x = x.unsqueeze(2) + F.linear(batch["obs"][:, ts], w_obs)
 
-        inputs.append(th.eye(self.n_agents, device=batch.device).unsqueeze(0).unsqueeze(0).expand(bs, max_t, -1, -1))
+        # Each agent's own action is masked out of its joint actions, and its one-hot id selects a column
+        own_actions = th.einsum("btan,han->btah", actions, w_actions.view(-1, self.n_agents, self.n_actions))
+        x = x - own_actions + w_agent_id.t()
 
-        inputs = th.cat([x.reshape(bs, max_t, self.n_agents, -1) for x in inputs], dim=-1)
-        return inputs
+        x = F.relu(x)
+        x = F.relu(self.fc2(x))
+        q = self.fc3(x)
+        return q
 
     def _get_input_shape(self, scheme):
         # state
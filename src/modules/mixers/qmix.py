@@ -39,22 +39,42 @@ class QMixer(nn.Module):
                                nn.Linear(self.embed_dim, 1))
 
     def forward(self, agent_qs, states):
-        bs = agent_qs.size(0)
+        return self.mix(agent_qs, self.hypernet(states))
+
+    def hypernet(self, states):
+        # Evaluates the hypernetworks on B*T states, with the layers applied to the states stacked into one matmul
         states = states.reshape(-1, self.state_dim)
-        agent_qs = agent_qs.view(-1, 1, self.n_agents)
-        # First layer
-        w1 = th.abs(self.hyper_w_1(states))
-        b1 = self.hyper_b_1(states)
-        w1 = w1.view(-1, self.n_agents, self.embed_dim)
+        layers = self._state_layers()
+        weight = th.cat([layer.weight for layer in layers], dim=0)
+        bias = th.cat([layer.bias for layer in layers], dim=0)
+        w1, w_final, b1, v = F.linear(states, weight, bias).split([layer.out_features for layer in layers], dim=-1)
+
+        # Hypernetworks with 2 layers continue from their first layer
+        if isinstance(self.hyper_w_1, nn.Sequential):
+            w1 = self.hyper_w_1[1:](w1)
+            w_final = self.hyper_w_final[1:](w_final)
+        v = self.V[1:](v)
+
+        w1 = th.abs(w1).view(-1, self.n_agents, self.embed_dim)
         b1 = b1.view(-1, 1, self.embed_dim)
+        w_final = th.abs(w_final).view(-1, self.embed_dim, 1)
+        v = v.view(-1, 1, 1)
+        return w1, b1, w_final, v
+
+    def mix(self, agent_qs, hyper):
+        # Mixes B*T*n_agents agent_qs with the hypernetwork outputs for B*T states
+        bs = agent_qs.size(0)
+        w1, b1, w_final, v = hyper
+        agent_qs = agent_qs.reshape(-1, 1, self.n_agents)
+        # First layer
         hidden = F.elu(th.bmm(agent_qs, w1) + b1)
-        # Second layer
-        w_final = th.abs(self.hyper_w_final(states))
-        w_final = w_final.view(-1, self.embed_dim, 1)
-        # State-dependent bias
-        v = self.V(states).view(-1, 1, 1)
-        # Compute final output
+        # Second layer, with the state-dependent bias
         y = th.bmm(hidden, w_final) + v
         # Reshape and return
         q_tot = y.view(bs, -1, 1)
         return q_tot
+
+    def _state_layers(self):
+        # The first layer of each hypernetwork, in the order of the hypernetwork outputs
+        first = lambda m: m[0] if isinstance(m, nn.Sequential) else m
+        return [first(self.hyper_w_1), first(self.hyper_w_final), self.hyper_b_1, self.V[0]]
@@ -1,3 +1,4 @@
+import copy
 import datetime
 import os
 import pprint
@@ -7,12 +8,15 @@ import torch as th
 from types import SimpleNamespace as SN
 from utils.logging import Logger
 from utils.timehelper import time_left, time_str
+from utils.profiling import PhaseTimer, ProfilerWindow
 from os.path import dirname, abspath
 
 from learners import REGISTRY as le_REGISTRY
 from runners import REGISTRY as r_REGISTRY
+from runners.async_collector import AsyncCollector
 from controllers import REGISTRY as mac_REGISTRY
-from components.episode_buffer import ReplayBuffer
+from components.episode_buffer import ReplayBuffer, PackedReplayBuffer, PrioritizedReplayBuffer, compact_storage_scheme
+from components.prefetcher import BatchPrefetcher
 from components.transforms import OneHot
 
 import pickle
@@ -70,6 +74,7 @@ def evaluate_sequential(args, runner, buffer):
         episode_batch = runner.run(test_mode=True)
         if args.save_episodes:
             buffer.insert_episode_batch(episode_batch)
+    buffer.close()
 
     if args.save_replay:
         runner.save_replay()
@@ -101,12 +106,18 @@ def run_sequential(args, logger):
         "agents": args.n_agents
     }
     preprocess = {
-        "actions": ("actions_onehot", [OneHot(out_dim=args.n_actions)])
+        "actions": ("actions_onehot", [OneHot(out_dim=args.n_actions, lazy=args.lazy_preprocess)])
     }
 
-    buffer = ReplayBuffer(scheme, groups, args.buffer_size, env_info["episode_limit"] + 1,
-                          preprocess=preprocess,
-                          device="cpu" if args.buffer_cpu_only else args.device,
+    # Replay buffers may store fields in smaller dtypes than they are used in, uint8 action indices need < 256 actions
+    buffer_scheme = scheme
+    if args.buffer_compact_storage or args.buffer_float16_obs:
+        buffer_scheme = compact_storage_scheme(scheme, preprocess,
+                                               uint8=args.buffer_compact_storage and args.n_actions < 256,
+                                               float16_keys=["obs", "state"] if args.buffer_float16_obs else [])
+
+    buffer = build_buffer(args, buffer_scheme, groups, args.buffer_size, env_info["episode_limit"] + 1, preprocess,
+                          prioritized=args.prioritized_buffer,
                           save_episodes=True if args.save_episodes else False,
                           episode_dir=args.episode_dir,
                           clear_existing_episodes=args.clear_existing_episodes)  # TODO maybe just pass args
@@ -125,9 +136,8 @@ def run_sequential(args, logger):
     model_buffer = None
     if args.model_learner:
         model_learner = le_REGISTRY[args.model_learner](mac, scheme, logger, args)
-        model_buffer = ReplayBuffer(scheme, groups, args.model_buffer_size, buffer.max_seq_length,
-                                    preprocess=preprocess,
-                                    device="cpu" if args.buffer_cpu_only else args.device,
+        model_buffer = build_buffer(args, buffer_scheme, groups, args.model_buffer_size, buffer.max_seq_length, preprocess,
+                                    prioritized=args.model_prioritized_buffer,
                                     save_episodes=False)
 
     if args.use_cuda:
@@ -190,6 +200,18 @@ def run_sequential(args, logger):
 
         # TODO checkpoints for model_learner
 
+    if args.async_learner:
+        run_async(args, logger, runner, buffer, mac, learner)
+        return
+
+    # Batches for the learner are sampled ahead of it from the buffer it trains on
+    prefetcher = build_prefetcher(args, model_buffer if model_learner else buffer)
+    sampler_wait_times = []
+
+    # Time spent in each phase of the training loop, and an optional profile of some of its iterations
+    timer = PhaseTimer(args.phase_timers, cuda_sync=args.phase_timers_cuda_sync)
+    profiler = build_profiler(args, [timer, getattr(runner, "timer", None)])
+
     # start training
     episode = 0
     last_test_T = -args.test_interval - 1
@@ -214,9 +236,11 @@ def run_sequential(args, logger):
 
         if model_learner:
             if collect_episodes:
-                episode_batch = runner.run(test_mode=False)  # collect real episode to progress t_env
+                with timer.phase("collect"):
+                    episode_batch = runner.run(test_mode=False)  # collect real episode to progress t_env
                 print(f"Collecting {args.batch_size_run} episodes from REAL ENV using epsilon: {runner.mac.env_action_selector.epsilon:.2f}, t_env: {runner.t_env}, collected episodes: {collected_episodes}")
-                buffer.insert_episode_batch(episode_batch)
+                with timer.phase("insert"):
+                    buffer.insert_episode_batch(episode_batch)
                 collected_episodes += args.batch_size_run
 
             n_collect = args.model_n_collect_episodes if model_trained else args.model_n_collect_episodes_initial
@@ -225,7 +249,8 @@ def run_sequential(args, logger):
                 # stop collection and train model
                 collect_episodes = False
                 collected_episodes = 0
-                model_learner.train(buffer, runner.t_env, plot_test_results=False)
+                with timer.phase("model_train"):
+                    model_learner.train(buffer, runner.t_env, plot_test_results=False)
                 model_trained = True
                 n_model_trained += 1
                 train_rl = True
@@ -233,10 +258,12 @@ def run_sequential(args, logger):
                 if args.model_rollout_before_rl:
                     print(f"Generating {args.model_rollouts} MODEL episodes")
                     rollouts = 0
-                    rollout_batch_size = min(buffer.episodes_in_buffer, args.model_rollout_batch_size)
+                    rollout_batch_size = args.model_rollout_batch_size
                     while rollouts < args.model_rollouts:
-                        model_batch = model_learner.generate_batch(buffer, rollout_batch_size, rl_iterations)
-                        model_buffer.insert_episode_batch(model_batch)
+                        with timer.phase("model_rollout"):
+                            model_batch = model_learner.generate_batch(buffer, rollout_batch_size, rl_iterations)
+                        with timer.phase("insert"):
+                            insert_episode_batch(model_buffer, prefetcher, model_batch)
                         rollouts += rollout_batch_size
 
             if train_rl: # and model_buffer.can_sample(args.batch_size):
@@ -244,23 +271,17 @@ def run_sequential(args, logger):
                 # generate synthetic episodes under current policy
                 if not args.model_rollout_before_rl:
                     print(f"Generating {args.model_rollouts} MODEL episodes")
-                    rollout_batch_size = min(buffer.episodes_in_buffer, args.model_rollout_batch_size)
-                    model_batch = model_learner.generate_batch(buffer, rollout_batch_size, rl_iterations)
-                    model_buffer.insert_episode_batch(model_batch)
+                    rollout_batch_size = args.model_rollout_batch_size
+                    with timer.phase("model_rollout"):
+                        model_batch = model_learner.generate_batch(buffer, rollout_batch_size, rl_iterations)
+                    with timer.phase("insert"):
+                        insert_episode_batch(model_buffer, prefetcher, model_batch)
 
                 if model_buffer.can_sample(args.batch_size):
                     for _ in range(args.model_rl_iterations_per_generated_sample):
-                        episode_sample = model_buffer.sample(args.batch_size)
-
-                        # truncate batch to only filled timesteps
-                        max_ep_t = episode_sample.max_t_filled()
-                        episode_sample = episode_sample[:, :max_ep_t]
-
-                        if episode_sample.device != args.device:
-                            episode_sample.to(args.device)
-
                         # train RL agent
-                        learner.train(episode_sample, runner.t_env, rl_iterations)
+                        sampler_wait_times.append(train_from_buffer(args, model_buffer, learner, runner.t_env,
+                                                                    rl_iterations, prefetcher, timer))
                         rl_iterations += 1
                         print(f"Model RL iteration {rl_iterations}, t_env: {runner.t_env}")
 
@@ -279,22 +300,15 @@ def run_sequential(args, logger):
                 model_learner.log_rl_stats(rl_iterations)
 
         else:
-            episode_batch = runner.run(test_mode=False)
-            buffer.insert_episode_batch(episode_batch)
+            with timer.phase("collect"):
+                episode_batch = runner.run(test_mode=False)
+            with timer.phase("insert"):
+                insert_episode_batch(buffer, prefetcher, episode_batch)
             if args.save_episodes and args.save_policy_outputs and args.runner == "episode":
                 mac.save_policy_outputs()
             if buffer.can_sample(args.batch_size):
                 for _ in range(args.batch_size_run):
-                    episode_sample = buffer.sample(args.batch_size)
-
-                    # Truncate batch to only filled timesteps
-                    max_ep_t = episode_sample.max_t_filled()
-                    episode_sample = episode_sample[:, :max_ep_t]
-
-                    if episode_sample.device != args.device:
-                        episode_sample.to(args.device)
-
-                    learner.train(episode_sample, runner.t_env, episode)
+                    sampler_wait_times.append(train_from_buffer(args, buffer, learner, runner.t_env, episode, prefetcher, timer))
                     rl_iterations += 1
                     print(f"RL iteration {rl_iterations}, t_env: {runner.t_env}")
 
@@ -313,8 +327,9 @@ def run_sequential(args, logger):
             last_rl_T = rl_iterations
             runner.t_rl = rl_iterations
 
-            for _ in range(n_test_runs):
-                runner.run(test_mode=True)
+            with timer.phase("test"):
+                for _ in range(n_test_runs):
+                    runner.run(test_mode=True)
 
             logger.print_recent_stats()
 
@@ -327,7 +342,8 @@ def run_sequential(args, logger):
 
             # learner should handle saving/loading -- delegate actor save/load to mac,
             # use appropriate filenames to do critics, optimizer states
-            learner.save_models(save_path)
+            with timer.phase("save"):
+                learner.save_models(save_path)
 
         if args.save_model and model_trained and (rl_iterations == 0 or (rl_iterations - rl_model_save_time)/args.rl_save_model_interval >= 1.0):
             print(f"Saving at RL model iteration {rl_iterations}")
@@ -339,19 +355,184 @@ def run_sequential(args, logger):
 
             # learner should handle saving/loading -- delegate actor save/load to mac,
             # use appropriate filenames to do critics, optimizer states
-            learner.save_models(save_path)
+            with timer.phase("save"):
+                learner.save_models(save_path)
 
         episode += args.batch_size_run
+        if profiler is not None:
+            profiler.step()
 
         if (runner.t_env - last_log_T) >= args.log_interval:
             logger.log_stat("rl_iterations", rl_iterations, runner.t_env)
             logger.log_stat("episode", episode, runner.t_env)
+            if sampler_wait_times:
+                logger.log_stat("sampler_wait_time", sum(sampler_wait_times) / len(sampler_wait_times), runner.t_env)
+                sampler_wait_times = []
+            timer.log(logger, runner.t_env)
+            logger.print_recent_stats()
+            last_log_T = runner.t_env
+
+    if profiler is not None:
+        profiler.close()
+    if prefetcher is not None:
+        prefetcher.close()
+    buffer.close()
+    if model_buffer is not None:
+        model_buffer.close()
+    if args.save_episodes and args.save_policy_outputs:
+        mac.close_policy_store()
+    runner.close_env()
+    logger.console_logger.info("Finished Training")
+
+def run_async(args, logger, runner, buffer, mac, learner):
+    # Rollouts are collected in a background thread with their own copy of the agents, while
+    # the learner trains continuously and publishes its parameters every async_param_sync_interval steps
+    runner.mac = copy.deepcopy(mac)
+    collector = AsyncCollector(runner, args, logger)
+    prefetcher = build_prefetcher(args, buffer)
+    timer = PhaseTimer(args.phase_timers, cuda_sync=args.phase_timers_cuda_sync)
+    profiler = build_profiler(args, [timer])
+
+    episode = 0
+    learner_steps = 0
+    last_log_T = 0
+    model_save_time = 0
+    policy_lags = []
+    queue_depths = []
+    sampler_wait_times = []
+    last_log_time = time.time()
+    last_log_env_T = runner.t_env
+    last_log_learner_steps = 0
+
+    logger.console_logger.info("Beginning asynchronous training for {} timesteps".format(args.t_max))
+    collector.start()
+    while runner.t_env <= args.t_max and collector.thread.is_alive():
+
+        # Move finished rollouts into the buffer, waiting for some only if there is nothing to train on yet
+        queue_depths.append(collector.queue.qsize())
+        items = collector.get_all()
+        if not items and not buffer.can_sample(args.batch_size):
+            with timer.phase("collect"):
+                item = collector.get(timeout=1.0)
+            items = [item] if item is not None else []
+        with timer.phase("insert"):
+            for episode_batch, param_version in items:
+                insert_episode_batch(buffer, prefetcher, episode_batch)
+                policy_lags.append(learner_steps - param_version)
+                episode += episode_batch.batch_size
+
+        if buffer.can_sample(args.batch_size):
+            runner.t_rl = learner_steps
+            sampler_wait_times.append(train_from_buffer(args, buffer, learner, runner.t_env, episode, prefetcher, timer))
+            learner_steps += 1
+            if learner_steps % args.async_param_sync_interval == 0:
+                with timer.phase("publish_params"):
+                    collector.publish_params(mac, learner_steps)
+
+        if args.save_model and (runner.t_env - model_save_time >= args.save_model_interval or model_save_time == 0):
+            model_save_time = runner.t_env
+            save_path = os.path.join(args.local_results_path, "models", args.unique_token, str(runner.t_env))
+            os.makedirs(save_path, exist_ok=True)
+            logger.console_logger.info("Saving models to {}".format(save_path))
+            with timer.phase("save"):
+                learner.save_models(save_path)
+        if profiler is not None:
+            profiler.step()
+
+        if (runner.t_env - last_log_T) >= args.log_interval:
+            elapsed = time.time() - last_log_time
+            logger.log_stat("env_steps_per_sec", (runner.t_env - last_log_env_T) / elapsed, runner.t_env)
+            logger.log_stat("learner_steps_per_sec", (learner_steps - last_log_learner_steps) / elapsed, runner.t_env)
+            if policy_lags:
+                logger.log_stat("policy_lag_mean", sum(policy_lags) / len(policy_lags), runner.t_env)
+                logger.log_stat("policy_lag_max", max(policy_lags), runner.t_env)
+            logger.log_stat("queue_depth_mean", sum(queue_depths) / len(queue_depths), runner.t_env)
+            if sampler_wait_times:
+                logger.log_stat("sampler_wait_time", sum(sampler_wait_times) / len(sampler_wait_times), runner.t_env)
+            logger.log_stat("rl_iterations", learner_steps, runner.t_env)
+            logger.log_stat("episode", episode, runner.t_env)
+            timer.log(logger, runner.t_env)
             logger.print_recent_stats()
+            policy_lags = []
+            queue_depths = []
+            sampler_wait_times = []
+            last_log_time = time.time()
+            last_log_env_T = runner.t_env
+            last_log_learner_steps = learner_steps
             last_log_T = runner.t_env
 
+    collector.stop()
+    if profiler is not None:
+        profiler.close()
+    if prefetcher is not None:
+        prefetcher.close()
+    buffer.close()
     runner.close_env()
+    if collector.error is not None:
+        raise collector.error
     logger.console_logger.info("Finished Training")
 
+def build_buffer(args, scheme, groups, buffer_size, max_seq_length, preprocess, prioritized=False, **kwargs):
+    device = "cpu" if args.buffer_cpu_only or args.buffer_storage == "mmap" else args.device
+    kwargs.update(storage=args.buffer_storage, storage_dir=args.buffer_storage_dir)
+    if prioritized:
+        return PrioritizedReplayBuffer(scheme, groups, buffer_size, max_seq_length,
+                                       alpha=args.per_alpha,
+                                       beta_start=args.per_beta,
+                                       beta_anneal_time=args.per_beta_anneal_time,
+                                       eps=args.per_eps,
+                                       preprocess=preprocess,
+                                       device=device,
+                                       **kwargs)
+    if args.buffer_packed:
+        return PackedReplayBuffer(scheme, groups, buffer_size, max_seq_length,
+                                  transition_capacity=args.buffer_packed_capacity,
+                                  preprocess=preprocess, device=device, **kwargs)
+    return ReplayBuffer(scheme, groups, buffer_size, max_seq_length, preprocess=preprocess, device=device, **kwargs)
+
+def train_from_buffer(args, buffer, learner, t_env, episode_num, prefetcher=None, timer=None):
+    # Returns the time spent waiting for the sampled batch to be ready on device
+    timer = timer or PhaseTimer(enabled=False)
+    start = time.time()
+    ep_ids, weights = None, None
+    with timer.phase("sample"):
+        if prefetcher is not None:
+            episode_sample, ep_ids, weights = prefetcher.get(t_env)
+        elif isinstance(buffer, PrioritizedReplayBuffer):
+            episode_sample, ep_ids, weights = buffer.sample_with_weights(args.batch_size, t_env)
+        else:
+            episode_sample = buffer.sample(args.batch_size)
+
+    # Samples are already truncated to their filled timesteps by the buffer
+    with timer.phase("to_device"):
+        if episode_sample.device != args.device:
+            episode_sample.to(args.device)
+    wait_time = time.time() - start
+
+    with timer.phase("train"):
+        if weights is None:
+            learner.train(episode_sample, t_env, episode_num)
+        else:
+            priorities = learner.train(episode_sample, t_env, episode_num, weights=weights.to(args.device))
+            (buffer if prefetcher is None else prefetcher).update_priorities(ep_ids, priorities)
+    return wait_time
+
+def build_prefetcher(args, buffer):
+    if args.prefetch_batches <= 0:
+        return None
+    return BatchPrefetcher(buffer, args.batch_size, args.prefetch_batches, args.device)
+
+def build_profiler(args, timers):
+    if args.profiler is None:
+        return None
+    out_dir = os.path.join(args.local_results_path, "profiles", args.unique_token)
+    return ProfilerWindow(args.profiler, args.profiler_start_iteration, args.profiler_iterations, out_dir,
+                          timers=[t for t in timers if t is not None])
+
+def insert_episode_batch(buffer, prefetcher, episode_batch):
+    # Inserts go through the prefetcher while it samples from the buffer
+    (buffer if prefetcher is None else prefetcher).insert_episode_batch(episode_batch)
+
 def save_buffer(buffer, filename, verbose=False):
     with open(filename, 'wb') as f:
         pickle.dump(buffer, f)
@@ -371,4 +552,16 @@ def args_sanity_check(config, _log):
     else:
         config["test_nepisode"] = (config["test_nepisode"]//config["batch_size_run"]) * config["batch_size_run"]
 
+    if config["async_learner"] and config["model_learner"]:
+        config["async_learner"] = False
+        _log.warning("Asynchronous training is not supported with a model learner, switching async_learner OFF!")
+
+    if (config["prioritized_buffer"] or config["model_prioritized_buffer"]) and config["learner"] != "q_learner":
+        config["prioritized_buffer"] = False
+        config["model_prioritized_buffer"] = False
+        _log.warning("Prioritised replay is only supported by the q_learner, switching it OFF for {}!".format(config["learner"]))
+
+    if config["buffer_packed"] and (config["prioritized_buffer"] or config["model_prioritized_buffer"]):
+        _log.warning("Packed buffers are not supported with prioritised replay, prioritised buffers will be padded!")
+
     return config
@@ -5,3 +5,6 @@ REGISTRY["episode"] = EpisodeRunner
 
 from .parallel_runner import ParallelRunner
 REGISTRY["parallel"] = ParallelRunner
+
+from .continuous_parallel_runner import ContinuousParallelRunner
+REGISTRY["parallel_continuous"] = ContinuousParallelRunner
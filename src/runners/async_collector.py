@@ -0,0 +1,101 @@
+import copy
+import queue
+import threading
+import time
+from utils.timehelper import time_left, time_str
+
+
+class AsyncCollector:
+    """
+    Runs a runner in a background thread so that rollouts overlap with learner updates.
+    Finished episode batches are pushed onto a bounded queue together with the learner step of the
+    parameters they were collected with, which the learner uses to measure policy lag.
+    """
+    def __init__(self, runner, args, logger):
+        self.runner = runner
+        self.args = args
+        self.logger = logger
+
+        self.queue = queue.Queue(maxsize=args.async_queue_size)
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._collect, name="AsyncCollector", daemon=True)
+
+        self.param_version = 0  # learner step the acting parameters come from
+        self._pending_params = None
+        self.error = None
+
+        self.last_test_T = -args.test_interval - 1
+        self.start_time = time.time()
+        self.last_time = self.start_time
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+
+    def publish_params(self, mac, version):
+        # Called by the learner. Hands over a snapshot which the actor picks up between episodes,
+        # so the learner never waits for a rollout to finish
+        params = copy.deepcopy(mac.agent.state_dict())
+        with self.lock:
+            self._pending_params = (params, version)
+
+    def get(self, timeout=None):
+        """ Returns (episode_batch, param_version) or None if nothing arrived within timeout """
+        if self.error is not None:
+            raise self.error
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def get_all(self):
+        items = []
+        while True:
+            try:
+                items.append(self.queue.get_nowait())
+            except queue.Empty:
+                return items
+
+    def _sync_params(self):
+        with self.lock:
+            pending, self._pending_params = self._pending_params, None
+        if pending is not None:
+            params, self.param_version = pending
+            self.runner.mac.agent.load_state_dict(params)
+
+    def _collect(self):
+        try:
+            while not self.stop_event.is_set() and self.runner.t_env <= self.args.t_max:
+                self._sync_params()
+
+                # Execute test runs once in a while
+                if (self.runner.t_env - self.last_test_T) / self.args.test_interval >= 1.0:
+                    self._test()
+
+                episode_batch = self.runner.run(test_mode=False)
+                item = (episode_batch, self.param_version)
+                while not self.stop_event.is_set():
+                    try:
+                        self.queue.put(item, timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+        except Exception as e:
+            self.error = e
+            raise
+
+    def _test(self):
+        self.logger.console_logger.info("t_env: {} / {}".format(self.runner.t_env, self.args.t_max))
+        self.logger.console_logger.info("Estimated time left: {}. Time passed: {}".format(
+            time_left(self.last_time, self.last_test_T, self.runner.t_env, self.args.t_max),
+            time_str(time.time() - self.start_time)))
+        self.last_time = time.time()
+        self.last_test_T = self.runner.t_env
+
+        n_test_runs = max(1, self.args.test_nepisode // self.runner.batch_size)
+        for _ in range(n_test_runs):
+            self.runner.run(test_mode=True)
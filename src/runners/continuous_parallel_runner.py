@@ -0,0 +1,193 @@
+from functools import partial
+from components.episode_buffer import EpisodeBatch
+from .parallel_runner import ParallelRunner
+import torch as th
+
+
+class ContinuousParallelRunner(ParallelRunner):
+    """
+    ParallelRunner variant that never waits for the slowest episode in the batch.
+    Every env keeps its own episode in a slot of an in-flight batch, with its own timestep. As soon as an
+    episode finishes it is copied into the returned batch and its env is reset to start the next one.
+    In-flight episodes carry over between calls to run, which returns once batch_size episodes are done, and are
+    played out rather than discarded when a test run needs the envs.
+    """
+
+    def __init__(self, args, logger):
+        super(ContinuousParallelRunner, self).__init__(args, logger)
+        self.needs_reset = True
+        self.pending = None  # Train episodes finished before a test run, handed off by the next call to run
+
+    def setup(self, scheme, groups, preprocess, mac):
+        super(ContinuousParallelRunner, self).setup(scheme, groups, preprocess, mac)
+        # Holds the current timestep (t=1) and the previous one (t=0, for last actions) of every slot for the mac
+        self.new_act_batch = partial(EpisodeBatch, scheme, groups, self.batch_size, 2,
+                                     preprocess=preprocess, device=self.args.device)
+
+    def reset_slots(self):
+        self.reset()
+        self.flight_batch = self.batch
+        self.act_batch = self.new_act_batch()
+        self.slot_t = th.zeros(self.batch_size, dtype=th.long, device=self.args.device)
+        self.slot_done = [False for _ in range(self.batch_size)]
+        self.slot_returns = [0 for _ in range(self.batch_size)]
+        self.slot_infos = [None for _ in range(self.batch_size)]
+        self.mac.init_hidden(batch_size=self.batch_size)
+        self.needs_reset = False
+
+    def new_handoff(self):
+        # Finished episodes, in a batch returned once full, with their returns, lengths and final env infos
+        return {"batch": self.new_batch(), "returns": [], "lengths": [], "infos": []}
+
+    def run(self, test_mode=False):
+        if test_mode:
+            # Test episodes use the synchronous runner on the same envs. The train episodes in flight are played
+            # out first and kept for the next call, so none of their steps are thrown away. The envs are reset
+            # after that
+            if not self.needs_reset:
+                self.mac.hidden_states = self.slot_hidden_states
+                self.pending = self.new_handoff()
+                self._run_slots(self.pending, drain=True)
+                self.needs_reset = True
+            return super(ContinuousParallelRunner, self).run(test_mode=True)
+
+        if self.needs_reset:
+            self.reset_slots()
+        else:
+            # The mac is shared with the learner, which resets its hidden states when it trains
+            self.mac.hidden_states = self.slot_hidden_states
+
+        handoff = self.pending if self.pending is not None else self.new_handoff()
+        self.pending = None
+        self.env_steps_this_run = self._run_slots(handoff)
+
+        cur_stats = self.train_stats
+        cur_returns = self.train_returns
+        infos = [cur_stats] + handoff["infos"]
+        cur_stats.update({k: sum(d.get(k, 0) for d in infos) for k in set.union(*[set(d) for d in infos])})
+        cur_stats["n_episodes"] = self.batch_size + cur_stats.get("n_episodes", 0)
+        cur_stats["ep_length"] = sum(handoff["lengths"]) + cur_stats.get("ep_length", 0)
+        cur_returns.extend(handoff["returns"])
+
+        if self.t_env - self.log_train_stats_t >= self.args.runner_log_interval:
+            self._log(cur_returns, cur_stats, "")
+            self._log_utilisation()
+            self.timer.log(self.logger, self.t_env, prefix="time_")
+            if hasattr(self.mac.action_selector, "epsilon"):
+                self.logger.log_stat("epsilon", self.mac.action_selector.epsilon, self.t_env)
+            self.log_train_stats_t = self.t_env
+
+        return handoff["batch"]
+
+    def _run_slots(self, handoff, drain=False):
+        # Steps the slots, handing off finished episodes and starting new ones in their place, until the handoff
+        # holds batch_size episodes. With drain, no new episodes are started and the slots run until every one of
+        # them has been handed off. Returns the number of env steps taken
+        batch = handoff["batch"]
+        n_done = len(handoff["returns"])
+        env_steps = 0
+        slots = th.arange(self.batch_size, device=self.args.device)
+        slot_idle = [False for _ in range(self.batch_size)]  # Handed off while draining
+
+        while (n_done < self.batch_size) if not drain else not all(slot_idle):
+            # Select actions for every slot at its own timestep, including the final timestep of finished episodes
+            with self.timer.phase("runner_select_actions"):
+                self._fill_act_batch(slots)
+                with th.no_grad():
+                    actions = self.mac.select_actions(self.act_batch, t_ep=1, t_env=self.t_env, test_mode=False)
+                cpu_actions = actions.to("cpu").numpy()
+            with self.timer.phase("runner_update"):
+                self._write(slots, self.slot_t, {"actions": actions.unsqueeze(-1)})
+
+            # Hand off finished episodes and restart their envs, step all the others
+            reset_slots = []
+            step_slots = []
+            for idx in range(self.batch_size):
+                if slot_idle[idx]:
+                    continue
+                if self.slot_done[idx]:
+                    if n_done == self.batch_size:
+                        continue  # Batch is full, the episode is handed off by the next call
+                    for k, v in self.flight_batch.data.transition_data.items():
+                        batch.data.transition_data[k][n_done] = v[idx]
+                    n_done += 1
+                    handoff["returns"].append(self.slot_returns[idx])
+                    handoff["lengths"].append(int(self.slot_t[idx]))
+                    handoff["infos"].append(self.slot_infos[idx])
+                    if drain:
+                        slot_idle[idx] = True
+                    else:
+                        reset_slots.append(idx)
+                else:
+                    step_slots.append(idx)
+            env_infos = self._step_envs(step_slots, cpu_actions[step_slots], reset_ids=reset_slots)
+            busy_workers = sorted({idx // self.envs_per_worker for idx in reset_slots + step_slots})
+            self.worker_busy_steps[busy_workers] += 1
+            self.worker_total_steps += 1
+
+            if step_slots:
+                rows = th.tensor(step_slots)
+                rewards = self.shared["reward"][:, 0].tolist()
+                env_terminated = []
+                for idx in step_slots:
+                    self.slot_returns[idx] += rewards[idx]
+                    env_steps += 1
+                    info = env_infos[idx]
+                    self.slot_done[idx] = bool(self.shared["terminated"][idx, 0])
+                    if self.slot_done[idx]:
+                        self.slot_infos[idx] = info
+                    env_terminated.append((self.slot_done[idx] and not info.get("episode_limit", False),))
+
+                with self.timer.phase("runner_update"):
+                    device_rows = rows.to(self.args.device)
+                    ts = self.slot_t[device_rows]
+                    self._write(device_rows, ts, {"reward": self.shared["reward"][rows], "terminated": env_terminated})
+                    self.slot_t[device_rows] += 1
+                    self._write(device_rows, ts + 1, self._shared_pre_transition_data(rows), mark_filled=True)
+
+            if reset_slots:
+                rows = th.tensor(reset_slots)
+                device_rows = rows.to(self.args.device)
+                for v in self.flight_batch.data.transition_data.values():
+                    v[device_rows] = 0
+                for idx in reset_slots:
+                    self.slot_done[idx] = False
+                    self.slot_returns[idx] = 0
+                    self.slot_infos[idx] = None
+                self.slot_t[device_rows] = 0
+                self._write(device_rows, self.slot_t[device_rows], self._shared_pre_transition_data(rows), mark_filled=True)
+
+                # Start the new episodes from a fresh hidden state
+                hidden_states = self.mac.hidden_states.reshape(self.batch_size, self.args.n_agents, -1).clone()
+                hidden_states[device_rows] = 0
+                self.mac.hidden_states = hidden_states
+
+        self.slot_hidden_states = self.mac.hidden_states
+        self.t_env += env_steps
+        return env_steps
+
+    def _fill_act_batch(self, slots):
+        data = self.act_batch.data.transition_data
+        flight = self.flight_batch.data.transition_data
+        last_t = (self.slot_t - 1).clamp(min=0)
+        data["obs"][:, 1] = flight["obs"][slots, self.slot_t]
+        data["avail_actions"][:, 1] = flight["avail_actions"][slots, self.slot_t]
+        # Slots at the start of an episode have no last action
+        started = (self.slot_t > 0).view(-1, *([1] * (flight["actions_onehot"].dim() - 2)))
+        data["actions_onehot"][:, 0] = flight["actions_onehot"][slots, last_t] * started
+
+    def _write(self, rows, ts, data, mark_filled=False):
+        # Writes each slot's row at its own timestep, applying the same preprocessing as EpisodeBatch.update
+        flight = self.flight_batch.data.transition_data
+        if mark_filled:
+            flight["filled"][rows, ts] = 1
+        for k, v in data.items():
+            dtype = self.flight_batch.scheme[k].get("dtype", th.float32)
+            v = th.as_tensor(v, dtype=dtype, device=self.args.device)
+            flight[k][rows, ts] = v.view_as(flight[k][rows, ts])
+            if k in self.preprocess:
+                new_k = self.preprocess[k][0]
+                v = flight[k][rows, ts]
+                for transform in self.preprocess[k][1]:
+                    v = transform.transform(v)
+                flight[new_k][rows, ts] = v.view_as(flight[new_k][rows, ts])
@@ -1,6 +1,7 @@
-from envs import REGISTRY as env_REGISTRY
+from envs import offset_seed, vec_env_fn
 from functools import partial
 from components.episode_buffer import EpisodeBatch
+from utils.profiling import PhaseTimer
 from multiprocessing import Pipe, Process
 import numpy as np
 import torch as th
@@ -15,11 +16,16 @@ class ParallelRunner:
         self.logger = logger
         self.batch_size = self.args.batch_size_run
 
-        # Make subprocesses for the envs
-        self.parent_conns, self.worker_conns = zip(*[Pipe() for _ in range(self.batch_size)])
-        env_fn = env_REGISTRY[self.args.env]
-        self.ps = [Process(target=env_worker, args=(worker_conn, CloudpickleWrapper(partial(env_fn, **self.args.env_args))))
-                            for worker_conn in self.worker_conns]
+        # Make subprocesses for the envs, each stepping envs_per_worker of them together
+        self.envs_per_worker = self.args.envs_per_worker
+        assert self.batch_size % self.envs_per_worker == 0, "batch_size_run must be a multiple of envs_per_worker"
+        self.n_workers = self.batch_size // self.envs_per_worker
+        self.parent_conns, self.worker_conns = zip(*[Pipe() for _ in range(self.n_workers)])
+        # Each worker's envs are seeded after those of the workers before it
+        env_fns = [partial(vec_env_fn, self.args.env, self.envs_per_worker,
+                           **offset_seed(self.args.env_args, i * self.envs_per_worker)) for i in range(self.n_workers)]
+        self.ps = [Process(target=env_worker, args=(worker_conn, CloudpickleWrapper(env_fn)))
+                            for worker_conn, env_fn in zip(self.worker_conns, env_fns)]
 
         for p in self.ps:
             p.daemon = True
@@ -29,6 +35,22 @@ class ParallelRunner:
         self.env_info = self.parent_conns[0].recv()
         self.episode_limit = self.env_info["episode_limit"]
 
+        # Workers write their per-step data straight into these shared-memory tensors (one row per env, a block
+        # of rows per worker), so only a small control message has to go through the pipes
+        n_agents = self.env_info["n_agents"]
+        self.shared = {
+            "state": th.zeros(self.batch_size, self.env_info["state_shape"]),
+            "obs": th.zeros(self.batch_size, n_agents, self.env_info["obs_shape"]),
+            "avail_actions": th.zeros(self.batch_size, n_agents, self.env_info["n_actions"], dtype=th.int),
+            "reward": th.zeros(self.batch_size, 1),
+            "terminated": th.zeros(self.batch_size, 1, dtype=th.uint8),
+        }
+        for v in self.shared.values():
+            v.share_memory_()
+        for w, parent_conn in enumerate(self.parent_conns):
+            rows = slice(w * self.envs_per_worker, (w + 1) * self.envs_per_worker)
+            parent_conn.send(("setup_shared", (rows, self.shared)))
+
         self.t = 0
 
         self.t_env = 0
@@ -41,6 +63,13 @@ class ParallelRunner:
 
         self.log_train_stats_t = -100000
 
+        # Steps each worker spent stepping any of its envs vs. steps the runner loop took, to measure utilisation
+        self.worker_busy_steps = np.zeros(self.n_workers)
+        self.worker_total_steps = np.zeros(self.n_workers)
+
+        # Time spent in each part of the rollout loop, logged as runner_* stats
+        self.timer = PhaseTimer(self.args.phase_timers, cuda_sync=self.args.phase_timers_cuda_sync)
+
     def setup(self, scheme, groups, preprocess, mac):
         self.new_batch = partial(EpisodeBatch, scheme, groups, self.batch_size, self.episode_limit + 1,
                                  preprocess=preprocess, device=self.args.device)
@@ -62,23 +91,10 @@ class ParallelRunner:
     def reset(self):
         self.batch = self.new_batch()
 
-        # Reset the envs
-        for parent_conn in self.parent_conns:
-            parent_conn.send(("reset", None))
+        # Reset the envs, which write their initial obs, state and avail_actions to shared memory
+        self._step_envs([], [], reset_ids=range(self.batch_size))
 
-        pre_transition_data = {
-            "state": [],
-            "avail_actions": [],
-            "obs": []
-        }
-        # Get the obs, state and avail_actions back
-        for parent_conn in self.parent_conns:
-            data = parent_conn.recv()
-            pre_transition_data["state"].append(data["state"])
-            pre_transition_data["avail_actions"].append(data["avail_actions"])
-            pre_transition_data["obs"].append(data["obs"])
-
-        self.batch.update(pre_transition_data, ts=0)
+        self.batch.update(self._shared_pre_transition_data(slice(None)), ts=0)
 
         self.t = 0
         self.env_steps_this_run = 0
@@ -98,23 +114,22 @@ class ParallelRunner:
 
             # Pass the entire batch of experiences up till now to the agents
             # Receive the actions for each agent at this timestep in a batch for each un-terminated env
-            actions = self.mac.select_actions(self.batch, t_ep=self.t, t_env=self.t_env,
-                                                  bs=envs_not_terminated, test_mode=test_mode)
-            cpu_actions = actions.to("cpu").numpy()
+            with self.timer.phase("runner_select_actions"):
+                actions = self.mac.select_actions(self.batch, t_ep=self.t, t_env=self.t_env,
+                                                      bs=envs_not_terminated, test_mode=test_mode)
+                cpu_actions = actions.to("cpu").numpy()
 
             # Update the actions taken
             actions_chosen = {
                 "actions": actions.unsqueeze(1)
             }
-            self.batch.update(actions_chosen, bs=envs_not_terminated, ts=self.t, mark_filled=False)
+            with self.timer.phase("runner_update"):
+                self.batch.update(actions_chosen, bs=envs_not_terminated, ts=self.t, mark_filled=False)
 
-            # Send actions to each env
-            action_idx = 0
-            for idx, parent_conn in enumerate(self.parent_conns):
-                if idx in envs_not_terminated: # We produced actions for this env
-                    if not terminated[idx]: # Only send the actions to the env if it hasn't terminated
-                        parent_conn.send(("step", cpu_actions[action_idx]))
-                    action_idx += 1 # actions is not a list over every env
+            # Step the envs we produced actions for that haven't terminated (actions is not a list over every env, and
+            # also covers the final timestep of envs that terminated on the last step), their data is in shared memory
+            step_rows = [i for i, idx in enumerate(envs_not_terminated) if not terminated[idx]]
+            env_infos = self._step_envs([envs_not_terminated[i] for i in step_rows], cpu_actions[step_rows])
 
             # Update envs_not_terminated
             envs_not_terminated = [b_idx for b_idx, termed in enumerate(terminated) if not termed]
@@ -122,54 +137,41 @@ class ParallelRunner:
             if all_terminated:
                 break
 
-            # Post step data we will insert for the current timestep
-            post_transition_data = {
-                "reward": [],
-                "terminated": []
-            }
-            # Data for the next step we will insert in order to select an action
-            pre_transition_data = {
-                "state": [],
-                "avail_actions": [],
-                "obs": []
-            }
-
-            # Receive data back for each unterminated env
-            for idx, parent_conn in enumerate(self.parent_conns):
-                if not terminated[idx]:
-                    data = parent_conn.recv()
-                    # Remaining data for this current timestep
-                    post_transition_data["reward"].append((data["reward"],))
-
-                    episode_returns[idx] += data["reward"]
-                    episode_lengths[idx] += 1
-                    if not test_mode:
-                        self.env_steps_this_run += 1
-
-                    env_terminated = False
-                    if data["terminated"]:
-                        final_env_infos.append(data["info"])
-                    if data["terminated"] and not data["info"].get("episode_limit", False):
-                        env_terminated = True
-                    terminated[idx] = data["terminated"]
-                    post_transition_data["terminated"].append((env_terminated,))
-
-                    # Data for the next timestep needed to select an action
-                    pre_transition_data["state"].append(data["state"])
-                    pre_transition_data["avail_actions"].append(data["avail_actions"])
-                    pre_transition_data["obs"].append(data["obs"])
-
-            # Add post_transiton data into the batch
-            self.batch.update(post_transition_data, bs=envs_not_terminated, ts=self.t, mark_filled=False)
-
-            # Move onto the next timestep
-            self.t += 1
-
-            # Add the pre-transition data
-            self.batch.update(pre_transition_data, bs=envs_not_terminated, ts=self.t, mark_filled=True)
+            rows = slice(None) if len(envs_not_terminated) == self.batch_size else th.tensor(envs_not_terminated)
+            rewards = self.shared["reward"][:, 0].tolist()
+            env_terminated = []
+            for idx in envs_not_terminated:
+                episode_returns[idx] += rewards[idx]
+                episode_lengths[idx] += 1
+                if not test_mode:
+                    self.env_steps_this_run += 1
+
+                info = env_infos[idx]
+                terminated[idx] = bool(self.shared["terminated"][idx, 0])
+                if terminated[idx]:
+                    final_env_infos.append(info)
+                env_terminated.append((terminated[idx] and not info.get("episode_limit", False),))
+
+            with self.timer.phase("runner_update"):
+                # Post step data we will insert for the current timestep
+                post_transition_data = {
+                    "reward": self.shared["reward"][rows],
+                    "terminated": env_terminated
+                }
+
+                # Add post_transiton data into the batch
+                self.batch.update(post_transition_data, bs=envs_not_terminated, ts=self.t, mark_filled=False)
+
+                # Move onto the next timestep
+                self.t += 1
+
+                # Add the pre-transition data for the next timestep needed to select an action
+                self.batch.update(self._shared_pre_transition_data(rows), bs=envs_not_terminated, ts=self.t, mark_filled=True)
 
         if not test_mode:
             self.t_env += self.env_steps_this_run
+            self.worker_busy_steps += np.reshape(episode_lengths, (self.n_workers, self.envs_per_worker)).max(1)
+            self.worker_total_steps += self.t
 
         # Get stats back for each env
         for parent_conn in self.parent_conns:
@@ -177,8 +179,7 @@ class ParallelRunner:
 
         env_stats = []
         for parent_conn in self.parent_conns:
-            env_stat = parent_conn.recv()
-            env_stats.append(env_stat)
+            env_stats.extend(parent_conn.recv())
 
         cur_stats = self.test_stats if test_mode else self.train_stats
         cur_returns = self.test_returns if test_mode else self.train_returns
@@ -199,12 +200,59 @@ class ParallelRunner:
             self._log(cur_returns, cur_stats, log_prefix)
         elif self.t_env - self.log_train_stats_t >= self.args.runner_log_interval:
             self._log(cur_returns, cur_stats, log_prefix)
+            self._log_utilisation()
+            self.timer.log(self.logger, self.t_env, prefix="time_")
             if hasattr(self.mac.action_selector, "epsilon"):
                 self.logger.log_stat("epsilon", self.mac.action_selector.epsilon, self.t_env)
             self.log_train_stats_t = self.t_env
 
         return self.batch
 
+    def _step_envs(self, step_ids, actions, reset_ids=()):
+        # Steps the envs in step_ids with the matching rows of actions and resets the envs in reset_ids, with one
+        # message per worker for all of its envs. Returns {env: info} for the stepped envs, info is only sent back
+        # at the end of an episode
+        steps = {}
+        for idx, env_actions in zip(step_ids, actions):
+            local_ids, local_actions = steps.setdefault(idx // self.envs_per_worker, ([], []))
+            local_ids.append(idx % self.envs_per_worker)
+            local_actions.append(env_actions)
+        resets = {}
+        for idx in reset_ids:
+            resets.setdefault(idx // self.envs_per_worker, []).append(idx % self.envs_per_worker)
+
+        with self.timer.phase("runner_send"):
+            for w, local_ids in resets.items():
+                self.parent_conns[w].send(("reset", local_ids))
+            for w, (local_ids, local_actions) in steps.items():
+                self.parent_conns[w].send(("step", (local_ids, np.stack(local_actions))))
+
+        # Includes the time spent waiting for the slowest worker to step its envs
+        with self.timer.phase("runner_recv"):
+            for w in resets:
+                self.parent_conns[w].recv()
+            env_infos = {}
+            for w, (local_ids, _) in steps.items():
+                for i, info in zip(local_ids, self.parent_conns[w].recv()):
+                    env_infos[w * self.envs_per_worker + i] = info
+        return env_infos
+
+    def _shared_pre_transition_data(self, rows):
+        # Views into shared memory when all envs are included, otherwise a gather of the requested rows
+        return {
+            "state": self.shared["state"][rows],
+            "avail_actions": self.shared["avail_actions"][rows],
+            "obs": self.shared["obs"][rows]
+        }
+
+    def _log_utilisation(self):
+        if self.worker_total_steps.sum() > 0:
+            utilisation = self.worker_busy_steps / np.maximum(self.worker_total_steps, 1)
+            self.logger.log_stat("worker_utilisation_mean", utilisation.mean(), self.t_env)
+            self.logger.log_stat("worker_utilisation_min", utilisation.min(), self.t_env)
+        self.worker_busy_steps[:] = 0
+        self.worker_total_steps[:] = 0
+
     def _log(self, returns, stats, prefix):
         self.logger.log_stat(prefix + "return_mean", np.mean(returns), self.t_env)
         self.logger.log_stat(prefix + "return_std", np.std(returns), self.t_env)
@@ -218,35 +266,29 @@ class ParallelRunner:
 
 
 def env_worker(remote, env_fn):
-    # Make environment
+    # Make the batch of environments hosted by this worker
     env = env_fn.x()
+    shared = None
     while True:
         cmd, data = remote.recv()
         if cmd == "step":
-            actions = data
-            # Take a step in the environment
-            reward, terminated, env_info = env.step(actions)
-            # Return the observations, avail_actions and state to make the next action
-            state = env.get_state()
-            avail_actions = env.get_avail_actions()
-            obs = env.get_obs()
-            remote.send({
-                # Data for the next timestep needed to pick an action
-                "state": state,
-                "avail_actions": avail_actions,
-                "obs": obs,
-                # Rest of the data for the current timestep
-                "reward": reward,
-                "terminated": terminated,
-                "info": env_info
-            })
+            env_ids, actions = data
+            # Take a step in the environments
+            rewards, terminated, env_infos = env.step(actions, env_ids)
+            # Write the observations, avail_actions and state needed to make the next action
+            _write_shared_obs(env, shared, env_ids)
+            # Rest of the data for the current timestep
+            shared["reward"][env_ids, 0] = rewards
+            shared["terminated"][env_ids, 0] = terminated
+            # The env info is only needed by the parent at the end of an episode
+            remote.send([info if term else None for info, term in zip(env_infos, terminated)])
         elif cmd == "reset":
-            env.reset()
-            remote.send({
-                "state": env.get_state(),
-                "avail_actions": env.get_avail_actions(),
-                "obs": env.get_obs()
-            })
+            env.reset(data)
+            _write_shared_obs(env, shared, data)
+            remote.send(None)
+        elif cmd == "setup_shared":
+            rows, buffers = data
+            shared = {k: v[rows].numpy() for k, v in buffers.items()}
         elif cmd == "close":
             env.close()
             remote.close()
@@ -259,6 +301,13 @@ def env_worker(remote, env_fn):
             raise NotImplementedError
 
 
+def _write_shared_obs(env, shared, env_ids):
+    rows = slice(None) if env_ids is None else env_ids
+    shared["state"][rows] = env.get_state(env_ids)
+    shared["avail_actions"][rows] = env.get_avail_actions(env_ids)
+    shared["obs"][rows] = env.get_obs(env_ids)
+
+
 class CloudpickleWrapper():
     """
     Uses cloudpickle to serialize contents (otherwise multiprocessing tries to use pickle)
@@ -0,0 +1,76 @@
+import torch as th
+import torch.nn as nn
+
+
+class ParamGroup:
+    """
+    The parameters a learner optimises, or the target parameters that follow them, in a fixed order.
+
+    With flat=True the parameters are moved into views of one contiguous buffer, and their gradients into views of
+    another, so that zeroing, clipping, the optimiser step and target updates each run on a single tensor. The
+    optimiser must then be built on optimiser_params(), and gradients zeroed with zero_grad() rather than the
+    optimiser's, which would detach them from the buffer. Anything that replaces the parameter tensors, like
+    Module.cuda(), must be followed by flatten().
+    Target groups (requires_grad=False) take no gradients, their modules are only evaluated to build targets.
+    """
+    def __init__(self, params, flat=False, requires_grad=True):
+        self.params = list(params)
+        self.flat = flat
+        self.requires_grad = requires_grad
+        self.flat_param = None
+        if not requires_grad:
+            for p in self.params:
+                p.requires_grad_(False)
+        self.flatten()
+
+    def flatten(self):
+        if not self.flat:
+            return
+        device, dtype = self.params[0].device, self.params[0].dtype
+        assert all(p.device == device and p.dtype == dtype for p in self.params), \
+            "Flat parameters must share a device and dtype"
+        data = th.cat([p.data.reshape(-1) for p in self.params])
+        grad = th.zeros_like(data) if self.requires_grad else None
+        offset = 0
+        for p in self.params:
+            n = p.numel()
+            p.data = data[offset:offset + n].view_as(p)
+            if grad is not None:
+                p.grad = grad[offset:offset + n].view_as(p)
+            offset += n
+
+        if self.flat_param is None:
+            self.flat_param = nn.Parameter(data, requires_grad=self.requires_grad)
+        else:
+            self.flat_param.data = data
+        self.flat_param.grad = grad
+
+    def optimiser_params(self):
+        return [self.flat_param] if self.flat else self.params
+
+    def zero_grad(self):
+        if self.flat:
+            self.flat_param.grad.zero_()
+        else:
+            for p in self.params:
+                p.grad = None
+
+    def clip_grad_norm(self, max_norm):
+        return th.nn.utils.clip_grad_norm_(self.optimiser_params(), max_norm)
+
+    @th.no_grad()
+    def copy_(self, other):
+        # Hard target update, to the parameters of other
+        if self.flat and other.flat:
+            self.flat_param.copy_(other.flat_param)
+        else:
+            for p, other_p in zip(self.params, other.params):
+                p.copy_(other_p)
+
+    @th.no_grad()
+    def lerp_(self, other, tau):
+        # Soft (Polyak) target update, moving tau of the way to the parameters of other
+        if self.flat and other.flat:
+            self.flat_param.lerp_(other.flat_param, tau)
+        else:
+            th._foreach_lerp_(self.params, other.params, tau)
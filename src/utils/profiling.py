@@ -0,0 +1,131 @@
+import cProfile
+import os
+import pstats
+import time
+from collections import defaultdict
+import torch as th
+
+
+class _Phase:
+    __slots__ = ["timer", "name", "start", "record"]
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.record = None
+        if self.timer.record_functions:
+            self.record = th.profiler.record_function(self.name)
+            self.record.__enter__()
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        if self.timer.cuda_sync:
+            th.cuda.synchronize()
+        self.timer.totals[self.name] += time.perf_counter() - self.start
+        self.timer.counts[self.name] += 1
+        if self.record is not None:
+            self.record.__exit__(*exc)
+
+
+class _NoPhase:
+    __slots__ = []
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NO_PHASE = _NoPhase()
+
+
+class PhaseTimer:
+    """
+    Accumulates the wall-clock time spent in named phases, timed with `with timer.phase(name):`.
+    log() reports every phase since the previous log as <prefix><name>_mean (seconds per call) and
+    <prefix><name>_frac (share of the elapsed time). A disabled timer costs one method call per phase.
+    With cuda_sync the gpu is synchronised at the end of each phase, so that its work is attributed to the phase.
+    """
+    def __init__(self, enabled=True, cuda_sync=False):
+        self.enabled = enabled
+        self.cuda_sync = cuda_sync and th.cuda.is_available()
+        self.record_functions = False  # also label phases in torch.profiler traces, see ProfilerWindow
+        self.totals = defaultdict(float)
+        self.counts = defaultdict(int)
+        self.last_log_time = time.perf_counter()
+
+    def phase(self, name):
+        if not self.enabled:
+            return _NO_PHASE
+        return _Phase(self, name)
+
+    def log(self, logger, t, prefix="time_"):
+        now = time.perf_counter()
+        elapsed = max(now - self.last_log_time, 1e-9)
+        for name, total in self.totals.items():
+            logger.log_stat("{}{}_mean".format(prefix, name), total / self.counts[name], t)
+            logger.log_stat("{}{}_frac".format(prefix, name), total / elapsed, t)
+        self.totals.clear()
+        self.counts.clear()
+        self.last_log_time = now
+
+
+class ProfilerWindow:
+    """
+    Profiles iterations [start, start + n_iterations) of a loop which calls step() at the end of every iteration.
+    kind is "torch" for torch.profiler, writing a chrome trace and a table of op times, or "cprofile" for
+    cProfile, writing a stats file and a table of function times. Output goes to out_dir.
+    While a torch profile is recorded, the phases of the given timers are labelled in the trace.
+    """
+    def __init__(self, kind, start, n_iterations, out_dir, timers=()):
+        assert kind in ["torch", "cprofile"], "Unknown profiler {}".format(kind)
+        self.kind = kind
+        self.start = start
+        self.end = start + n_iterations
+        self.out_dir = out_dir
+        self.timers = timers
+        self.iteration = 0
+        self.profiler = None
+        if self.start == 0:
+            self._begin()
+
+    def step(self):
+        self.iteration += 1
+        if self.iteration == self.start:
+            self._begin()
+        elif self.iteration == self.end:
+            self.close()
+
+    def close(self):
+        if self.profiler is None:
+            return
+        os.makedirs(self.out_dir, exist_ok=True)
+        if self.kind == "torch":
+            self.profiler.__exit__(None, None, None)
+            for timer in self.timers:
+                timer.record_functions = False
+            self.profiler.export_chrome_trace(os.path.join(self.out_dir, "trace.json"))
+            with open(os.path.join(self.out_dir, "ops.txt"), "w") as f:
+                f.write(self.profiler.key_averages().table(sort_by="self_cpu_time_total", row_limit=100))
+        else:
+            self.profiler.disable()
+            self.profiler.dump_stats(os.path.join(self.out_dir, "profile.prof"))
+            with open(os.path.join(self.out_dir, "functions.txt"), "w") as f:
+                pstats.Stats(self.profiler, stream=f).sort_stats("cumulative").print_stats(100)
+        self.profiler = None
+
+    def _begin(self):
+        if self.kind == "torch":
+            activities = [th.profiler.ProfilerActivity.CPU]
+            if th.cuda.is_available():
+                activities.append(th.profiler.ProfilerActivity.CUDA)
+            self.profiler = th.profiler.profile(activities=activities, record_shapes=True)
+            self.profiler.__enter__()
+            for timer in self.timers:
+                timer.record_functions = True
+        else:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
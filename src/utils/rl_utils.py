@@ -1,15 +1,59 @@
 import torch as th
 
 
+def discounted_cumsum(x, discount, init=None, chunk_size=64):
+    # Returns y in B*T*..., with y[:, t] = x[:, t] + discount * y[:, t + 1] and y[:, T] = <init> (0 if None)
+    # Evaluated backwards a chunk of timesteps at a time, each as a product with a triangular matrix of discount powers
+    size = min(chunk_size, x.shape[1])
+    exps = th.arange(size, device=x.device, dtype=x.dtype)
+    exps = exps.view(1, -1) - exps.view(-1, 1)
+    powers = th.where(exps >= 0, discount ** exps.clamp(min=0), th.zeros_like(exps))
+    carry_powers = discount ** th.arange(size, 0, -1, device=x.device, dtype=x.dtype)
+    carry = init
+    chunks = []
+    for end in range(x.shape[1], 0, -size):
+        start = max(end - size, 0)
+        length = end - start
+        y = th.einsum("tk,bk...->bt...", powers[:length, :length], x[:, start:end])
+        if carry is not None:
+            y = y + carry_powers[size - length:].view(1, length, *([1] * (x.dim() - 2))) * carry.unsqueeze(1)
+        chunks.append(y)
+        carry = y[:, 0]
+    return th.cat(chunks[::-1], dim=1)
+
+
 def build_td_lambda_targets(rewards, terminated, mask, target_qs, n_agents, gamma, td_lambda):
     # Assumes  <target_qs > in B*T*A and <reward >, <terminated >, <mask > in (at least) B*T-1*1
     # Initialise  last  lambda -return  for  not  terminated  episodes
-    ret = target_qs.new_zeros(*target_qs.shape)
-    ret[:, -1] = target_qs[:, -1] * (1 - th.sum(terminated, dim=1))
-    # Backwards  recursive  update  of the "forward  view"
-    for t in range(ret.shape[1] - 2, -1,  -1):
-        ret[:, t] = td_lambda * gamma * ret[:, t + 1] + mask[:, t] \
-                    * (rewards[:, t] + (1 - td_lambda) * gamma * target_qs[:, t + 1] * (1 - terminated[:, t]))
+    last = target_qs[:, -1] * (1 - th.sum(terminated, dim=1))
+    # The backwards recursive update of the "forward view" ret_t = td_lambda * gamma * ret_t+1 + steps_t
+    steps = mask * (rewards + (1 - td_lambda) * gamma * target_qs[:, 1:] * (1 - terminated))
     # Returns lambda-return from t=0 to t=T-1, i.e. in B*T-1*A
-    return ret[:, 0:-1]
+    return discounted_cumsum(steps, td_lambda * gamma, init=last)
+
+
+def build_n_step_targets(rewards, terminated, mask, target_qs, n_agents, gamma, nstep):
+    # Assumes  <target_qs > in B*T*A and <reward >, <terminated >, <mask > in (at least) B*T-1*1, with <mask > 1 up to
+    # the end of each episode. Sums the next nstep discounted rewards and bootstraps from the target after them,
+    # both cut short at the end of the episode. There is no bootstrap if the episode terminates in between
+    def windows(x):
+        # B*T-1*...*nstep windows of x[:, t:t + nstep], 0 past the end
+        padded = th.cat([x, x.new_zeros(x.shape[0], nstep - 1, *x.shape[2:])], dim=1)
+        return padded.unfold(1, nstep, 1)
+
+    discounts = gamma ** th.arange(nstep, device=rewards.device, dtype=rewards.dtype)
+    returns = (windows(rewards * mask) * discounts).sum(-1)
+
+    # Timesteps taken before bootstrapping
+    steps = windows(mask).sum(-1)
+    ended = (windows(terminated * mask).sum(-1) > 0).to(rewards.dtype)
+    ts = th.arange(rewards.shape[1], device=rewards.device).view(1, -1, *([1] * (rewards.dim() - 2)))
+    bootstrap = th.gather(target_qs, 1, (ts + steps.long()).expand(-1, -1, *target_qs.shape[2:]))
+
+    # Returns n-step targets from t=0 to t=T-1, i.e. in B*T-1*A
+    return returns + (gamma ** steps) * bootstrap * (1 - ended) * mask
+
 
+def build_discounted_returns(rewards, mask, gamma):
+    # Assumes <reward >, <mask > in B*T*..., returns the discounted sum of the rewards from each timestep on
+    return discounted_cumsum(rewards * mask, gamma)